@@ -16,7 +16,14 @@ def plots(m,
           traded_volume=False,
           open_interest=False,
           margin=False,
-          valuation=False):
+          valuation=False,
+          max_points=1000,
+          max_lps=10):
+    '''
+    Plot a market's history. Each subplot is downsampled to about max_points rows before drawing (see _downsample),
+    and LP plots show the max_lps largest LPs by stake, with the rest added up as "others". Pass None for either to
+    plot everything.
+    '''
 
     show_all = not (
         mark_price or
@@ -32,19 +39,27 @@ def plots(m,
         margin or 
         valuation)
 
+    # kept by the market's history, so redrawing after stepping the market forward only exports the new records
     df = m.to_data_frame(
-        lp_fields=['stake', 'equity_share', 'stake_share', 'fee_revenue', 'annualised_return', 'margin'])
+        lp_fields=['stake', 'equity_share', 'stake_share', 'fee_revenue', 'annualised_return', 'margin'],
+        incremental=True)
+    lps = m._history.lp_names
 
+    def frame(columns):
+        return _downsample(df[columns], max_points)
+
+    def lp_frame(field, market_columns=[]):
+        return _downsample(pd.concat([df[market_columns], _lp_frame(df, lps, field, max_lps)], axis=1), max_points)
     
 
     if show_all or mark_price:
-        ax = df[['mark_price']].plot(title="Mark price")
+        ax = frame(['mark_price']).plot(title="Mark price")
         ax.get_yaxis().set_major_formatter(
             mtick.FuncFormatter(lambda x, p: format(int(x), ',')))
         ax.set(xlabel="day")
 
     if show_all or market_size:
-        ax = df[['traded_volume', 'open_interest']].plot(
+        ax = frame(['traded_volume', 'open_interest']).plot(
             subplots=True, title="Volume & open interest")
         ax[0].get_yaxis().set_major_formatter(
             mtick.FuncFormatter(lambda x, p: f'%1.0fM' % (x * 1e-6)))
@@ -53,58 +68,57 @@ def plots(m,
         ax[1].set(xlabel="day")
 
     if traded_volume:  # already covered in market_size so not including in show_all
-        ax = df[['traded_volume']].plot(title="Volume")
+        ax = frame(['traded_volume']).plot(title="Volume")
         ax.get_yaxis().set_major_formatter(
             mtick.FuncFormatter(lambda x, p: f'%1.0fM' % (x * 1e-6)))
         ax.set(xlabel="day")
 
     if open_interest:  # already covered in market_size so not including in show_all
-        ax = df[['open_interest']].plot(title="Open interest")
+        ax = frame(['open_interest']).plot(title="Open interest")
         ax.get_yaxis().set_major_formatter(
             mtick.FuncFormatter(lambda x, p: f'%1.0fk' % (x * 1e-3)))
         ax.set(xlabel="day")
 
     if show_all or stake_vs_target:
-        ax = df[['target_stake', 'total_stake']].plot(title="Stake")
+        ax = frame(['target_stake', 'total_stake']).plot(title="Stake")
         ax.get_yaxis().set_major_formatter(
             mtick.FuncFormatter(lambda x, p: f'%1.0fk' % (x * 1e-3)))
         ax.set(xlabel="day")
 
     if show_all or fee_rate:
-        ax = df[['fee_rate']].plot(title="Fee rate")
+        ax = frame(['fee_rate']).plot(title="Fee rate")
         ax.get_yaxis().set_major_formatter(
             mtick.FuncFormatter(lambda x, p: '{:.3%}'.format(x)))
         ax.set(xlabel="day")
 
     if show_all or fees_collected:
-        fees = df[['fees_collected']]
-        ax = fees.plot(title="Fees collected / day")
+        ax = frame(['fees_collected']).plot(title="Fees collected / day")
         ax.get_yaxis().set_major_formatter(
             mtick.FuncFormatter(lambda x, p: format(int(x), ',')))
         ax.set(xlabel="day")
 
     if show_all or equity_share:
-        ax = df[[col for col in df.columns if 'equity_share' in col]].plot(title="Equity Share")
+        ax = lp_frame('equity_share').plot(title="Equity Share")
         ax.set(xlabel="day")
         ax.set(ylabel="share")
 
     if show_all or stake_share:
-        ax = df[[col for col in df.columns if 'stake_share' in col]].plot(title="Stake Share")
+        ax = lp_frame('stake_share').plot(title="Stake Share")
         ax.set(xlabel="day")
         ax.set(ylabel="share")
 
 
     if show_all or annualised_return:
-        ax = df[[col for col in df.columns if 'annualised_return' in col]].plot(
+        ax = lp_frame('annualised_return', ['annualised_return', 'annualised_return_on_capital']).plot(
             title="Annualised Rate of Return")
 
     if show_all or margin:
-        ax = df[[col for col in df.columns if 'margin' in col]].plot(title="Margin for orders")
+        ax = lp_frame('margin', ['total_margin']).plot(title="Margin for orders")
         ax.set(xlabel="day")
         ax.set(ylabel="margin amount")
 
     if show_all or valuation:
-        ax = df[['traded_volume', 'valuation']].plot(
+        ax = frame(['traded_volume', 'valuation']).plot(
             subplots=True, title="volume & valuation")
         ax[0].set(xlabel="day")
         ax[0].set(ylabel="volume")
@@ -113,18 +127,67 @@ def plots(m,
 
 
 
+def _lp_frame(df, lps, field, max_lps, others='others'):
+    '''
+    The field columns of df for each of lps. Beyond max_lps LPs, only the max_lps with the largest mean stake are
+    kept and the rest are added up into one column: a total, or for annualised_return their combined return.
+    '''
+    columns = [f'{lp}_{field}' for lp in lps]
+    if max_lps is None or len(lps) <= max_lps:
+        return df[columns]
+    stakes = np.nan_to_num(df[[f'{lp}_stake' for lp in lps]].mean().to_numpy())
+    kept = np.zeros(len(lps), dtype=bool)
+    kept[np.argsort(-stakes, kind='stable')[:max_lps]] = True
+    rest = [lp for (lp, keep) in zip(lps, kept) if not keep]
+    if field == 'annualised_return':
+        stake = df[[f'{lp}_stake' for lp in rest]].sum(axis=1, min_count=1)
+        total = 365 * df[[f'{lp}_fee_revenue' for lp in rest]].sum(axis=1, min_count=1) / stake
+    else:
+        total = df[[f'{lp}_{field}' for lp in rest]].sum(axis=1, min_count=1)
+    return df[[column for (column, keep) in zip(columns, kept) if keep]].assign(**{f'{others}_{field}': total})
+
+
+def _downsample(df, max_points):
+    '''
+    At most about max_points rows of df, chosen to keep its shape: the first and last rows, and in each of
+    max_points / (2 * columns) equal buckets of rows, those holding each column's minimum and maximum
+    '''
+    n = len(df)
+    if max_points is None or n <= max_points or not len(df.columns):
+        return df
+    values = df.to_numpy(dtype=float)
+    buckets = max(1, max_points // (2 * values.shape[1]))
+    width = -(-n // buckets)
+    padded = np.full((buckets * width, values.shape[1]), np.nan)
+    padded[:n] = values
+    blocks = padded.reshape(buckets, width, values.shape[1])
+    starts = np.arange(buckets)[:, None] * width
+    missing = np.isnan(blocks)
+    lows = np.argmin(np.where(missing, np.inf, blocks), axis=1) + starts
+    highs = np.argmax(np.where(missing, -np.inf, blocks), axis=1) + starts
+    rows = np.unique(np.concatenate([lows.ravel(), highs.ravel(), [0, n - 1]]))
+    return df.iloc[rows[rows < n]]
+
+
 def visualise_orders(lp: 'LiquidityProvider', plot_pegged_orders=False, plot_liquidity_fractions=False, plot_prob_of_trading=False, title='', print_liquidity=False, print_margins=False):
-    mid = lp.market.mark_price
-    tick_size = lp.market.tick_size
-    bid_levels = []
-    offer_levels = []
-    for i in range(1, lp.market.num_ticks+1):
-        bid_levels = np.append(bid_levels, mid-i*tick_size)
-        offer_levels = np.append(offer_levels, mid+i*tick_size)
-
-    bid_indices = [i for i in range(lp.market.num_ticks)]
-    offer_indices = [i for i in range(
-        lp.market.num_ticks+1, 2*lp.market.num_ticks+1)]
+    from mechanism.liquidity_provider import ladder, normalise_fractions
+
+    market = lp.market
+    mid = market.mark_price
+    # each side's ladder (price levels and probabilities of trading) on the LP's current book, and its pegged
+    # volumes, computed once
+    bids = ladder(mid, market.tick_size, lp.buy_side_shape.ticks, market.risk_model, False)
+    offers = ladder(mid, market.tick_size, lp.sell_side_shape.ticks, market.risk_model, True)
+    bid_levels = bids.prices
+    offer_levels = offers.prices
+    num_bids = len(bid_levels)
+    num_offers = len(offer_levels)
+    if plot_pegged_orders:
+        shape_implied_bids = lp.get_volume_meeting_obligation_from_shape(lp.buy_side_shape)
+        shape_implied_offers = lp.get_volume_meeting_obligation_from_shape(lp.sell_side_shape)
+
+    bid_indices = np.arange(num_bids)
+    offer_indices = np.arange(num_bids + 1, num_bids + num_offers + 1)
 
     # bids
     plt.bar(bid_indices, np.flip(
@@ -133,7 +196,7 @@ def visualise_orders(lp: 'LiquidityProvider', plot_pegged_orders=False, plot_liq
     # offers
     plt.bar(offer_indices, lp.sell_side_shape.limit_orders, color='red')
 
-    plt.xticks([i for i in range(2*lp.market.num_ticks+1)],
+    plt.xticks(np.arange(num_bids + num_offers + 1),
                np.concatenate((np.flip(bid_levels), "mid", offer_levels), axis=None))
     plt.xticks(rotation=90)
 
@@ -142,11 +205,6 @@ def visualise_orders(lp: 'LiquidityProvider', plot_pegged_orders=False, plot_liq
     legend = ['Bids', 'Offers']
 
     if plot_pegged_orders:
-        shape_implied_bids = lp.get_volume_meeting_obligation_from_shape(
-            lp.buy_side_shape)
-        shape_implied_offers = lp.get_volume_meeting_obligation_from_shape(
-            lp.sell_side_shape)
-
         # bids
         plt.bar(bid_indices, np.flip(shape_implied_bids), bottom=np.flip(
             lp.buy_side_shape.limit_orders), color='lightgreen')
@@ -164,9 +222,9 @@ def visualise_orders(lp: 'LiquidityProvider', plot_pegged_orders=False, plot_liq
         ax2.set_ylabel('probability')
         legend2 = np.array([])
         if plot_liquidity_fractions:
-            bid_fractions = np.flip(lp._normalise_fractions(
+            bid_fractions = np.flip(normalise_fractions(
                 lp.buy_side_shape.liquidity_fractions))
-            offer_fractions = lp._normalise_fractions(
+            offer_fractions = normalise_fractions(
                 lp.sell_side_shape.liquidity_fractions)
 
             ax2.scatter(np.concatenate((bid_indices, offer_indices)), np.concatenate(
@@ -175,11 +233,10 @@ def visualise_orders(lp: 'LiquidityProvider', plot_pegged_orders=False, plot_liq
             legend2 = np.append(legend2, ['liquidity fraction'])
 
         if plot_prob_of_trading:
-            price_levels = np.concatenate(
-                (np.flip(bid_levels), mid, offer_levels), axis=None)
-            probabilities = [lp.market.risk_model.ProbOfTrading(
-                mid, level) for level in price_levels]
-            ax2.plot([i for i in range(2*lp.market.num_ticks+1)],
+            probabilities = np.concatenate(
+                (np.flip(bids.prob_of_trading), market.risk_model.ProbsOfTrading(mid, mid), offers.prob_of_trading),
+                axis=None)
+            ax2.plot(np.arange(num_bids + num_offers + 1),
                      probabilities, 'm--')
             legend2 = np.append(['prob. of trading'], legend2)
 
@@ -191,14 +248,14 @@ def visualise_orders(lp: 'LiquidityProvider', plot_pegged_orders=False, plot_liq
     plt.title(title)
     plt.show()
 
-    if print_liquidity:
+    if print_liquidity or print_margins:
         bid = lp.buy_side_shape.limit_orders
         offer = lp.sell_side_shape.limit_orders
         if plot_pegged_orders:
-            bid = bid + lp.get_volume_meeting_obligation_from_shape(
-                lp.buy_side_shape)
-            offer = offer + lp.get_volume_meeting_obligation_from_shape(
-                lp.sell_side_shape)
+            bid = bid + shape_implied_bids
+            offer = offer + shape_implied_offers
+
+    if print_liquidity:
         bid_liquidity = lp.buy_side_shape.CalculateLiquidity(bid)
         offer_liquidity = lp.sell_side_shape.CalculateLiquidity(offer)
         print(
@@ -206,13 +263,6 @@ def visualise_orders(lp: 'LiquidityProvider', plot_pegged_orders=False, plot_liq
             format(lp.obligation, bid_liquidity, offer_liquidity, min(bid_liquidity, offer_liquidity)))
 
     if print_margins:
-        bid = lp.buy_side_shape.limit_orders
-        offer = lp.sell_side_shape.limit_orders
-        if plot_pegged_orders:
-            bid = bid + lp.get_volume_meeting_obligation_from_shape(
-                lp.buy_side_shape)
-            offer = offer + lp.get_volume_meeting_obligation_from_shape(
-                lp.sell_side_shape)
         bid_margin = lp.buy_side_shape.CalculateMargin(bid)
         offer_margin = lp.sell_side_shape.CalculateMargin(offer)
         print(
@@ -0,0 +1,256 @@
+'''
+Benchmarks of the mechanism hot paths on synthetic data, runnable offline.
+
+	python bench.py --output bench.json
+	python bench.py --baseline bench.json --tolerance 0.25
+
+Each benchmark is run at a range of data sizes and timed a few times per size, so the results show how its cost
+scales rather than a single number. Results can be saved as a JSON baseline and later runs compared against it; a
+benchmark slower than its baseline by more than the tolerance is reported as a regression and makes the command exit
+with status 1.
+'''
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(__file__))
+from prelude import *
+from mechanism import *
+from data.cache import *
+from data.exchanges import DataSource
+
+# name -> (setup, sizes); setup(size) returns the function to time
+BENCHMARKS = {}
+
+
+def benchmark(*sizes):
+	'''
+	Register a setup function as a benchmark run at each of sizes
+	'''
+	def register(setup):
+		BENCHMARKS[setup.__name__] = (setup, sizes)
+		return setup
+	return register
+
+
+def synthetic_market(steps, lps=4, num_ticks=10, tick_size=1e-2, period=7, seed=0):
+	'''
+	A market run for steps records on a random price and volume path, with lps LPs committing at the start, each
+	with an order shape on both sides
+	'''
+	rng = np.random.default_rng(seed)
+	price = 100 * np.exp(np.cumsum(rng.normal(0, 0.02, steps)))
+	volume = 1e6 * (1 + rng.random(steps))
+	m = Market(
+		name='bench',
+		mark_price=price[0],
+		tick_size=tick_size,
+		num_ticks=num_ticks,
+		liquidity=Liquidity(v=10, k=1, stake_target_period=period, valuation_period=period),
+		traded_volume=volume[0],
+		open_interest=0.25*volume[0],
+		risk_model=RiskModel(mu=0.0, sigma=2.0, tau=1.0/60/24/365.25, lambd=0.001))
+	for i in range(lps):
+		m.commit(f'LP{i}', stake=float(rng.integers(1, 100) * 1000), fee_bid=float(rng.integers(1, 50)) / 1e4,
+				 sell_side_shape=_shape(m, True, num_ticks, rng), buy_side_shape=_shape(m, False, num_ticks, rng))
+	for i in range(1, steps):
+		m = m.next(traded_volume=volume[i], open_interest=0.25*volume[i], mark_price=price[i])
+	return m
+
+
+def synthetic_candles(n, seed=0):
+	rng = np.random.default_rng(seed)
+	close = 100 * np.exp(np.cumsum(rng.normal(0, 0.02, n)))
+	return [{'startTime': f'{i}', 'time': 86400000.0 * i, 'open': float(c), 'high': float(c), 'low': float(c),
+			 'close': float(c), 'volume': float(v)} for (i, (c, v)) in enumerate(zip(close, 1e6 * rng.random(n)))]
+
+
+def _shape(m, is_sell_side, num_ticks, rng):
+	return OrderSetForSide(
+		market=m, is_sell_side=is_sell_side, limit_orders=np.zeros(num_ticks),
+		liquidity_fractions=rng.random(num_ticks) + 0.01)
+
+
+@benchmark(1_000, 10_000, 100_000)
+def market_next(steps):
+	# stepping a market with a few LPs forward, from its first record
+	return lambda: synthetic_market(steps)
+
+
+@benchmark(100, 1_000, 10_000)
+def to_data_frame(records):
+	m = synthetic_market(records)
+	return lambda: m.to_data_frame()
+
+
+@benchmark(10, 100, 1_000, 10_000)
+def lp_margin(num_ticks):
+	# the book spans the same prices at every depth
+	m = synthetic_market(1, lps=1, num_ticks=num_ticks, tick_size=0.1 / num_ticks)
+	lp = m.lp('LP0')
+
+	def run():
+		ladder_cache_clear()
+		m._cache.clear()
+		return lp.margin
+	return run
+
+
+@benchmark(10, 100, 1_000, 10_000)
+def fee_rate(lps):
+	m = Market(name='bench', traded_volume=1e6, open_interest=1e5)
+	rng = np.random.default_rng(0)
+	for i in range(lps):
+		m.commit(f'LP{i}', stake=float(rng.integers(1, 100) * 1000), fee_bid=float(rng.integers(1, 50)) / 1e4)
+
+	def run():
+		# rebuild the fee index from scratch, as for a record read back from the history
+		m._fees = None
+		m._cache.clear()
+		return m.fee_rate
+	return run
+
+
+@benchmark(10, 100, 1_000, 10_000)
+def valuation_and_target_stake(period):
+	m = synthetic_market(2 * period, lps=1, period=period)
+
+	def run():
+		# the window statistics for the whole history, from cold
+		m._history.rolling.reset(0)
+		m._cache.clear()
+		return (m.valuation, m.target_stake)
+	return run
+
+
+@benchmark(1_000, 10_000, 100_000)
+def json_cache_load(candles):
+	return _cache_load(JsonFileCache, candles)
+
+
+@benchmark(1_000, 10_000, 100_000)
+def columnar_cache_load(candles):
+	return _cache_load(ColumnarCache, candles)
+
+
+def _cache_load(cache_type, candles):
+	directory = tempfile.mkdtemp(prefix='bench-')
+	cache = cache_type(directory)
+	cache.put('candles.json', {'success': True, 'result': synthetic_candles(candles)})
+	run = lambda: DataSource(cache=cache).get_cached_json(url=None, cache_file='candles.json')
+	run.cleanup = lambda: shutil.rmtree(directory, ignore_errors=True)
+	return run
+
+
+def measure(fn, repeat=5, budget=10.0):
+	'''
+	Time fn repeat times, or as many as fit in budget seconds (at least once), and summarise the timings in seconds.
+	fn is called once first, untimed, to fill caches and finish imports.
+	'''
+	fn()
+	times = []
+	start = time.perf_counter()
+	while len(times) < repeat and (not times or time.perf_counter() - start < budget):
+		t = time.perf_counter()
+		fn()
+		times.append(time.perf_counter() - t)
+	return {'min': min(times), 'median': float(np.median(times)), 'runs': len(times)}
+
+
+def run(pattern=None, repeat=5, budget=10.0, max_size=None, output=print):
+	'''
+	Run the benchmarks whose name matches pattern at each of their sizes up to max_size. Returns the results as a
+	dict of benchmark name to size (as a string, as in JSON) to timings.
+	'''
+	results = {}
+	for (name, (setup, sizes)) in BENCHMARKS.items():
+		if pattern is not None and not re.search(pattern, name):
+			continue
+		results[name] = {}
+		for size in sizes:
+			if max_size is not None and size > max_size:
+				continue
+			fn = setup(size)
+			try:
+				results[name][str(size)] = measure(fn, repeat, budget)
+			finally:
+				getattr(fn, 'cleanup', lambda: None)()
+			output(f"{name:<28} {size:>8} {results[name][str(size)]['median'] * 1e3:>12.3f} ms")
+		output(f"{name:<28} {'scaling':>8} {'O(n^%.2f)' % scaling(results[name]):>15}")
+	return results
+
+
+def scaling(timings):
+	'''
+	The exponent of a power law fitted to median time against size, e.g. 1 for linear
+	'''
+	if len(timings) < 2:
+		return float('nan')
+	sizes = np.log([float(size) for size in timings])
+	times = np.log([max(t['median'], 1e-9) for t in timings.values()])
+	return float(np.polyfit(sizes, times, 1)[0])
+
+
+def compare(results, baseline, tolerance=0.25, output=print):
+	'''
+	Compare results with a baseline from an earlier run and return the (name, size, ratio) of every benchmark slower
+	than the baseline by more than tolerance
+	'''
+	regressions = []
+	for (name, timings) in results.items():
+		for (size, t) in timings.items():
+			base = baseline.get(name, {}).get(size)
+			if base is None:
+				continue
+			ratio = t['median'] / base['median']
+			flag = 'REGRESSION' if ratio > 1 + tolerance else ('faster' if ratio < 1 - tolerance else '')
+			output(f'{name:<28} {size:>8} {ratio:>8.2f}x {flag}')
+			if ratio > 1 + tolerance:
+				regressions.append((name, size, ratio))
+	return regressions
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Benchmark the mechanism hot paths on synthetic data.')
+	parser.add_argument('--only', default=None, help='regular expression selecting benchmarks by name')
+	parser.add_argument('--repeat', type=int, default=5, help='timings per benchmark and size')
+	parser.add_argument('--budget', type=float, default=10.0, help='seconds to stop repeating a benchmark after')
+	parser.add_argument('--max-size', type=int, default=None, help='skip sizes larger than this, for a quick run')
+	parser.add_argument('--output', default=None, help='JSON file to save the results to, e.g. as a new baseline')
+	parser.add_argument('--baseline', default=None, help='JSON file of earlier results to compare against')
+	parser.add_argument('--tolerance', type=float, default=0.25, help='slowdown reported as a regression, 0.25 = 25%%')
+	parser.add_argument('--list', action='store_true', help='list the benchmarks and their sizes')
+	args = parser.parse_args(argv)
+
+	if args.list:
+		for (name, (_, sizes)) in BENCHMARKS.items():
+			print(name, *sizes)
+		return
+
+	results = run(args.only, args.repeat, args.budget, args.max_size)
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump({
+				'python': platform.python_version(),
+				'numpy': np.__version__,
+				'machine': platform.platform(),
+				'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+				'results': results,
+			}, f, indent=1)
+	if args.baseline:
+		with open(args.baseline, 'r') as f:
+			baseline = json.load(f)['results']
+		if compare(results, baseline, args.tolerance):
+			sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,285 @@
+import gzip
+import json
+import os
+import re
+import tempfile
+import time
+from abc import ABCMeta, abstractmethod
+
+import numpy as np
+
+from prelude import *
+
+
+class CacheType(DataType, ABCMeta):
+	'''
+	Data records that can have abstract methods
+	'''
+
+
+class Cache(Data, metaclass=CacheType):
+	'''
+	Where DataSource keeps downloaded responses, by key. get returns None for a miss. A backend must implement get
+	and put; one that doesn't can't be created.
+	'''
+
+	@abstractmethod
+	def get(self, key):
+		raise NotImplementedError
+
+	@abstractmethod
+	def put(self, key, data):
+		raise NotImplementedError
+
+	def append(self, key, records, on):
+		'''
+		Add records to the list of records under key, replacing any with the same value of on, and keep the list
+		sorted by on
+		'''
+		self.put(key, _merge(self.get(key) or [], records, on))
+
+	def last(self, key, on):
+		'''
+		The largest value of on in the list of records under key, or None if there is none
+		'''
+		records = self.get(key)
+		return max((r[on] for r in records), default=None) if records else None
+
+
+class JsonFileCache(Cache):
+	'''
+	One plain JSON file per key in directory, the original cache layout
+	'''
+	directory: str
+
+	def get(self, key):
+		path = os.path.join(self.directory, key)
+		if not os.path.isfile(path):
+			return None
+		try:
+			with open(path, 'r') as f:
+				return json.load(f)
+		except ValueError:
+			return None  # not valid JSON, e.g. written by an older version that crashed mid-write
+
+	def put(self, key, data):
+		_write_atomic(os.path.join(self.directory, key), lambda f: f.write(json.dumps(data).encode()))
+
+
+class ColumnarCache(Cache):
+	'''
+	One compressed file per key in directory, with an index of what is stored, when and how big it is.
+
+	Lists of records with the same keys (candles, markets), bare or under 'result' in an API response, are stored
+	column-wise in an NPZ file, which loads far faster than parsing the equivalent JSON. Anything else is stored as
+	gzipped JSON. Entries older than ttl seconds are treated as missing, and once the files add up to more than
+	max_bytes the least recently used entries are evicted. Every file, including the index, is written to a temporary
+	file and renamed into place, so a crash never leaves a half-written entry behind.
+	'''
+	directory: str
+	ttl: Optional[float] = None
+	max_bytes: Optional[int] = None
+	_index: Dict[str, dict] = field(default=None, init=False, repr=False)
+
+	INDEX = 'index.json'
+	# files an appended entry is split over before they are merged back into one
+	SEGMENTS = 16
+
+	def __post_init__(self):
+		os.makedirs(self.directory, exist_ok=True)
+		path = os.path.join(self.directory, self.INDEX)
+		try:
+			with open(path, 'r') as f:
+				self._index = json.load(f)
+		except (OSError, ValueError):
+			self._index = {}
+
+	def get(self, key):
+		paths = self._paths(key)
+		if paths is None:
+			return None
+		if paths[0].endswith('.npz'):
+			(envelope, columns) = self._load_columns(key, paths)
+			names = list(columns)
+			records = [dict(zip(names, values)) for values in zip(*(columns[n].tolist() for n in names))]
+			if envelope is None:
+				return records
+			envelope['result'] = records
+			return envelope
+		with gzip.open(paths[0], 'rt') as f:
+			return json.load(f)
+
+	def get_columns(self, key):
+		'''
+		The records of a column-wise entry as a dict of column name to array, without building a dict per record, or
+		None if the entry is missing, expired or not column-wise
+		'''
+		paths = self._paths(key)
+		if paths is None or not paths[0].endswith('.npz'):
+			return None
+		return self._load_columns(key, paths)[1]
+
+	def append(self, key, records, on):
+		'''
+		As Cache.append, but a column-wise list only has the new records written, to a segment file of their own;
+		duplicates are dropped as it is read back, and the segments are merged into one file once there are SEGMENTS
+		of them.
+		'''
+		entry = self._index.get(key)
+		columns = _columns(records)
+		if entry is None or columns is None or entry.get('on') != on or not entry['file'].endswith('.npz') \
+				or len(entry.get('segments', ())) + 1 >= self.SEGMENTS or self._paths(key) is None \
+				or columns[1] != self._names(entry):
+			merged = _merge(self.get(key) or [], records, on)
+			self.put(key, merged)
+			entry = self._index.get(key)
+			if merged and entry is not None and entry['file'].endswith('.npz'):
+				entry.update(on=on, last=merged[-1][on])
+				self._save_index()
+			return
+
+		(_, names, arrays) = columns
+		file = f"{entry['file'][:-len('.npz')]}.{len(entry.get('segments', ())) + 1}.npz"
+		self._savez(file, None, names, arrays)
+		entry.setdefault('segments', []).append(file)
+		entry['bytes'] += os.path.getsize(os.path.join(self.directory, file))
+		entry['stored'] = entry['used'] = time.time()
+		entry['last'] = max(entry['last'], arrays[names.index(on)].max().item())
+		self._evict()
+		self._save_index()
+
+	def last(self, key, on):
+		entry = self._index.get(key)
+		if entry is not None and entry.get('on') == on and self._paths(key) is not None:
+			return entry['last']
+		return super().last(key, on)
+
+	def _paths(self, key):
+		# the files of a live entry, marked as used, or None, dropping the entry if it has expired or gone missing
+		entry = self._index.get(key)
+		if entry is None:
+			return None
+		paths = [os.path.join(self.directory, file) for file in [entry['file'], *entry.get('segments', ())]]
+		if (self.ttl is not None and time.time() - entry['stored'] > self.ttl) or not all(map(os.path.isfile, paths)):
+			self._remove(key)
+			self._save_index()
+			return None
+		entry['used'] = time.time()
+		return paths
+
+	def _load_columns(self, key, paths):
+		envelope = None
+		parts = []
+		for path in paths:
+			with np.load(path, allow_pickle=False) as npz:
+				if envelope is None:
+					envelope = json.loads(str(npz['__envelope__']))
+				names = json.loads(str(npz['__columns__']))
+				parts.append({name: npz[name] for name in names})
+		if len(parts) == 1:
+			return (envelope, parts[0])
+		columns = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+		# the last copy of each record wins, as with Cache.append
+		on = columns[self._index[key]['on']]
+		(_, first) = np.unique(on[::-1], return_index=True)
+		keep = len(on) - 1 - first
+		return (envelope, {name: values[keep] for (name, values) in columns.items()})
+
+	def _names(self, entry):
+		with np.load(os.path.join(self.directory, entry['file']), allow_pickle=False) as npz:
+			return json.loads(str(npz['__columns__']))
+
+	def _savez(self, file, envelope, names, arrays):
+		_write_atomic(os.path.join(self.directory, file), lambda f: np.savez_compressed(
+			f, __envelope__=np.array(json.dumps(envelope)), __columns__=np.array(json.dumps(names)),
+			**{n: a for (n, a) in zip(names, arrays)}))
+
+	def put(self, key, data):
+		columns = _columns(data)
+		name = re.sub(r'[^\w.-]', '_', key)
+		if columns is not None:
+			(envelope, names, arrays) = columns
+			file = name + '.npz'
+			self._savez(file, envelope, names, arrays)
+		else:
+			file = name + '.json.gz'
+			_write_atomic(os.path.join(self.directory, file), lambda f: f.write(gzip.compress(json.dumps(data).encode())))
+
+		old = self._index.get(key)
+		if old is not None and (old['file'] != file or old.get('segments')):
+			self._remove(key, keep=file)
+		now = time.time()
+		self._index[key] = {'file': file, 'bytes': os.path.getsize(os.path.join(self.directory, file)), 'stored': now, 'used': now}
+		self._evict()
+		self._save_index()
+
+	def _evict(self):
+		if self.max_bytes is None:
+			return
+		total = sum(e['bytes'] for e in self._index.values())
+		for key in sorted(self._index, key=lambda k: self._index[k]['used']):
+			if total <= self.max_bytes:
+				break
+			total -= self._index[key]['bytes']
+			self._remove(key)
+
+	def _remove(self, key, keep=None):
+		entry = self._index.pop(key)
+		for file in [entry['file'], *entry.get('segments', ())]:
+			if file == keep:
+				continue
+			try:
+				os.remove(os.path.join(self.directory, file))
+			except OSError:
+				pass
+
+	def _save_index(self):
+		_write_atomic(os.path.join(self.directory, self.INDEX), lambda f: f.write(json.dumps(self._index).encode()))
+
+
+def _columns(data):
+	'''
+	Split data into (envelope, column names, column arrays) if it is a list of flat records with the same keys, else
+	None
+	'''
+	envelope = None
+	records = data
+	if isinstance(data, dict) and isinstance(data.get('result'), list):
+		envelope = {k: v for (k, v) in data.items() if k != 'result'}
+		records = data['result']
+	if not isinstance(records, list) or not records or not all(isinstance(r, dict) for r in records):
+		return None
+	names = list(records[0])
+	if any(list(r) != names for r in records):
+		return None
+	arrays = []
+	for name in names:
+		values = [r[name] for r in records]
+		kinds = {type(v) for v in values}
+		if kinds <= {bool} or kinds <= {int} or kinds <= {int, float} or kinds <= {str}:
+			arrays.append(np.array(values))
+		else:
+			return None  # None, nested or mixed values don't survive a round trip through an array
+	return (envelope, names, arrays)
+
+
+def _merge(old, new, on):
+	'''
+	The records of old and new sorted by on, a record of new replacing one of old with the same value of on
+	'''
+	return sorted({r[on]: r for r in [*old, *new]}.values(), key=lambda r: r[on])
+
+
+def _write_atomic(path, write):
+	'''
+	Write a file via a temporary file in the same directory and an atomic rename
+	'''
+	directory = os.path.dirname(path) or '.'
+	(fd, tmp) = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			write(f)
+		os.replace(tmp, path)
+	except BaseException:
+		os.remove(tmp)
+		raise
@@ -1,42 +1,214 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
-import json
-import os
+from requests.adapters import HTTPAdapter
 
 from prelude import *
+from .cache import *
 
 
 class DataSource(Data):
 	cache_dir: Optional[str] = None
+	# where responses are cached, plain JSON files in cache_dir unless another backend is given
+	cache: Optional[Cache] = None
+	# requests in flight at once, also the size of the connection pool
+	max_workers: int = 8
+	# attempts after the first for a request that fails, is rate limited (429) or hits a server error (5xx)
+	retries: int = 5
+	# seconds before the first retry, doubled for each one after, unless the server asks for longer with Retry-After
+	backoff: float = 0.5
+	timeout: float = 30
+	_session: requests.Session = field(default=None, init=False, repr=False, compare=False)
+
+	RETRY_STATUS = (429, 500, 502, 503, 504)
+
+	def __post_init__(self):
+		if self.cache is None and self.cache_dir is not None:
+			self.cache = JsonFileCache(self.cache_dir)
+		self._session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+		self._session.mount('http://', adapter)
+		self._session.mount('https://', adapter)
 
-	def get_cached_json(self, url, cache_file=None, force=False):
-		cache_path = self.cache_dir and cache_file and os.path.join(self.cache_dir, cache_file)
-		
-		# Load from cache file
-		if cache_path != None and (not force) and os.path.isfile(cache_path):
+	def get_json(self, url, params=None):
+		'''
+		GET url over the pooled session and decode the JSON response, retrying with exponential backoff (and jitter)
+		on connection errors, rate limiting and server errors
+		'''
+		for attempt in range(self.retries + 1):
 			try:
-				with open(cache_path, 'r') as f: 
-					return json.load(f)
-			except:
-				pass  # this except clause is in case the file doesn't contain valid JSON
+				response = self._session.get(url, params=params, timeout=self.timeout)
+			except (requests.ConnectionError, requests.Timeout):
+				if attempt == self.retries:
+					raise
+				time.sleep(self._delay(attempt))
+				continue
+			if response.status_code not in self.RETRY_STATUS or attempt == self.retries:
+				response.raise_for_status()
+				return response.json()
+			time.sleep(self._delay(attempt, response.headers.get('Retry-After')))
+
+	def get_cached_json(self, url, cache_file=None, force=False, params=None):
+		cache = self.cache if cache_file else None
+
+		# Load from cache
+		if cache != None and not force:
+			data = cache.get(cache_file)
+			if data is not None:
+				return data
 
 		# Download afresh
-		data = requests.get(url).json()
-		if cache_path != None: 
-			with open(cache_path, 'w') as f: 
-				json.dump(data, f)
+		data = self.get_json(url, params)
+		if cache != None:
+			cache.put(cache_file, data)
 		return data
 
+	def map(self, fn, items):
+		'''
+		fn applied to each of items on up to max_workers threads, in the order of items
+		'''
+		items = list(items)
+		if len(items) <= 1 or self.max_workers <= 1:
+			return [fn(item) for item in items]
+		with ThreadPoolExecutor(max_workers=min(self.max_workers, len(items))) as pool:
+			return list(pool.map(fn, items))
+
+	def _delay(self, attempt, retry_after=None):
+		delay = self.backoff * 2 ** attempt * (1 + random.random())
+		try:
+			return max(delay, float(retry_after))
+		except (TypeError, ValueError):
+			return delay  # no Retry-After, or an HTTP date rather than seconds
+
 
 class FTX(DataSource):
-	API = 'https://ftx.com/api/{}'.format
 	API_HISTORY = 'markets/{market}/candles?resolution={resolution}'.format
+	# candles the API returns per request at most
+	PAGE_SIZE = 1500
+	api: str = 'https://ftx.com/api'
 
 	def get_markets(self, force=False):
-		cache_file = f'FTX_{market_id}_markets.json'
-		url = FTX.API('markets')
+		cache_file = 'FTX_markets.json'
+		url = self._url('markets')
 		return self.get_cached_json(url=url, cache_file=cache_file, force=force)['result']
 
-	def get_history(self, market_id, resolution=86400, force=False):
-		cache_file = f'FTX_{market_id}_history_{resolution}.json'
-		url = FTX.API(FTX.API_HISTORY(market=market_id, resolution=resolution))
-		return self.get_cached_json(url=url, cache_file=cache_file, force=force)['result']
+	def get_history(self, market_id, resolution=86400, start_time=None, end_time=None, force=False):
+		'''
+		Candles for market_id at resolution seconds. With no start_time this is the latest page the API gives; with one,
+		the whole range up to end_time (default now) is fetched in pages, concurrently, and cached as one list.
+		'''
+		if start_time is None:
+			cache_file = f'FTX_{market_id}_history_{resolution}.json'
+			url = self._url(FTX.API_HISTORY(market=market_id, resolution=resolution))
+			return self.get_cached_json(url=url, cache_file=cache_file, force=force)['result']
+		return self.get_histories([market_id], resolution, start_time, end_time, force)[market_id]
+
+	def get_histories(self, market_ids, resolution=86400, start_time=0, end_time=None, force=False):
+		'''
+		Candles for each of market_ids from start_time to end_time (seconds since the epoch, end_time default now), as
+		a dict by market. The pages of every market are fetched together on one pool of max_workers threads. With no
+		end_time, a cache keeps one list of candles per market that each call tops up (see update_histories), rather
+		than a list per range: every call's range would end at a different now.
+		'''
+		start_time = int(start_time)
+		if end_time is None and self.cache is not None:
+			histories = self._update(market_ids, resolution, start_time, int(time.time()), force)
+			return {market_id: [c for c in candles if c['time'] >= start_time * 1000]
+					for (market_id, candles) in histories.items()}
+
+		end_time = int(time.time()) if end_time is None else int(end_time)
+		cached = {}
+		if self.cache is not None and not force:
+			for market_id in market_ids:
+				data = self.cache.get(self._range_file(market_id, resolution, start_time, end_time))
+				if data is not None:
+					cached[market_id] = data['result']
+
+		histories = self._fetch(resolution, [(m, start_time, end_time) for m in market_ids if m not in cached])
+		if self.cache is not None:
+			for (market_id, candles) in histories.items():
+				self.cache.put(self._range_file(market_id, resolution, start_time, end_time), {'result': candles})
+		return {market_id: cached[market_id] if market_id in cached else histories[market_id] for market_id in market_ids}
+
+	def update_history(self, market_id, resolution=86400, start_time=0, end_time=None):
+		'''
+		update_histories for one market
+		'''
+		return self.update_histories([market_id], resolution, start_time, end_time)[market_id]
+
+	def update_histories(self, market_ids, resolution=86400, start_time=0, end_time=None):
+		'''
+		Bring the cached candles of each of market_ids up to end_time (default now) and return them all, as a dict by
+		market. Only candles from the last cached one on are downloaded (that one again, as it may have been
+		incomplete when it was fetched) and appended to the cache; a market with nothing cached yet is fetched from
+		start_time, as are the candles before the cached ones if start_time is earlier than any update asked for yet.
+		'''
+		if self.cache is None:
+			raise ValueError('Updating history needs a cache to update.')
+		end_time = int(time.time()) if end_time is None else int(end_time)
+		return self._update(market_ids, resolution, int(start_time), end_time)
+
+	def _update(self, market_ids, resolution, start_time, end_time, force=False):
+		ranges = []
+		starts = {}
+		for market_id in market_ids:
+			last = None if force else self.cache.last(self._store_file(market_id, resolution), 'time')
+			stored = self.cache.get(self._start_file(market_id, resolution))
+			# where the cached candles were first fetched from, as a market may have none that early
+			covered = start_time if stored is None else stored['start_time']
+			if last is None:
+				ranges.append((market_id, start_time, end_time))
+			else:
+				ranges.append((market_id, int(last // 1000), end_time))  # time is in ms
+				if start_time < covered:
+					ranges.append((market_id, start_time, covered))
+			if stored is None or start_time < covered:
+				starts[market_id] = min(start_time, covered)
+
+		for (market_id, candles) in self._fetch(resolution, ranges).items():
+			if candles:
+				self.cache.append(self._store_file(market_id, resolution), candles, on='time')
+		for (market_id, start) in starts.items():
+			self.cache.put(self._start_file(market_id, resolution), {'start_time': start})
+		return {market_id: self.cache.get(self._store_file(market_id, resolution)) or [] for market_id in market_ids}
+
+	def _fetch(self, resolution, ranges):
+		'''
+		Download the candles in ranges, a list of (market, start_time, end_time), in pages on one pool of threads, as a
+		dict of market to its candles in order
+		'''
+		span = FTX.PAGE_SIZE * resolution
+		pages = [(market_id, start_time, end_time, page_start)
+				 for (market_id, start_time, end_time) in ranges
+				 for page_start in range(start_time, end_time + 1, span)]
+		results = self.map(
+			lambda page: self._get_page(resolution, page[0], page[3], min(page[3] + span - resolution, page[2])), pages)
+
+		histories = {market_id: {} for (market_id, _, _) in ranges}
+		for ((market_id, start_time, end_time, _), candles) in zip(pages, results):
+			for c in candles:
+				# in case the API returns a candle on either side of a page edge, or outside the range altogether
+				if start_time * 1000 <= c['time'] <= end_time * 1000:
+					histories[market_id][c['time']] = c
+		return {market_id: sorted(candles.values(), key=lambda c: c['time']) for (market_id, candles) in histories.items()}
+
+	def _get_page(self, resolution, market_id, start_time, end_time):
+		url = self._url(FTX.API_HISTORY(market=market_id, resolution=resolution))
+		return self.get_json(url, params={'start_time': start_time, 'end_time': end_time})['result']
+
+	def _url(self, path):
+		return f'{self.api}/{path}'
+
+	@staticmethod
+	def _store_file(market_id, resolution):
+		return f'FTX_{market_id}_candles_{resolution}.json'
+
+	@staticmethod
+	def _start_file(market_id, resolution):
+		return f'FTX_{market_id}_candles_{resolution}_start.json'
+
+	@staticmethod
+	def _range_file(market_id, resolution, start_time, end_time):
+		return f'FTX_{market_id}_history_{resolution}_{start_time}_{end_time}.json'
@@ -0,0 +1,134 @@
+import json
+import os
+
+from prelude import *
+
+# Candles read from a file at a time
+CHUNK_SIZE = 10_000
+
+# The notebooks' mapping from a candle to Market.next inputs; open interest is made up from volume (not realistic!)
+CANDLE_FIELDS = {
+	'traded_volume': 'volume',
+	'open_interest': lambda c: 0.25*c['volume'],
+	'mark_price': 'close',
+}
+
+
+def read_candles(path, chunk_size=CHUNK_SIZE):
+	'''
+	Yield candles one at a time as dicts from a JSON file cached by DataSource (a list, or an API response with the
+	list under 'result'), a CSV file or a Parquet file, reading at most about chunk_size candles at once.
+	'''
+	ext = os.path.splitext(path)[1].lower()
+	if ext == '.json':
+		with open(path, 'r') as f:
+			yield from _json_array(f, chunk_size)
+	elif ext == '.csv':
+		import pandas as pd
+		for chunk in pd.read_csv(path, chunksize=chunk_size):
+			yield from chunk.to_dict('records')
+	elif ext == '.parquet':
+		import pyarrow.parquet as pq
+		for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+			yield from batch.to_pylist()
+	else:
+		raise ValueError(f"Don't know how to read candles from '{path}'.")
+
+
+def market_inputs(candles, fields=CANDLE_FIELDS):
+	'''
+	Map candles to keyword arguments for Market.next. fields maps each argument to a candle key or a function of the
+	candle.
+	'''
+	for c in candles:
+		yield {arg: (c[src] if isinstance(src, str) else src(c)) for (arg, src) in fields.items()}
+
+
+def replay(m: 'Market', inputs, commitments=(), snapshot=None):
+	'''
+	Drive a market forward lazily, one step per item of inputs (see market_inputs), and yield each new record, or
+	snapshot(record) if given, e.g. to keep just a few fields.
+
+	commitments are the notebooks' (step, name, stake, fee_bid, sell_side_shape, buy_side_shape) entries, sorted by
+	step; each is added to the market before the step it is due at.
+	'''
+	from mechanism.liquidity_provider import LiquidityProvider
+
+	commitments = list(commitments)
+	for (i, kwargs) in enumerate(inputs):
+		while commitments and commitments[0][0] <= i:
+			(_, name, stake, fee_bid, sell_side_shape, buy_side_shape) = commitments.pop(0)
+			LiquidityProvider(market=m, name=name, stake=stake, fee_bid=fee_bid,
+							  sell_side_shape=sell_side_shape, buy_side_shape=buy_side_shape)
+		m = m.next(**kwargs)
+		yield m if snapshot is None else snapshot(m)
+
+
+def snapshot_of(*names):
+	'''
+	A snapshot function for replay that keeps the named fields of each record as a dict
+	'''
+	return lambda m: {name: getattr(m, name) for name in names}
+
+
+def _json_array(f, chunk_size):
+	'''
+	Decode the objects of a JSON list (top level, or under 'result') one at a time without reading the whole file
+	'''
+	decoder = json.JSONDecoder()
+	buf = ''
+	pos = 0
+	block = 64 * chunk_size  # characters, roughly chunk_size small candles
+
+	def fill():
+		nonlocal buf, pos
+		data = f.read(block)
+		buf = buf[pos:] + data
+		pos = 0
+		return bool(data)
+
+	def skip(chars):
+		nonlocal pos
+		while True:
+			while pos < len(buf) and buf[pos] in chars:
+				pos += 1
+			if pos < len(buf) or not fill():
+				return
+
+	def decode():
+		nonlocal pos
+		while True:
+			try:
+				(obj, end) = decoder.raw_decode(buf, pos)
+				# a number at the end of the buffer may go on in the next block
+				if end < len(buf) or not fill():
+					break
+			except ValueError:
+				if not fill():
+					raise
+		pos = end
+		return obj
+
+	fill()
+	skip(' \t\r\n')
+	if buf[pos:pos + 1] == '{':
+		# an API response: step over the top level keys and their values up to "result"
+		pos += 1
+		while True:
+			skip(' \t\r\n,')
+			if buf[pos:pos + 1] != '"':
+				raise ValueError('No "result" list in the cached response.')
+			key = decode()
+			skip(' \t\r\n:')
+			if key == 'result':
+				break
+			decode()
+	if buf[pos:pos + 1] != '[':
+		raise ValueError('Expected a JSON list of candles.')
+	pos += 1
+
+	while True:
+		skip(' \t\r\n,')
+		if buf[pos:pos + 1] == ']' or pos >= len(buf):
+			return
+		yield decode()
@@ -1,3 +1,4 @@
 from .liquidity import *
 from .market import *
-from .risk import *
\ No newline at end of file
+from .risk import *
+from .checkpoint import *
\ No newline at end of file
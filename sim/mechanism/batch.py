@@ -0,0 +1,292 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from prelude import *
+from .risk import *
+from .liquidity import *
+from .liquidity_provider import *
+from .market import *
+
+
+class Batch(Data):
+	'''
+	N independent markets advanced in lockstep, with every quantity held as an array over a leading scenario axis.
+
+	Each scenario follows the notebook loop for the object model: the market starts from its initial values, then
+	at each of T steps the commitments made at that step are added to the current record before it moves forward
+	with that step's traded volume, open interest and mark price (which, as in Market.next, carry over when 0). That
+	gives T + 1 records per scenario. Commitments are padded to a common count C; a slot with a negative commitment
+	step is empty. Each commitment is for one of L LPs (lp_index, by default each its own), and a later commitment of
+	an LP replaces its earlier one, as creating a LiquidityProvider of the same name does.
+	'''
+
+	traded_volume: np.ndarray  # (N, T)
+	open_interest: np.ndarray  # (N, T)
+	lp_stake: np.ndarray  # (N, C)
+	lp_fee_bid: np.ndarray  # (N, C)
+	lp_commit_step: np.ndarray  # (N, C), the step the commitment is made at, -1 for an empty slot
+	lp_index: Optional[np.ndarray] = None  # (N, C), the LP each commitment is for, default a different one each
+	# (N, C) OrderSetForSide or None, for the margins of each commitment, default None
+	lp_sell_side_shape: Optional[np.ndarray] = None
+	lp_buy_side_shape: Optional[np.ndarray] = None
+	mark_price: Optional[np.ndarray] = None  # (N, T), default the initial mark price throughout
+
+	# network parameters, scalars or one per scenario
+	v: Union[float, np.ndarray] = 5
+	k: Union[float, np.ndarray] = 1
+	stake_target_period: Union[int, np.ndarray] = 7
+	valuation_period: Union[int, np.ndarray] = 1
+	risk_model: Union[RiskModel, List[RiskModel]] = default_factory(RiskModel)
+
+	# initial market data, scalars or one per scenario
+	initial_traded_volume: Union[float, np.ndarray] = 0
+	initial_open_interest: Union[float, np.ndarray] = 0
+	initial_mark_price: Union[float, np.ndarray] = 0
+	tick_size: Union[float, np.ndarray] = 1
+
+	def __post_init__(self):
+		self.traded_volume = np.atleast_2d(np.asarray(self.traded_volume, dtype=float))
+		self.open_interest = np.atleast_2d(np.asarray(self.open_interest, dtype=float))
+		(n, steps) = self.traded_volume.shape
+		if self.open_interest.shape != (n, steps):
+			raise ValueError("traded_volume and open_interest must both be (scenarios, steps) arrays.")
+
+		self.lp_stake = np.atleast_2d(np.asarray(self.lp_stake, dtype=float))
+		self.lp_fee_bid = np.atleast_2d(np.asarray(self.lp_fee_bid, dtype=float))
+		self.lp_commit_step = np.atleast_2d(np.asarray(self.lp_commit_step, dtype=int))
+		if not (self.lp_stake.shape == self.lp_fee_bid.shape == self.lp_commit_step.shape) or self.lp_stake.shape[0] != n:
+			raise ValueError("lp_stake, lp_fee_bid and lp_commit_step must all be (scenarios, commitments) arrays.")
+		slots = self.lp_stake.shape
+		if self.lp_index is None:
+			self.lp_index = np.broadcast_to(np.arange(slots[1]), slots)
+		self.lp_index = np.atleast_2d(np.asarray(self.lp_index, dtype=int))
+		if self.lp_index.shape != slots or (self.lp_index < 0).any():
+			raise ValueError("lp_index must be a (scenarios, commitments) array of LP numbers from 0.")
+		for f in ('lp_sell_side_shape', 'lp_buy_side_shape'):
+			shapes = np.empty(slots, dtype=object)
+			if getattr(self, f) is not None:
+				shapes[...] = np.asarray(getattr(self, f), dtype=object)
+			setattr(self, f, shapes)
+		self.mark_price = np.zeros((n, steps)) if self.mark_price is None else \
+			np.atleast_2d(np.asarray(self.mark_price, dtype=float))
+		if self.mark_price.shape != (n, steps):
+			raise ValueError("mark_price must be a (scenarios, steps) array.")
+
+		self.v = np.broadcast_to(np.asarray(self.v, dtype=float), (n, ))
+		self.k = np.broadcast_to(np.asarray(self.k, dtype=float), (n, ))
+		self.stake_target_period = np.broadcast_to(np.asarray(self.stake_target_period, dtype=int), (n, ))
+		self.valuation_period = np.broadcast_to(np.asarray(self.valuation_period, dtype=int), (n, ))
+		if (self.stake_target_period < 1).any() or (self.valuation_period < 1).any():
+			raise ValueError("stake_target_period and valuation_period must be at least 1.")
+		self.initial_traded_volume = np.broadcast_to(np.asarray(self.initial_traded_volume, dtype=float), (n, ))
+		self.initial_open_interest = np.broadcast_to(np.asarray(self.initial_open_interest, dtype=float), (n, ))
+		self.initial_mark_price = np.broadcast_to(np.asarray(self.initial_mark_price, dtype=float), (n, ))
+		self.tick_size = np.broadcast_to(np.asarray(self.tick_size, dtype=float), (n, ))
+		if isinstance(self.risk_model, RiskModel):
+			self.risk_model = [self.risk_model] * n
+		if len(self.risk_model) != n:
+			raise ValueError("risk_model must be a RiskModel or one per scenario.")
+
+	@property
+	def num_scenarios(self):
+		return self.traded_volume.shape[0]
+
+	@property
+	def num_steps(self):
+		return self.traded_volume.shape[1]
+
+	@property
+	def num_lps(self):
+		return int(self.lp_index.max()) + 1 if self.lp_index.size else 0
+
+	def run(self):
+		'''
+		Run every scenario. Returns a dict of arrays: market quantities are (N, T + 1), one value per record, and
+		LP quantities, prefixed 'lp_', are (N, T + 1, L), NaN where the LP has no commitment.
+		'''
+		traded_volume = _carry_forward(self.initial_traded_volume, self.traded_volume)
+		open_interest = _carry_forward(self.initial_open_interest, self.open_interest)
+		mark_price = _carry_forward(self.initial_mark_price, self.mark_price)
+		(n, records) = traded_volume.shape
+		steps = np.arange(records)
+
+		# SUM of traded volume over the valuation period, scaled up while the window is still short
+		period = self.valuation_period[:, None]
+		cumulative = np.concatenate([np.zeros((n, 1)), np.cumsum(traded_volume, axis=1)], axis=1)
+		window_start = np.maximum(0, steps[None, :] - period + 1)
+		window_volume = cumulative[:, 1:] - np.take_along_axis(cumulative, window_start, axis=1)
+		scaled_volume = period / (steps[None, :] + 1 - window_start) * window_volume
+
+		# MAX of open interest over the stake target period
+		max_oi = np.empty_like(open_interest)
+		for p in np.unique(self.stake_target_period):
+			rows = self.stake_target_period == p
+			padded = np.concatenate([np.full((rows.sum(), p - 1), -np.inf), open_interest[rows]], axis=1)
+			max_oi[rows] = sliding_window_view(padded, p, axis=1).max(axis=-1)
+		risk_factor = np.array([rm.RiskFactorShort() for rm in self.risk_model])
+		target_stake = max_oi * self.v[:, None] * risk_factor[:, None]
+
+		# commitments are made on the record of their step, in (step, slot) order as the notebooks sort them, and
+		# stay in place until a later commitment of the same LP replaces them
+		commit = self.lp_commit_step
+		slots = commit.shape[1]
+		committed = (commit >= 0) & (commit < self.num_steps)
+		order = np.lexsort((np.broadcast_to(np.arange(slots), commit.shape), np.where(committed, commit, records)))
+		rank = np.argsort(order, axis=1)
+		same_lp = committed[:, None, :] & (self.lp_index[:, :, None] == self.lp_index[:, None, :])
+		later = same_lp & (rank[:, None, :] > rank[:, :, None])
+		replaced_at = np.where(later, commit[:, None, :], records).min(axis=2)
+		replaced_by = np.where(later, rank[:, None, :], slots).min(axis=2)
+		# an LP keeps its place among equal fee bids from its first commitment, as FeeIndex keeps it
+		joined = np.where(same_lp, rank[:, None, :], slots).min(axis=2)
+		present = committed[:, None, :] & (commit[:, None, :] <= steps[None, :, None]) & \
+				  (steps[None, :, None] < replaced_at[:, None, :])
+		stake = np.where(present, self.lp_stake[:, None, :], 0.0)
+		total_stake = stake.sum(axis=2)
+		valuation = np.maximum(scaled_volume, total_stake)
+
+		# entry valuation: the valuation of the commit record with only the commitments before this one that are still
+		# in place (an LP's earlier commitment is, until this one replaces it)
+		before = committed[:, None, :] & (rank[:, None, :] < rank[:, :, None]) & \
+				 (replaced_by[:, None, :] >= rank[:, :, None])
+		stake_before = (before * self.lp_stake[:, None, :]).sum(axis=2)
+		commit_record = np.clip(commit, 0, records - 1)
+		entry_valuation = np.maximum(np.take_along_axis(scaled_volume, commit_record, axis=1), stake_before)
+		entry_valuation = np.where(committed, entry_valuation, np.nan)
+
+		with np.errstate(divide='ignore', invalid='ignore'):
+			equity = np.where(present, valuation[:, :, None] / entry_valuation[:, None, :] * self.lp_stake[:, None, :], 0.0)
+			total_equity = equity.sum(axis=2)
+			equity_share = np.where(total_equity[:, :, None] > 0, equity / total_equity[:, :, None], 0.0)
+			stake_share = np.where(total_stake[:, :, None] > 0, stake / total_stake[:, :, None], 0.0)
+
+		fee_rate = self._fee_rate(present, target_stake, joined)
+		fees_collected = traded_volume * fee_rate
+		fee_revenue = fees_collected[:, :, None] * equity_share
+		obligation = stake * self.k[:, None, None]
+		margin = self._margins(present, mark_price, obligation)
+		total_margin = margin.sum(axis=2)
+		cost_base = target_stake + total_margin
+		with np.errstate(divide='ignore', invalid='ignore'):
+			annualised_return = np.where(total_stake > 0, 365 * fees_collected / total_stake, 0.0)
+			annualised_return_on_capital = np.where(cost_base > 0, 365 * fees_collected / cost_base, 0.0)
+			lp_annualised_return = 365 * fee_revenue / self.lp_stake[:, None, :]
+
+		# each LP's values are those of its commitment in place at the record
+		scenarios = np.arange(n)
+		own = self.num_lps == slots and (self.lp_index == np.arange(slots)).all()
+
+		def lp(values):
+			values = np.broadcast_to(values, present.shape)
+			if own:
+				return np.where(present, values, np.nan)
+			by_lp = np.full((n, records, self.num_lps), np.nan)
+			for slot in range(slots):
+				lps = self.lp_index[:, slot]
+				by_lp[scenarios, :, lps] = np.where(present[:, :, slot], values[:, :, slot], by_lp[scenarios, :, lps])
+			return by_lp
+
+		return {
+			'_n': np.broadcast_to(steps, (n, records)),
+			'traded_volume': traded_volume,
+			'open_interest': open_interest,
+			'mark_price': mark_price,
+			'valuation': valuation,
+			'target_stake': target_stake,
+			'total_stake': total_stake,
+			'total_equity': total_equity,
+			'total_margin': total_margin,
+			'fee_rate': fee_rate,
+			'fees_collected': fees_collected,
+			'annualised_return': annualised_return,
+			'annualised_return_on_capital': annualised_return_on_capital,
+			'lp_stake': lp(stake),
+			'lp_fee_bid': lp(self.lp_fee_bid[:, None, :]),
+			'lp_entry_valuation': lp(entry_valuation[:, None, :]),
+			'lp_obligation': lp(obligation),
+			'lp_margin': lp(margin),
+			'lp_equity': lp(equity),
+			'lp_equity_share': lp(equity_share),
+			'lp_stake_share': lp(stake_share),
+			'lp_fee_revenue': lp(fee_revenue),
+			'lp_annualised_return': lp(lp_annualised_return),
+		}
+
+	def _fee_rate(self, present, target_stake, joined):
+		'''
+		Market.fee_rate for every record: walk the commitments in place in fee bid order (ties in the order their LPs
+		first committed) until the cumulative stake covers the target stake
+		'''
+		by_bid = np.lexsort((joined, self.lp_fee_bid))
+		bids = np.take_along_axis(self.lp_fee_bid, by_bid, axis=1)[:, None, :]
+		present = np.take_along_axis(present, by_bid[:, None, :], axis=2)
+		covered = np.cumsum(np.where(present, np.take_along_axis(self.lp_stake, by_bid, axis=1)[:, None, :], 0.0), axis=2)
+		met = present & (covered >= target_stake[:, :, None])
+		first_met = np.argmax(met, axis=2)
+		last_present = present.shape[2] - 1 - np.argmax(present[:, :, ::-1], axis=2)
+		bids = np.broadcast_to(bids, present.shape)
+		return np.where(
+			met.any(axis=2),
+			np.take_along_axis(bids, first_met[:, :, None], axis=2)[:, :, 0],
+			np.where(present.any(axis=2), np.take_along_axis(bids, last_present[:, :, None], axis=2)[:, :, 0], 0.0))
+
+	def _margins(self, present, mark_price, obligation):
+		'''
+		LiquidityProvider.margin of each commitment in place at every record, 0 without an order shape. The records of
+		a scenario with the same shaped commitments in place are solved together (see record_margins).
+		'''
+		margin = np.zeros(present.shape)
+		shaped = np.array([[sell is not None or buy is not None for (sell, buy) in zip(*rows)]
+						   for rows in zip(self.lp_sell_side_shape, self.lp_buy_side_shape)], dtype=bool)
+		for i in np.flatnonzero(shaped.any(axis=1)):
+			in_place = present[i] & shaped[i]
+			(groups, inverse) = np.unique(in_place, axis=0, return_inverse=True)
+			inverse = inverse.reshape(-1)
+			for (group, slots) in enumerate(groups):
+				slots = np.flatnonzero(slots)
+				if not len(slots):
+					continue
+				rows = np.flatnonzero(inverse == group)
+				margin[i][np.ix_(rows, slots)] = record_margins(
+					mark_price[i, rows], np.full(len(rows), self.tick_size[i]), obligation[i][np.ix_(rows, slots)],
+					[(self.lp_sell_side_shape[i, slot], self.lp_buy_side_shape[i, slot]) for slot in slots],
+					self.risk_model[i])
+		return margin
+
+	def to_market(self, i, name='batch'):
+		'''
+		Run scenario i through the object model, e.g. to check the batch results against it
+		'''
+		m = Market(
+			name=name,
+			liquidity=Liquidity(
+				v=self.v[i], k=self.k[i],
+				stake_target_period=int(self.stake_target_period[i]), valuation_period=int(self.valuation_period[i])),
+			risk_model=self.risk_model[i],
+			traded_volume=self.initial_traded_volume[i],
+			open_interest=self.initial_open_interest[i],
+			mark_price=self.initial_mark_price[i],
+			tick_size=self.tick_size[i])
+		commitments = sorted(
+			[(step, slot) for (slot, step) in enumerate(self.lp_commit_step[i]) if 0 <= step < self.num_steps])
+		for step in range(self.num_steps):
+			while commitments and commitments[0][0] <= step:
+				(_, slot) = commitments.pop(0)
+				LiquidityProvider(
+					market=m, name=f'LP{self.lp_index[i, slot]}', stake=self.lp_stake[i, slot],
+					fee_bid=self.lp_fee_bid[i, slot], sell_side_shape=self.lp_sell_side_shape[i, slot],
+					buy_side_shape=self.lp_buy_side_shape[i, slot])
+			m = m.next(
+				traded_volume=self.traded_volume[i, step], open_interest=self.open_interest[i, step],
+				mark_price=self.mark_price[i, step])
+		return m
+
+
+def _carry_forward(initial, values):
+	'''
+	Prepend the initial values and, as Market.next does, carry the previous value forward over zeros
+	'''
+	records = np.concatenate([initial[:, None], values], axis=1)
+	filled = np.where(records != 0, np.arange(records.shape[1])[None, :], 0)
+	np.maximum.accumulate(filled, axis=1, out=filled)
+	return np.take_along_axis(records, filled, axis=1)
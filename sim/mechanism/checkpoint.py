@@ -0,0 +1,363 @@
+import contextlib
+import heapq
+import json
+import os
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from dataclasses import fields
+
+from prelude import *
+from .risk import RiskModel
+from .liquidity import Liquidity
+from .liquidity_provider import LiquidityProvider, OrderSetForSide
+from .history import History, RollingWindows, SPILL_ROWS, _drop_pages
+from .events import Event
+from .market import Market
+
+# Bumped whenever the checkpoint layout changes; restore refuses files of any other version
+CHECKPOINT_VERSION = 2
+# Prefixes of the arrays with a row per record, which are written in segments of rows
+ROWS = ('column_', 'object_', 'lp_')
+
+
+def save(m: Market, path, compress=False):
+	'''
+	Write a checkpoint of m's market to path: the whole history (every record's market data, LP commitments and entry
+	valuations), the Liquidity and RiskModel parameters, order shapes and the pending and applied events. See restore.
+	'''
+	_write(path, *snapshot(m), compress)
+
+
+def restore(path, spill_dir=None) -> Market:
+	'''
+	Read a checkpoint written by save or a Checkpointer and return the latest record of its market, ready to continue
+	with Market.next. With spill_dir, the history is restored spilled to that directory (see History.spill_to): the
+	columns are copied from the checkpoint straight into their files, SPILL_ROWS at a time, so it never has to fit in
+	memory.
+	'''
+	with zipfile.ZipFile(path) as archive:
+		meta = json.loads(_read_array(archive, 'meta').tobytes().decode())
+		if meta['version'] != CHECKPOINT_VERSION:
+			raise ValueError(f"Checkpoint {path} is version {meta['version']}, expected {CHECKPOINT_VERSION}.")
+		arrays = {name[:-len('.npy')]: _read_array(archive, name[:-len('.npy')]) for name in archive.namelist()
+				  if name.startswith('shape_')}
+
+		n = meta['len']
+		cols = len(meta['lp_names'])
+		history = History()
+		if spill_dir is not None:
+			os.makedirs(spill_dir, exist_ok=True)
+			history._directory = spill_dir
+		history._len = history._rows = n
+		history._cols = cols
+		segments = [(start, stop, archive if file is None else os.path.join(os.path.dirname(path), file))
+					for (start, stop, file) in meta['segments']]
+		for (prefix, store, shape, fill) in (('column', history._columns, (n, ), 0),
+											 ('object', history._object_ids, (n, ), 0),
+											 ('lp', history._lp_columns, (n, cols), np.nan)):
+			for (f, values) in store.items():
+				store[f] = _read_rows(history, f'{prefix}_{f}', values, shape, fill, segments)
+		history._lp_present = _read_rows(history, 'lp_present', history._lp_present, (n, cols), False, segments)
+		history._lp_shapes = _read_rows(history, 'lp_shapes', history._lp_shapes, (n, cols, 2), -1, segments)
+	history._rolling = history._grow('rolling', history._rolling, (n, RollingWindows.COLUMNS))
+	history._integral = meta['integral']
+	history._lp_names = meta['lp_names']
+	history._lp_index = {name: col for (col, name) in enumerate(history._lp_names)}
+	history._record_type = Market
+	history._lp_type = LiquidityProvider
+
+	liquidities = [Liquidity(**values) for values in meta['liquidities']]
+	history._liquidities = {tuple(values.values()): l for (values, l) in zip(meta['liquidities'], liquidities)}
+	tables = {'name': meta['names'], 'liquidity': liquidities,
+			  'risk_model': [RiskModel(**values) for values in meta['risk_models']]}
+	for (f, table) in tables.items():
+		history._object_tables[f] = table
+		history._object_index[f] = {(o if f == 'name' else id(o)): i for (i, o) in enumerate(table)}
+	for risk_model in tables['risk_model']:
+		risk_model._histories.add(history)
+	if history.spilled:
+		history._release()
+
+	latest = history[-1]
+	shapes = _decode_shapes(history, latest, meta['shapes'], arrays)
+	history._shapes = shapes[:meta['history_shapes']]
+	history._shape_index = {id(shape): i for (i, shape) in enumerate(history._shapes)}
+
+	events = history.events
+	events._pending = [(step, submitted, _decode_event(e, shapes)) for (step, submitted, e) in meta['pending']]
+	heapq.heapify(events._pending)
+	events._submitted = meta['submitted']
+	events.applied = [_decode_event(e, shapes) for e in meta['applied']]
+	return latest
+
+
+def snapshot(m: Market, start=0):
+	'''
+	Copy what save writes out of m's history, as (arrays, meta): enough to write the checkpoint later, e.g. on
+	another thread, while the market moves on. Only the rows from record start on are copied (see Checkpointer), and
+	a spilled history's aren't copied at all but left in their files (so its checkpoint must be written before the
+	market moves on).
+	'''
+	history = m._history
+	n = len(history)
+	cols = len(history._lp_names)
+	copy = (lambda values: values) if history.spilled else np.copy
+	arrays = {f'column_{f}': copy(values[start:n]) for (f, values) in history._columns.items()}
+	arrays.update({f'object_{f}': copy(values[start:n]) for (f, values) in history._object_ids.items()})
+	arrays.update({f'lp_{f}': copy(values[start:n, :cols]) for (f, values) in history._lp_columns.items()})
+	arrays['lp_present'] = copy(history._lp_present[start:n, :cols])
+	arrays['lp_shapes'] = copy(history._lp_shapes[start:n, :cols])
+
+	# rows start to n are in the checkpoint file itself
+	meta = {'version': CHECKPOINT_VERSION, 'len': n, 'segments': [(start, n, None)], 'lp_names': list(history._lp_names),
+			'integral': dict(history._integral)}
+	for (f, key, encode) in (('name', 'names', str), ('liquidity', 'liquidities', _fields),
+							 ('risk_model', 'risk_models', _fields)):
+		meta[key] = [encode(o) for o in history._object_tables[f]]
+
+	# shapes still to be committed by pending events are saved after the history's own
+	shapes = list(history._shapes)
+	shape_index = {id(shape): i for (i, shape) in enumerate(shapes)}
+	pending = sorted(history.events._pending, key=lambda p: p[:2])
+	meta['pending'] = [(step, submitted, _encode_event(e, shapes, shape_index)) for (step, submitted, e) in pending]
+	meta['submitted'] = history.events._submitted
+	meta['applied'] = [_encode_event(e, shapes, shape_index) for e in history.events.applied]
+	meta['history_shapes'] = len(history._shapes)
+	(meta['shapes'], shape_arrays) = _encode_shapes(history, shapes)
+	arrays.update(shape_arrays)
+	return (arrays, meta)
+
+
+class Checkpointer:
+	'''
+	Checkpoints a market to path every `every` records as it moves forward, e.g.
+
+		checkpointer = Checkpointer('run.ckpt', every=1000).attach(m)
+		for ...:
+			m = m.next(...)
+		checkpointer.close()
+
+	Once attached, Market.next calls step with each new record. The history's rows are written to segment files
+	beside path, which a checkpoint keeps while their records are unchanged: only the rows added (or changed, see
+	changed) since the last checkpoint are written again, merged with the latest segments while those are no longer,
+	so there are O(log n) segments and each row is rewritten O(log n) times. Only the copy of those rows (see
+	snapshot) is done on the simulation's thread; the files are written on a background thread, at most one
+	checkpoint at a time, and path is replaced atomically, so it always holds a complete checkpoint. With
+	background=False, or for a spilled history, which isn't copied, checkpoints are written in step.
+	'''
+
+	def __init__(self, path, every=1000, background=True, compress=False):
+		self.path = path
+		self.every = every
+		self.compress = compress
+		self.saved = 0  # number of records in the latest checkpoint
+		self._history = None
+		self._segments = []  # (start, stop, file) of the rows in the latest checkpoint
+		self._changed = None  # the first of its records changed since, if any
+		self._executor = ThreadPoolExecutor(max_workers=1) if background else None
+		self._writing = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def attach(self, m: Market):
+		'''
+		Checkpoint m's market from now on, counting from its current length
+		'''
+		self._history = m._history
+		self._history.checkpointer = self
+		self.saved = len(self._history)
+		self._segments = []
+		self._changed = None
+		return self
+
+	def step(self, m: Market):
+		if len(m._history) - self.saved >= self.every:
+			self.save(m)
+
+	def changed(self, n):
+		'''
+		Note that records from n on have changed, so that the next checkpoint writes their rows again. The history
+		calls this as it clears its caches.
+		'''
+		if n < self.saved and (self._changed is None or n < self._changed):
+			self._changed = n
+
+	def save(self, m: Market):
+		'''
+		Checkpoint m's market now, waiting for the previous checkpoint to finish writing first
+		'''
+		self.wait()
+		n = len(m._history)
+		unchanged = self.saved if self._changed is None else self._changed
+		kept = [segment for segment in self._segments if segment[1] <= unchanged]
+		start = kept[-1][1] if kept else 0
+		while kept and kept[-1][1] - kept[-1][0] <= n - start:
+			start = kept.pop()[0]
+		(arrays, meta) = snapshot(m, start)
+		rows = {key: arrays.pop(key) for key in list(arrays) if key.startswith(ROWS)}
+
+		(fd, segment) = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', prefix=os.path.basename(self.path) + '.')
+		os.close(fd)
+		segment = os.path.basename(segment)
+		meta['segments'] = [*kept, (start, n, segment)]
+		files = {file for (_, _, file) in meta['segments']}
+		# the first checkpoint replaces whatever was at path before
+		previous = self._segments if self._segments else _segments(self.path)
+		obsolete = [file for (_, _, file) in previous if file is not None and file not in files]
+		(self._segments, self.saved, self._changed) = (meta['segments'], n, None)
+		if self._executor is None or m._history.spilled:
+			_write_checkpoint(self.path, segment, rows, arrays, meta, obsolete, self.compress)
+		else:
+			self._writing = self._executor.submit(
+				_write_checkpoint, self.path, segment, rows, arrays, meta, obsolete, self.compress)
+
+	def wait(self):
+		'''
+		Wait for the checkpoint being written, if any, raising any error writing it
+		'''
+		if self._writing is not None:
+			(writing, self._writing) = (self._writing, None)
+			writing.result()
+
+	def close(self):
+		'''
+		Stop checkpointing, once the last checkpoint has been written
+		'''
+		if self._history is not None and self._history.checkpointer is self:
+			self._history.checkpointer = None
+		try:
+			self.wait()
+		finally:
+			if self._executor is not None:
+				self._executor.shutdown()
+
+
+def _write_checkpoint(path, segment, rows, arrays, meta, obsolete, compress=False):
+	# the new rows first, then the checkpoint that refers to them, and only then drop the segments it no longer does
+	directory = os.path.dirname(path)
+	_write(os.path.join(directory, segment), rows, None, compress)
+	_write(path, arrays, meta, compress)
+	for file in obsolete:
+		try:
+			os.remove(os.path.join(directory, file))
+		except OSError:
+			pass
+
+
+def _write(path, arrays, meta, compress=False):
+	directory = os.path.dirname(path) or '.'
+	(fd, tmp) = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			if meta is not None:
+				arrays = {'meta': np.frombuffer(json.dumps(meta, default=_json_default).encode(), dtype=np.uint8),
+						  **arrays}
+			(np.savez_compressed if compress else np.savez)(f, **arrays)
+		os.replace(tmp, path)
+	except BaseException:
+		os.remove(tmp)
+		raise
+
+
+def _segments(path):
+	# the segments of the checkpoint at path, if there is one
+	try:
+		with zipfile.ZipFile(path) as archive:
+			return json.loads(_read_array(archive, 'meta').tobytes().decode()).get('segments', [])
+	except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+		return []
+
+
+def _read_array(archive, key):
+	with archive.open(key + '.npy') as f:
+		return np.lib.format.read_array(f, allow_pickle=False)
+
+
+def _read_rows(history, name, values, shape, fill, segments):
+	'''
+	The history's array name, of the given shape, read from the segments of a checkpoint into values enlarged (see
+	History._grow) SPILL_ROWS at a time. Columns (LPs) a segment doesn't have are filled with fill.
+	'''
+	values = history._grow(name, values, shape, fill)
+	mapped = history._maps.get(name)
+	for (start, stop, file) in segments:
+		opened = contextlib.nullcontext(file) if isinstance(file, zipfile.ZipFile) else zipfile.ZipFile(file)
+		with opened as archive, archive.open(name + '.npy') as f:
+			version = np.lib.format.read_magic(f)
+			read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+			(stored, _, dtype) = read_header(f)
+			row_bytes = int(np.prod(stored[1:], dtype=np.int64)) * dtype.itemsize
+			region = tuple(slice(0, size) for size in stored[1:])
+			for chunk in range(start, stop, SPILL_ROWS):
+				rows = min(chunk + SPILL_ROWS, stop) - chunk
+				values[chunk:chunk + rows] = fill
+				values[(slice(chunk, chunk + rows), *region)] = \
+					np.frombuffer(f.read(rows * row_bytes), dtype=dtype).reshape((rows, *stored[1:]))
+				if mapped is not None:
+					(m, mapped_row_bytes) = mapped
+					_drop_pages(m, chunk * mapped_row_bytes, (chunk + rows) * mapped_row_bytes)
+	return values
+
+
+def _json_default(value):
+	if isinstance(value, np.generic):
+		return value.item()
+	raise TypeError(f'Cannot checkpoint a value of type {type(value).__name__}.')
+
+
+def _fields(o):
+	return {f.name: getattr(o, f.name) for f in fields(o) if f.init}
+
+
+def _encode_shapes(history, shapes):
+	# the record each shape was made for, if it is in this history (else the latest record), and its side; the
+	# levels of every shape are concatenated into one array per field
+	meta = [(shape.market._n if history.holds(shape.market) else -1, bool(shape.is_sell_side)) for shape in shapes]
+	lengths = [len(shape.ticks) for shape in shapes]
+	arrays = {'shape_offsets': np.cumsum([0, *lengths])}
+	for f in ('ticks', 'limit_orders', 'liquidity_fractions'):
+		values = [np.asarray(getattr(shape, f)) for shape in shapes]
+		arrays[f'shape_{f}'] = np.concatenate(values) if values else np.zeros(0)
+	return (meta, arrays)
+
+
+def _decode_shapes(history, latest, meta, arrays):
+	offsets = arrays['shape_offsets']
+	shapes = []
+	for (i, (n, is_sell_side)) in enumerate(meta):
+		(start, stop) = (offsets[i], offsets[i + 1])
+		shape = object.__new__(OrderSetForSide)
+		set_fields(
+			shape,
+			market=history[n] if n >= 0 else latest,
+			is_sell_side=is_sell_side,
+			limit_orders=arrays['shape_limit_orders'][start:stop].copy(),
+			liquidity_fractions=arrays['shape_liquidity_fractions'][start:stop].copy(),
+			ticks=arrays['shape_ticks'][start:stop].astype(int))
+		shapes.append(shape)
+	return shapes
+
+
+def _encode_event(event, shapes, shape_index):
+	values = {}
+	for (key, value) in event.values.items():
+		if isinstance(value, OrderSetForSide):
+			if id(value) not in shape_index:
+				shape_index[id(value)] = len(shapes)
+				shapes.append(value)
+			value = {'shape': shape_index[id(value)]}
+		values[key] = value
+	return (event.step, event.kind, event.name, values)
+
+
+def _decode_event(encoded, shapes):
+	(step, kind, name, values) = encoded
+	values = {key: shapes[value['shape']] if isinstance(value, dict) else value for (key, value) in values.items()}
+	return Event(step, kind, name, values)
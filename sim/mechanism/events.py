@@ -0,0 +1,69 @@
+import heapq
+
+from prelude import *
+
+# A change to an LP's commitment, taking effect at record step: kind is one of KINDS and values holds the
+# LiquidityProvider fields it sets
+Event = namedtuple('Event', ['step', 'kind', 'name', 'values'])
+
+KINDS = ('commit', 'amend_stake', 'amend_fee_bid', 'cancel')
+
+
+class EventLog:
+	'''
+	The LP commitment changes of one market: those still to come, ordered by step and then by submission, and those
+	already applied, in the order they were applied. Market.next applies the events due at each new record.
+	'''
+
+	def __init__(self):
+		self._pending = []  # heap of (step, submitted, event)
+		self._submitted = 0
+		self.applied = []
+
+	def __len__(self):
+		return len(self._pending)
+
+	def push(self, event: Event):
+		if event.kind not in KINDS:
+			raise ValueError(f"Unknown event kind '{event.kind}', expected one of {KINDS}.")
+		heapq.heappush(self._pending, (event.step, self._submitted, event))
+		self._submitted += 1
+
+	def due(self, step, check=None):
+		'''
+		Remove and return the pending events for records up to step, in order. If check(events) raises, the events
+		are left in the queue.
+		'''
+		entries = []
+		while self._pending and self._pending[0][0] <= step:
+			entries.append(heapq.heappop(self._pending))
+		events = [entry[2] for entry in entries]
+		if check is not None and events:
+			try:
+				check(events)
+			except BaseException:
+				for entry in entries:
+					heapq.heappush(self._pending, entry)
+				raise
+		return events
+
+	def upto(self, step):
+		'''
+		The pending events for records up to step, in order, left in the queue
+		'''
+		return [entry[2] for entry in sorted(entry for entry in self._pending if entry[0] <= step)]
+
+
+def check_events(names, events):
+	'''
+	Raise KeyError for the first of events that, applied in order to a record with LPs called names, would amend or
+	cancel an LP that isn't there
+	'''
+	names = set(names)
+	for event in events:
+		if event.kind == 'commit':
+			names.add(event.name)
+		elif event.name not in names:
+			raise KeyError(f"Event {event.kind} at step {event.step}: no LP called '{event.name}'.")
+		elif event.kind == 'cancel':
+			names.discard(event.name)
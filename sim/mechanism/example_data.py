@@ -1,5 +1,4 @@
 import json
-import matplotlib.pyplot as plt
 
 from .liquidity_provider import *
 
@@ -0,0 +1,353 @@
+import numpy as np
+
+from prelude import *
+from .history import History
+from .liquidity_provider import record_margins
+
+
+# Rows per chunk when streaming an export
+CHUNK_SIZE = 10_000
+
+
+def export_columns(m: 'Market', market_fields, lp_fields, start=0, stop=None):
+	'''
+	Collect market_fields and, for every LP in the history, lp_fields over records start to stop in one pass.
+
+	Returns a dict of column name to NumPy array. Fields stored in the history are sliced straight out of its
+	columns, and the derived fields of Market and LiquidityProvider (valuation, equity, ...) are computed from them a
+	whole column at a time (see Derived). Only fields Derived doesn't know are evaluated record by record. Cells for
+	an LP with no commitment at a record are NaN, so a genuine zero stays a zero.
+	'''
+	history = m._history
+	(start, stop, _) = slice(start, stop).indices(len(history))
+	lps = history.lp_names
+	# judged over the whole history so that every chunk of an export gets the same column types
+	present = history.lp_column('present').all(axis=0)
+	derived = Derived(history, start, stop)
+	columns = {}
+	per_record = []
+
+	for f in market_fields:
+		if f == '_n':
+			columns[f] = np.arange(start, stop)
+		elif f in History.FIELDS:
+			columns[f] = _typed(history, f, history.column(f)[start:stop])
+		elif f in Derived.MARKET:
+			columns[f] = derived.market(f)
+		else:
+			columns[f] = []
+			per_record.append(f)
+
+	lp_per_record = []
+	for (i, lp) in enumerate(lps):
+		for f in lp_fields:
+			name = f'{lp}_{f}'
+			if f in History.LP_FIELDS:
+				values = history.lp_column(f)[start:stop, i]
+				columns[name] = _typed(history, f, values) if present[i] else values
+			elif f in Derived.LP:
+				columns[name] = derived.lp(f)[:, i]
+			else:
+				columns[name] = []
+				lp_per_record.append((name, lp, f))
+
+	if per_record or lp_per_record:
+		for n in range(start, stop):
+			r = history[n]
+			for f in per_record:
+				columns[f].append(getattr(r, f))
+			for (name, lp, f) in lp_per_record:
+				columns[name].append(r.lp(name=lp, attr=f, default=np.nan))
+		for name in [*per_record, *[name for (name, _, _) in lp_per_record]]:
+			columns[name] = np.asarray(columns[name]) if columns[name] else np.zeros(0)
+
+	return columns
+
+
+class Derived:
+	'''
+	The derived Market and LiquidityProvider fields of records start to stop of a history, each computed from the
+	history's columns for every record (and LP) at once the first time it is asked for.
+
+	The formulas are those of the Market and LiquidityProvider properties, evaluated in the same order (sums run over
+	the LPs in the order of lp_names, as the records' do), so the values are the records' own: the rolling window
+	statistics give valuation and target stake, and the (step x LP) stake and entry valuation columns give equity
+	and the rest. The fee rate walks each record's LPs in fee bid order, ties in the order of lp_names, as the
+	FeeIndex of a record read back from the history does. Margins depend on the LPs' order shapes: they are 0 where an
+	LP has none, and records whose LPs have the same shapes under the same risk model are solved together with
+	record_margins.
+	'''
+
+	MARKET = ('valuation', 'total_stake', 'total_equity', 'target_stake', 'total_margin', 'fee_rate',
+			  'fees_collected', 'annualised_return', 'annualised_return_on_capital')
+	LP = ('equity', 'equity_share', 'stake_share', 'fee_revenue', 'annualised_return', 'obligation', 'margin')
+
+	def __init__(self, history, start, stop):
+		self._history = history
+		self._start = start
+		self._stop = stop
+		self._values = {}
+
+	def market(self, f):
+		'''
+		Market field f for each record, as an array
+		'''
+		return self._get(f)
+
+	def lp(self, f):
+		'''
+		LiquidityProvider field f as a (record x LP) array, NaN where the LP has no commitment
+		'''
+		if ('nan', f) not in self._values:
+			self._values[('nan', f)] = np.where(self._present, self._get('lp_' + f), np.nan)
+		return self._values[('nan', f)]
+
+	def _get(self, name):
+		if name not in self._values:
+			with np.errstate(divide='ignore', invalid='ignore'):
+				self._values[name] = getattr(self, '_' + name)()
+		return self._values[name]
+
+	@property
+	def _present(self):
+		return self._lp_column('present')
+
+	def _column(self, f):
+		return self._history.column(f)[self._start:self._stop]
+
+	def _lp_column(self, f):
+		if ('lp', f) not in self._values:
+			self._values[('lp', f)] = np.asarray(self._history.lp_column(f)[self._start:self._stop])
+		return self._values[('lp', f)]
+
+	def _rolling(self, i):
+		if self._stop > self._start:
+			self._history.rolling._catch_up(self._stop - 1)
+		return self._history._rolling[self._start:self._stop, i]
+
+	def _objects(self, f, value):
+		# value(o) for the object (liquidity or risk model) of each record
+		table = np.array([value(o) for o in self._history._object_tables[f]])
+		return table[self._history._object_ids[f][self._start:self._stop]]
+
+	def _over_lps(self, values):
+		# the sum over each record's LPs, added up one LP at a time as Python's sum over the LPs would
+		total = np.zeros(self._stop - self._start)
+		for col in range(values.shape[1]):
+			total = total + np.where(self._present[:, col], values[:, col], 0.0)
+		return total
+
+	def _total_stake(self):
+		return _typed(self._history, 'stake', self._over_lps(self._lp_column('stake')))
+
+	def _valuation(self):
+		period = self._column('valuation_period')
+		n = np.arange(self._start, self._stop)
+		factor = period.astype(float) / (n + 1 - np.maximum(0, n - period + 1)).astype(float)
+		return np.maximum(factor * self._rolling(0), self._get('total_stake'))
+
+	def _target_stake(self):
+		v = self._objects('liquidity', lambda liquidity: liquidity.v)
+		risk_factor = self._objects('risk_model', lambda risk_model: risk_model.RiskFactorShort())
+		return self._rolling(1) * v * risk_factor
+
+	def _total_equity(self):
+		return self._over_lps(self._get('lp_equity'))
+
+	def _total_margin(self):
+		return self._over_lps(self._get('lp_margin'))
+
+	def _fee_rate(self):
+		present = self._present
+		cols = present.shape[1]
+		# each record's LPs by bid, ties by column, those without a commitment last
+		bids = np.where(present, self._lp_column('fee_bid'), np.inf)
+		order = np.lexsort((np.broadcast_to(np.arange(cols), bids.shape), bids))
+		stakes = np.take_along_axis(np.where(present, self._lp_column('stake'), 0.0), order, axis=1)
+		cumulative = np.maximum.accumulate(np.cumsum(stakes, axis=1), axis=1)
+		bids = np.take_along_axis(bids, order, axis=1)
+		count = present.sum(axis=1)
+		met = (cumulative >= self._get('target_stake')[:, None]) & (np.arange(cols) < count[:, None])
+		i = np.where(met.any(axis=1), np.argmax(met, axis=1), count - 1)
+		return np.where(count > 0, np.take_along_axis(bids, np.maximum(i, 0)[:, None], axis=1)[:, 0], 0.0)
+
+	def _fees_collected(self):
+		return self._column('traded_volume') * self._get('fee_rate')
+
+	def _annualised_return(self):
+		total_stake = self._get('total_stake')
+		return np.where(total_stake > 0, (365 * self._get('fees_collected')) / total_stake, 0.0)
+
+	def _annualised_return_on_capital(self):
+		cost_base = self._get('target_stake') + self._get('total_margin')
+		return np.where(cost_base > 0, (365 * self._get('fees_collected')) / cost_base, 0.0)
+
+	def _lp_equity(self):
+		return (self._get('valuation')[:, None] / self._lp_column('entry_valuation')) * self._lp_column('stake')
+
+	def _lp_equity_share(self):
+		total_equity = self._get('total_equity')[:, None]
+		return np.where(total_equity > 0, self._get('lp_equity') / total_equity, 0.0)
+
+	def _lp_stake_share(self):
+		total_stake = self._get('total_stake')[:, None]
+		return np.where(total_stake > 0, self._lp_column('stake') / total_stake, 0.0)
+
+	def _lp_fee_revenue(self):
+		return self._get('fees_collected')[:, None] * self._get('lp_equity_share')
+
+	def _lp_annualised_return(self):
+		return (365 * self._get('lp_fee_revenue')) / self._lp_column('stake')
+
+	def _lp_obligation(self):
+		return self._lp_column('stake') * self._objects('liquidity', lambda liquidity: liquidity.k)[:, None]
+
+	def _lp_margin(self):
+		# records with the same risk model and the same LPs' shapes have the same books but for mid and tick, so
+		# each such group is solved at once; an LP without a shape has no margin
+		history = self._history
+		shapes = np.where(self._present[:, :, None], self._lp_column('shapes'), -1)
+		shaped = (shapes >= 0).any(axis=2)
+		values = np.zeros(shaped.shape)
+		rows = np.flatnonzero(shaped.any(axis=1))
+		if not len(rows):
+			return values
+		risk_models = history._object_ids['risk_model'][self._start:self._stop]
+		keys = np.concatenate([risk_models[rows, None], shapes[rows].reshape(len(rows), -1)], axis=1)
+		(_, inverse, counts) = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+		groups = np.split(rows[np.argsort(inverse.reshape(-1), kind='stable')], np.cumsum(counts)[:-1])
+		mid = self._column('mark_price')
+		tick = self._column('tick_size')
+		obligations = self._get('lp_obligation')
+		for members in groups:
+			row = members[0]
+			cols = np.flatnonzero(shaped[row])
+			lp_shapes = [[history._shapes[i] if i >= 0 else None for i in shapes[row, col]] for col in cols]
+			values[np.ix_(members, cols)] = record_margins(
+				mid[members], tick[members], obligations[np.ix_(members, cols)], lp_shapes,
+				history._object_tables['risk_model'][risk_models[row]])
+		return values
+
+
+def iter_frames(m: 'Market', market_fields, lp_fields, chunk_size=CHUNK_SIZE, start=0, stop=None):
+	'''
+	Yield the export as DataFrames of up to chunk_size records, indexed by record number
+	'''
+	import pandas as pd
+
+	(start, stop, _) = slice(start, stop).indices(len(m._history))
+	for chunk_start in range(start, stop, chunk_size):
+		chunk_stop = min(chunk_start + chunk_size, stop)
+		yield pd.DataFrame(
+			export_columns(m, market_fields, lp_fields, chunk_start, chunk_stop),
+			index=pd.RangeIndex(chunk_start, chunk_stop))
+
+
+class IncrementalFrame:
+	'''
+	A DataFrame export of a market history that is kept up to date rather than rebuilt: each call to frame exports
+	only the records added since the last call, or changed since (the history reports changes, see
+	History.clear_caches), and appends them to per-column buffers. Stepping a market forward and exporting again so
+	costs O(new records), e.g. for redrawing plots interactively.
+
+	Columns start with the types of a full export. They are appended as new LPs appear, NaN for earlier records, and
+	a column's type is widened (e.g. integers to floats) as new values need it, so it may end up wider than a full
+	export's. The frames returned share memory with the
+	buffers, so treat them as read-only.
+	'''
+
+	def __init__(self, market_fields, lp_fields):
+		self.market_fields = list(market_fields)
+		self.lp_fields = list(lp_fields)
+		self._buffers = {}
+		self._len = 0  # records exported and still up to date
+		self._capacity = 0
+
+	def changed(self, n):
+		'''
+		Record n, and so possibly every record after it, has changed since it was exported
+		'''
+		self._len = min(self._len, n)
+
+	def frame(self, m: 'Market'):
+		import pandas as pd
+
+		n = len(m._history)
+		if self._len < n:
+			self._extend(export_columns(m, self.market_fields, self.lp_fields, self._len, n), n)
+		return pd.DataFrame({name: values[:n] for (name, values) in self._buffers.items()}, copy=False)
+
+	def _extend(self, columns, n):
+		start = self._len
+		if n > self._capacity:
+			self._capacity = max(n, 2 * self._capacity, 64)
+			for (name, values) in self._buffers.items():
+				self._buffers[name] = _resized(values, self._capacity)
+		for (name, values) in columns.items():
+			buffer = self._buffers.get(name)
+			if buffer is None and start == 0:
+				buffer = self._buffers[name] = np.empty(self._capacity, dtype=values.dtype)
+			elif buffer is None:
+				# a new LP's column, with no commitment at the records already exported
+				buffer = self._buffers[name] = np.full(self._capacity, np.nan, dtype=np.result_type(values, float))
+			elif np.result_type(buffer, values) != buffer.dtype:
+				buffer = self._buffers[name] = buffer.astype(np.result_type(buffer, values))
+			buffer[start:n] = values
+		self._len = n
+
+
+def incremental_frame(m: 'Market', market_fields, lp_fields):
+	'''
+	The export of m's history as a DataFrame, from the IncrementalFrame its history keeps for these fields
+	'''
+	key = (tuple(market_fields), tuple(lp_fields))
+	exports = m._history.exports
+	if key not in exports:
+		exports[key] = IncrementalFrame(market_fields, lp_fields)
+	return exports[key].frame(m)
+
+
+def write_csv(m: 'Market', market_fields, lp_fields, output, chunk_size=CHUNK_SIZE):
+	'''
+	Stream the export to a CSV file object a chunk at a time. LPs with no commitment at a record are left blank.
+	'''
+	header = True
+	for df in iter_frames(m, market_fields, lp_fields, chunk_size):
+		df.to_csv(output, header=header, index=False, na_rep='')
+		header = False
+	if header:
+		output.write(','.join(_column_names(m, market_fields, lp_fields)) + '\n')
+
+
+def write_parquet(m: 'Market', market_fields, lp_fields, path, chunk_size=CHUNK_SIZE):
+	'''
+	Stream the export to a Parquet file a row group at a time, all columns as doubles. Needs pyarrow.
+	'''
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+
+	writer = None
+	try:
+		for df in iter_frames(m, market_fields, lp_fields, chunk_size):
+			table = pa.Table.from_pandas(df.astype(float), preserve_index=False)
+			if writer is None:
+				writer = pq.ParquetWriter(path, table.schema)
+			writer.write_table(table)
+	finally:
+		if writer is not None:
+			writer.close()
+
+
+def _column_names(m, market_fields, lp_fields):
+	return [*market_fields, *[f'{lp}_{f}' for lp in m._history.lp_names for f in lp_fields]]
+
+
+def _typed(history, field, values):
+	# fields only ever given integers come back as integers, as they would from the records themselves
+	return values.astype(np.int64) if history._integral[field] else values
+
+
+def _resized(values, size):
+	resized = np.empty(size, dtype=values.dtype)
+	resized[:len(values)] = values
+	return resized
@@ -0,0 +1,81 @@
+from bisect import bisect_left
+
+import numpy as np
+
+from prelude import *
+
+
+class FeeIndex:
+	'''
+	A market record's LPs sorted by fee bid, ties in the order they joined, with the cumulative stake along that order.
+
+	It is kept up to date as LPs join, leave or change their stake or bid (see Market.add_lp, amend_lp and
+	remove_lp), at the cost of a binary search and a list insertion each, so the fee rate is a binary search against
+	the target stake rather than a sort of every LP. The cumulative stake is recomputed on the first lookup after a
+	change.
+	'''
+
+	def __init__(self):
+		self._keys = []  # (fee_bid, joined), sorted
+		self._stakes = []  # stake for each of _keys
+		self._entries = {}  # name -> (fee_bid, joined, stake)
+		self._joined = 0
+		self._cumulative = None
+
+	def __len__(self):
+		return len(self._keys)
+
+	def copy(self):
+		other = FeeIndex()
+		other._keys = self._keys.copy()
+		other._stakes = self._stakes.copy()
+		other._entries = self._entries.copy()
+		other._joined = self._joined
+		other._cumulative = self._cumulative
+		return other
+
+	def set(self, name, stake, fee_bid):
+		'''
+		Add the LP called name, or move it to its new place if its bid or stake has changed
+		'''
+		entry = self._entries.get(name)
+		if entry is not None:
+			(old_bid, joined, old_stake) = entry
+			if old_bid == fee_bid and old_stake == stake:
+				return
+			self._pop(entry)
+		else:
+			joined = self._joined
+			self._joined += 1
+		key = (fee_bid, joined)
+		i = bisect_left(self._keys, key)
+		self._keys.insert(i, key)
+		self._stakes.insert(i, stake)
+		self._entries[name] = (fee_bid, joined, stake)
+		self._cumulative = None
+
+	def remove(self, name):
+		'''
+		Take the LP called name out of the index
+		'''
+		self._pop(self._entries.pop(name))
+
+	def fee_rate(self, target_stake):
+		'''
+		The bid of the first LP, in bid order, at which the cumulative stake reaches target_stake, the highest bid if
+		it never does, or 0 with no LPs
+		'''
+		if not self._keys:
+			return 0
+		if self._cumulative is None:
+			# a running max so the search also finds the first crossing should a stake ever be negative
+			self._cumulative = np.maximum.accumulate(np.cumsum(self._stakes))
+		i = int(np.searchsorted(self._cumulative, target_stake))
+		return self._keys[min(i, len(self._keys) - 1)][0]
+
+	def _pop(self, entry):
+		(fee_bid, joined, _) = entry
+		i = bisect_left(self._keys, (fee_bid, joined))
+		del self._keys[i]
+		del self._stakes[i]
+		self._cumulative = None
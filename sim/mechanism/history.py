@@ -0,0 +1,566 @@
+import mmap
+import os
+import weakref
+from collections import deque
+from collections.abc import MutableMapping
+
+import numpy as np
+from dataclasses import fields
+
+from prelude import *
+from .events import EventLog
+
+# Rows a spilled history's files grow by at a time, and how often it releases the rows behind its window from memory
+SPILL_ROWS = 4096
+
+
+class History:
+	'''
+	The history shared by every record of one market, stored column-wise.
+
+	Market fields are kept in one array per field and LP commitments in 2-D (step x LP) arrays, so a long history
+	costs a few numbers per step rather than a Market object and a copy of every LiquidityProvider. Market records
+	(and their LPs) are views materialised on demand by indexing, e.g. m[i] or ~m. A view stays the same object
+	while something holds on to it, and any change made to a view, or to one of its LPs, is written back to the
+	columns (see Market.invalidate).
+
+	A history that outgrows memory can be spilled to disk (see spill_to): its columns are then memory-mapped files,
+	and only the rows in the latest record's windows, plus up to SPILL_ROWS more, are kept resident.
+	'''
+
+	# numeric Market fields, stored as float64
+	FIELDS = ('num_ticks', 'tick_size', 'mark_price', 'traded_volume', 'open_interest')
+	# Market fields stored by reference
+	OBJECTS = ('name', 'liquidity', 'risk_model')
+	# numeric LiquidityProvider fields, stored as (step x LP) float64
+	LP_FIELDS = ('stake', 'fee_bid', 'entry_valuation')
+
+	def __init__(self):
+		self._len = 0
+		self._rows = 0  # allocated rows
+		self._cols = 0  # allocated LP columns
+		self._columns = {f: np.zeros(0) for f in self.FIELDS}
+		self._columns['valuation_period'] = np.zeros(0, dtype=np.int64)
+		self._columns['stake_target_period'] = np.zeros(0, dtype=np.int64)
+		# objects stored by reference, as an index per row into a list of the distinct objects
+		self._object_ids = {f: np.zeros(0, dtype=np.int32) for f in self.OBJECTS}
+		self._object_tables = {f: [] for f in self.OBJECTS}
+		self._object_index = {f: {} for f in self.OBJECTS}  # name, or id of the object -> index into its table
+		self._lp_columns = {f: np.zeros((0, 0)) for f in self.LP_FIELDS}
+		self._lp_present = np.zeros((0, 0), dtype=bool)
+		self._lp_shapes = np.zeros((0, 0, 2), dtype=np.int32)  # indices into _shapes, -1 for no shape
+		# fields that have only ever been given integers are handed back as integers
+		self._integral = {f: True for f in (*self.FIELDS, *self.LP_FIELDS)}
+		self._lp_names = []
+		self._lp_index = {}
+		self._shapes = []
+		self._shape_index = {}  # id(shape) -> index into _shapes
+		self._liquidities = {}  # interned copies of the Liquidity parameters
+		self._rolling = np.zeros((0, RollingWindows.COLUMNS))
+		self._directory = None  # where the columns are spilled to, if they are
+		self._maps = {}  # file name -> (mmap, bytes per row) of each spilled array
+		self._released = 0  # rows before this have been released from memory
+		self._record_type = None
+		self._lp_type = None
+		self._views = weakref.WeakValueDictionary()
+		self.rolling = RollingWindows(self)
+		self.events = EventLog()
+		self.checkpointer = None  # see checkpoint.Checkpointer
+		self.exports = {}  # (market fields, LP fields) -> export.IncrementalFrame
+
+	def __len__(self):
+		return self._len
+
+	def __iter__(self):
+		return (self[i] for i in range(self._len))
+
+	def __getitem__(self, key):
+		if isinstance(key, slice):
+			return [self[i] for i in range(*key.indices(self._len))]
+		if key < 0:
+			key += self._len
+		if not 0 <= key < self._len:
+			raise IndexError('market history index out of range')
+		m = self._views.get(key)
+		return m if m is not None else self._materialise(key)
+
+	def holds(self, m):
+		'''
+		True if m is the view of its own place in this history (records are briefly outside it while being created)
+		'''
+		return self._views.get(m._n) is m
+
+	def column(self, name):
+		'''
+		Read-only array of a Market field (or the liquidity periods) over the whole history
+		'''
+		values = self._columns[name][:self._len]
+		values.flags.writeable = False
+		return values
+
+	def lp_column(self, name):
+		'''
+		Read-only (step x LP) array of a LiquidityProvider field, NaN where the LP had no commitment, columns in the
+		order of lp_names. 'present' is whether each LP had a commitment and 'shapes' (step x LP x 2) the indices of its
+		sell and buy side shapes, -1 for none.
+		'''
+		values = {'present': self._lp_present, 'shapes': self._lp_shapes}.get(name)
+		values = (values if values is not None else self._lp_columns[name])[:self._len, :len(self._lp_names)]
+		values.flags.writeable = False
+		return values
+
+	@property
+	def lp_names(self):
+		'''
+		Every LP that has appeared in the history, in order of first appearance
+		'''
+		return list(self._lp_names)
+
+	def append(self, m):
+		'''
+		Add a new record at the end of the history, making m its view
+		'''
+		if self._record_type is None:
+			self._record_type = type(m)
+		n = self._len
+		self._add_row(n, 0)
+		self._views[n] = m
+		self.store(m)
+		for lp in m.lps:
+			self.store_lp(m, lp)
+		set_fields(m, _lps=LPViews(self, m, dict(m._lps)))
+
+	def advance(self, m):
+		'''
+		Add m as the next record, carrying over the LP commitments of the record before it. Their rows are copied
+		array to array and m's LPs are only materialised when looked up, so no per-LP Python work is done.
+		'''
+		n = self._len
+		cols = len(self._lp_names)
+		self._add_row(n, cols)
+		self._views[n] = m
+		self.store(m)
+		for f in self.LP_FIELDS:
+			self._lp_columns[f][n, :cols] = self._lp_columns[f][n - 1, :cols]
+		self._lp_present[n, :cols] = self._lp_present[n - 1, :cols]
+		self._lp_shapes[n, :cols] = self._lp_shapes[n - 1, :cols]
+		set_fields(m, _lps=LPViews(self, m))
+
+	def lp_values(self, name, n):
+		'''
+		A LiquidityProvider field for each LP committed at record n, in the order of lp_names
+		'''
+		cols = len(self._lp_names)
+		values = self._lp_columns[name][n, :cols][self._lp_present[n, :cols]].tolist()
+		return [int(v) for v in values] if self._integral[name] else values
+
+	def store(self, m):
+		'''
+		Write a record's Market fields to its row
+		'''
+		n = m._n
+		for f in self.FIELDS:
+			value = getattr(m, f)
+			self._integral[f] = self._integral[f] and _is_integral(value)
+			self._columns[f][n] = value
+		for f in ('name', 'risk_model'):
+			self._object_ids[f][n] = self._object_id(f, getattr(m, f))
+		self._object_ids['liquidity'][n] = self._object_id('liquidity', self._intern(m.liquidity))
+		self._columns['valuation_period'][n] = m.liquidity.valuation_period
+		self._columns['stake_target_period'][n] = m.liquidity.stake_target_period
+		self.rolling.check(n)
+
+	def store_lp(self, m, lp):
+		'''
+		Write one of a record's LPs to its row
+		'''
+		if self._lp_type is None:
+			self._lp_type = type(lp)
+		n = m._n
+		col = self._lp_index.get(lp.name)
+		if col is None:
+			col = self._lp_index[lp.name] = len(self._lp_names)
+			self._lp_names.append(lp.name)
+			self._reserve(self._rows, col + 1)
+		for f in self.LP_FIELDS:
+			value = getattr(lp, f)
+			self._integral[f] = self._integral[f] and _is_integral(value)
+			self._lp_columns[f][n, col] = value
+		self._lp_present[n, col] = True
+		self._lp_shapes[n, col] = (self._shape(lp.sell_side_shape), self._shape(lp.buy_side_shape))
+
+	def remove_lp(self, m, name):
+		'''
+		Clear an LP from a record's row
+		'''
+		col = self._lp_index[name]
+		for f in self.LP_FIELDS:
+			self._lp_columns[f][m._n, col] = np.nan
+		self._lp_present[m._n, col] = False
+		self._lp_shapes[m._n, col] = -1
+
+	def clear_caches(self, n):
+		'''
+		Drop the cached aggregates of live views from record n onwards, and tell the incremental exports and the
+		checkpointer
+		'''
+		for export in self.exports.values():
+			export.changed(n)
+		if self.checkpointer is not None:
+			self.checkpointer.changed(n)
+		if n == self._len - 1:
+			views = [self._views.get(n)]  # the common case, a change to the latest record
+		else:
+			views = [m for i, m in list(self._views.items()) if i >= n]
+		for m in views:
+			if m is not None:
+				m._cache.clear()
+
+	def _materialise(self, n):
+		m = object.__new__(self._record_type)
+		values = {f: self._value(f, self._columns[f][n]) for f in self.FIELDS}
+		values.update(
+			name=self._object(n, 'name'),
+			liquidity=clone(self._object(n, 'liquidity')),
+			risk_model=self._object(n, 'risk_model'),
+			_n=n,
+			_history=self,
+			_cache={},
+			_fees=None)
+		set_fields(m, **values, _lps=LPViews(self, m))
+		set_fields(m.liquidity, _market=m)
+		self._views[n] = m
+		return m
+
+	def _materialise_lp(self, m, col):
+		lp = object.__new__(self._lp_type)
+		n = m._n
+		sell, buy = self._lp_shapes[n, col]
+		set_fields(
+			lp,
+			market=m,
+			name=self._lp_names[col],
+			sell_side_shape=self._shapes[sell] if sell >= 0 else None,
+			buy_side_shape=self._shapes[buy] if buy >= 0 else None,
+			**{f: self._value(f, self._lp_columns[f][n, col]) for f in self.LP_FIELDS})
+		return lp
+
+	def _value(self, field, value):
+		return int(value) if self._integral[field] else float(value)
+
+	def _object(self, n, field):
+		return self._object_tables[field][self._object_ids[field][n]]
+
+	def _object_id(self, field, o):
+		# names by value, other objects by identity (the table keeps them alive, so ids stay unique)
+		key = o if field == 'name' else id(o)
+		i = self._object_index[field].get(key)
+		if i is None:
+			i = self._object_index[field][key] = len(self._object_tables[field])
+			self._object_tables[field].append(o)
+			if field == 'risk_model':
+				o._histories.add(self)
+		return i
+
+	def risk_model_changed(self, risk_model):
+		'''
+		Drop the cached aggregates of every record from the first that uses risk_model, which has been changed in place
+		'''
+		i = self._object_index['risk_model'].get(id(risk_model))
+		rows = np.flatnonzero(self._object_ids['risk_model'][:self._len] == i) if i is not None else []
+		if len(rows):
+			self.clear_caches(int(rows[0]))
+
+	def _intern(self, liquidity):
+		key = tuple(getattr(liquidity, f.name) for f in fields(liquidity) if f.init)
+		if key not in self._liquidities:
+			self._liquidities[key] = clone(liquidity, _market=None)  # a private copy, views get their own
+		return self._liquidities[key]
+
+	def _shape(self, shape):
+		if shape is None:
+			return -1
+		if id(shape) not in self._shape_index:
+			self._shape_index[id(shape)] = len(self._shapes)
+			self._shapes.append(shape)  # keeps the shape alive, so its id stays unique
+		return self._shape_index[id(shape)]
+
+	def _reserve(self, rows, cols):
+		'''
+		Make room for at least rows records and cols LPs, growing geometrically (a spilled history's rows grow by
+		SPILL_ROWS at a time)
+		'''
+		if rows > self._rows:
+			if self._directory is None:
+				self._grow_rows(max(rows, 2 * self._rows, 16))
+			else:
+				self._grow_rows(max(rows, self._rows + SPILL_ROWS))
+		if cols > self._cols:
+			self._grow_lps(self._rows, max(cols, 2 * self._cols, 4))
+
+	def _add_row(self, n, cols):
+		'''
+		Make record n the last, its LP row clear from column cols on
+		'''
+		self._reserve(n + 1, len(self._lp_names))
+		self._len = n + 1
+		# a spilled history's files grow without being filled, so every row is cleared as it is added
+		for f in self.LP_FIELDS:
+			self._lp_columns[f][n, cols:] = np.nan
+		self._lp_present[n, cols:] = False
+		self._lp_shapes[n, cols:] = -1
+		if self._directory is not None and self._len - self._released >= 2 * SPILL_ROWS:
+			self._release()
+
+	def _grow_rows(self, rows):
+		for (prefix, store) in (('column', self._columns), ('object', self._object_ids)):
+			for (f, values) in store.items():
+				store[f] = self._grow(f'{prefix}_{f}', values, (rows, ))
+		self._rolling = self._grow('rolling', self._rolling, (rows, RollingWindows.COLUMNS))
+		self._rows = rows
+		self._grow_lps(rows, self._cols)
+
+	def _grow_lps(self, rows, cols):
+		for (f, values) in self._lp_columns.items():
+			self._lp_columns[f] = self._grow(f'lp_{f}', values, (rows, cols), np.nan)
+		self._lp_present = self._grow('lp_present', self._lp_present, (rows, cols), False)
+		self._lp_shapes = self._grow('lp_shapes', self._lp_shapes, (rows, cols, 2), -1)
+		self._cols = cols
+
+	def _grow(self, name, values, shape, fill=0):
+		'''
+		values enlarged to shape, in memory or, for a spilled history, in the file called name
+		'''
+		if self._directory is None or 0 in shape:
+			grown = np.full(shape, fill, dtype=values.dtype)
+			grown[tuple(slice(0, size) for size in values.shape)] = values
+			return grown
+		path = os.path.join(self._directory, name)
+		row_bytes = int(np.prod(shape[1:], dtype=np.int64)) * values.dtype.itemsize
+		if name in self._maps and values.shape[1:] == shape[1:]:
+			# only more rows: extend the file, whose new rows are cleared as they are added, and map it again
+			with open(path, 'r+b') as f:
+				f.truncate(shape[0] * row_bytes)
+				self._maps[name] = (mmap.mmap(f.fileno(), shape[0] * row_bytes), row_bytes)
+			return np.frombuffer(self._maps[name][0], dtype=values.dtype).reshape(shape)
+
+		# a new layout: copy into a new file a chunk of rows at a time, releasing each chunk once it's written
+		with open(path + '.tmp', 'w+b') as f:
+			f.truncate(shape[0] * row_bytes)
+			m = mmap.mmap(f.fileno(), shape[0] * row_bytes)
+		grown = np.frombuffer(m, dtype=values.dtype).reshape(shape)
+		region = tuple(slice(0, size) for size in values.shape[1:])
+		for start in range(0, values.shape[0], SPILL_ROWS):
+			stop = min(start + SPILL_ROWS, values.shape[0])
+			if fill != 0 and values.shape[1:] != shape[1:]:
+				grown[start:stop] = fill
+			grown[(slice(start, stop), *region)] = values[start:stop]
+			if stop <= self._released:
+				_drop_pages(m, start * row_bytes, stop * row_bytes)
+		os.replace(path + '.tmp', path)
+		self._maps[name] = (m, row_bytes)
+		return grown
+
+	def spill_to(self, directory):
+		'''
+		Keep the columns in memory-mapped files in directory from now on, so that the history's memory use is bounded
+		by its windows rather than its length. Records, m[i] and exports read older rows back from the files.
+		'''
+		if self._directory is not None:
+			raise ValueError(f'History is already spilled to {self._directory}.')
+		os.makedirs(directory, exist_ok=True)
+		self._directory = directory
+		self._grow_rows(self._rows)
+		self._release()
+
+	@property
+	def spilled(self):
+		return self._directory is not None
+
+	def _release(self):
+		'''
+		Write the rows before the latest record's windows back to the files and drop them from memory
+		'''
+		n = self._len - 1
+		window = max(self._columns['valuation_period'][n], self._columns['stake_target_period'][n])
+		stop = max(0, n - int(window))
+		if stop > self._released:
+			for (m, row_bytes) in self._maps.values():
+				_drop_pages(m, self._released * row_bytes, stop * row_bytes)
+			self._released = stop
+
+
+class LPViews(MutableMapping):
+	'''
+	A record's LPs by name, read from its row of the history. An LP is materialised the first time it is looked up
+	and then kept, so a record carried forward by History.advance costs nothing until its LPs are used. Adding and
+	removing LPs (Market.add_lp and remove_lp) update the row as well as this mapping.
+	'''
+
+	def __init__(self, history, m, lps=None):
+		self._history = history
+		self._market = m
+		self._lps = lps if lps is not None else {}
+
+	def __getitem__(self, name):
+		lp = self._lps.get(name)
+		if lp is None:
+			col = self._col(name)
+			if col is None:
+				raise KeyError(name)
+			lp = self._lps[name] = self._history._materialise_lp(self._market, col)
+		return lp
+
+	def __setitem__(self, name, lp):
+		self._lps[name] = lp
+
+	def __delitem__(self, name):
+		if self._col(name) is None:
+			raise KeyError(name)
+		self._lps.pop(name, None)
+		self._history.remove_lp(self._market, name)
+
+	def __contains__(self, name):
+		return name in self._lps or self._col(name) is not None
+
+	def __iter__(self):
+		history = self._history
+		n = self._market._n
+		cols = np.flatnonzero(history._lp_present[n, :len(history._lp_names)])
+		return iter([history._lp_names[col] for col in cols])
+
+	def __len__(self):
+		return int(np.count_nonzero(self._history._lp_present[self._market._n, :len(self._history._lp_names)]))
+
+	def copy(self):
+		return dict(self.items())
+
+	def _col(self, name):
+		col = self._history._lp_index.get(name)
+		if col is None or not self._history._lp_present[self._market._n, col]:
+			return None
+		return col
+
+
+def _is_integral(value):
+	return isinstance(value, (int, np.integer)) and not isinstance(value, bool)
+
+
+def _drop_pages(m, start, stop):
+	# flush bytes start to stop of a mapping to its file and drop the whole pages among them from memory; they are
+	# read back from the file if touched again. Without madvise (Windows, Python < 3.8) they are only flushed, which
+	# leaves them clean for the OS to reclaim when it needs the memory.
+	start = -(-start // mmap.PAGESIZE) * mmap.PAGESIZE
+	stop = stop // mmap.PAGESIZE * mmap.PAGESIZE
+	if stop > start:
+		m.flush(start, stop - start)
+		if hasattr(mmap, 'MADV_DONTNEED'):
+			m.madvise(mmap.MADV_DONTNEED, start, stop - start)
+
+
+class RollingWindows:
+	'''
+	Incrementally maintained window statistics over a market history: the SUM of traded volume over each record's
+	valuation_period and the MAX of open interest over its stake_target_period.
+
+	Records are pushed in order as they are first queried, with a running sum and a monotonic deque carried from one
+	record to the next, so stepping a market forward costs O(1) amortised rather than O(window). The running sum is
+	compensated (Neumaier), so it stays accurate however large the volumes that have passed through the window. If a
+	record's period differs from the previous record's (e.g. a Liquidity parameter change mid-run) the window is
+	re-seeded from the history at that record. Editing a record that has already been pushed forgets the statistics
+	from it onwards.
+
+	The statistics are kept as a row per record of the history's _rolling array, so they are spilled along with it.
+	'''
+
+	# volume sum, max open interest, then the inputs they were computed from: the periods, volume and open interest
+	COLUMNS = 6
+
+	def __init__(self, history):
+		self._history = history
+		self._count = 0  # records with statistics
+		self._volume_period = None
+		self._volume_sum = 0.0
+		self._volume_error = 0.0  # compensation for rounding error in _volume_sum
+		self._oi_period = None
+		self._oi_deque = deque()  # indices of records in the open interest window, open interest decreasing
+
+	def volume_sum(self, n):
+		'''
+		Sum of traded volume over record n's valuation_period
+		'''
+		self._catch_up(n)
+		return float(self._history._rolling[n, 0])
+
+	def max_open_interest(self, n):
+		'''
+		Maximum open interest over record n's stake_target_period
+		'''
+		self._catch_up(n)
+		return float(self._history._rolling[n, 1])
+
+	def reset(self, n):
+		'''
+		Forget the statistics for record n and every later record, whose windows may include it
+		'''
+		if n < self._count:
+			self._count = n
+			self._volume_period = self._oi_period = None  # re-seed on the next push
+
+	def check(self, n):
+		'''
+		Reset from record n if its inputs have changed since its statistics were computed
+		'''
+		if n < self._count and tuple(self._history._rolling[n, 2:]) != self._key(n):
+			self.reset(n)
+
+	def _key(self, n):
+		c = self._history._columns
+		return (c['valuation_period'][n], c['stake_target_period'][n], c['traded_volume'][n], c['open_interest'][n])
+
+	def _catch_up(self, n):
+		while self._count <= n:
+			self._push(self._count)
+
+	def _push(self, n):
+		volume = self._history.column('traded_volume')
+		open_interest = self._history.column('open_interest')
+		key = self._key(n)
+		(volume_period, oi_period, _, _) = key
+
+		if volume_period == self._volume_period:
+			self._add_volume(volume[n])
+			if n - volume_period >= 0:
+				self._add_volume(-volume[n - volume_period])
+		else:
+			self._volume_period = volume_period
+			self._volume_sum = float(sum(volume[max(0, n - volume_period + 1):n + 1]))
+			self._volume_error = 0.0
+
+		oi = self._oi_deque
+		if oi_period == self._oi_period:
+			start = n
+		else:
+			self._oi_period = oi_period
+			oi.clear()
+			start = max(0, n - oi_period + 1)
+		for i in range(start, n + 1):
+			while oi and open_interest[oi[-1]] <= open_interest[i]:
+				oi.pop()
+			oi.append(i)
+		while oi[0] <= n - oi_period:
+			oi.popleft()
+
+		self._history._rolling[n] = (self._volume_sum + self._volume_error, open_interest[oi[0]], *key)
+		self._count = n + 1
+
+	def _add_volume(self, x):
+		# Neumaier's compensated summation: the low-order bits lost adding x to the running sum are kept in
+		# _volume_error, so large volumes leaving the window don't leave their rounding error in the sums after them
+		x = float(x)
+		total = self._volume_sum + x
+		if abs(self._volume_sum) >= abs(x):
+			self._volume_error += (self._volume_sum - total) + x
+		else:
+			self._volume_error += (x - total) + self._volume_sum
+		self._volume_sum = total
@@ -0,0 +1,171 @@
+import cProfile
+import functools
+import sys
+import time
+from contextlib import contextmanager
+
+from prelude import *
+from . import risk, liquidity_provider, history, export, market
+
+# What profile instruments: (class or module, subsystem, attribute names). Each is timed as '<subsystem>.<attribute>';
+# Market aggregates are timed when computed, not when read back from the cache.
+TARGETS = [
+	(risk.RiskModel, 'RiskModel', ('RiskFactorLong', 'RiskFactorShort', 'ProbOfTrading', 'ProbsOfTrading')),
+	(risk, 'RiskModel', ('_risk_factors', )),
+	(market.Market, 'Market', (
+		'next', 'valuation', 'total_stake', 'total_margin', 'lp_margins', 'total_equity', 'target_stake', 'fee_rate',
+		'fee_index', 'fees_collected', 'annualised_return', 'annualised_return_on_capital',
+		'to_csv', 'to_parquet', 'to_data_frame')),
+	(liquidity_provider.LiquidityProvider, 'LiquidityProvider', (
+		'margin', 'obligation', 'equity', 'equity_share', 'stake_share', 'fee_revenue', 'annualised_return')),
+	(liquidity_provider, 'book', ('margins', 'implied_volumes', 'ladder')),
+	(history.History, 'History', ('append', 'advance', 'store', 'store_lp', '_materialise')),
+	(export, 'export', ('export_columns', 'write_csv', 'write_parquet')),
+]
+
+_active = None
+
+
+class Profile:
+	'''
+	Call counts and times of the instrumented functions over one profile() run, in seconds. cumulative includes
+	time spent in other instrumented functions called from it, self_time does not.
+	'''
+
+	def __init__(self):
+		self.calls = {}
+		self.cumulative = {}
+		self.self_time = {}
+		self.folded = {}  # stack of names -> self time, for flame graphs
+		self._stack = []  # [name, start, time in callees] for each call in progress
+		self._depth = {}
+
+	def stats(self):
+		'''
+		One dict per instrumented function that was called, slowest (by self time) first
+		'''
+		return sorted(
+			[{'name': name, 'calls': calls, 'cumulative': self.cumulative[name], 'self_time': self.self_time[name],
+			  'per_call': self.cumulative[name] / calls} for (name, calls) in self.calls.items()],
+			key=lambda s: -s['self_time'])
+
+	def subsystems(self):
+		'''
+		Self time by subsystem (RiskModel, Market, ...), which adds up to the time spent in instrumented code
+		'''
+		totals = {}
+		for (name, t) in self.self_time.items():
+			subsystem = name.split('.')[0]
+			totals[subsystem] = totals.get(subsystem, 0.0) + t
+		return dict(sorted(totals.items(), key=lambda item: -item[1]))
+
+	def report(self, top=None):
+		lines = [f"{'subsystem':<48} {'self s':>10}"]
+		lines += [f'{subsystem:<48} {t:>10.4f}' for (subsystem, t) in self.subsystems().items()]
+		lines += ['', f"{'function':<48} {'calls':>10} {'cumul. s':>10} {'self s':>10} {'per call ms':>12}"]
+		for s in self.stats()[:top]:
+			lines.append(
+				f"{s['name']:<48} {s['calls']:>10} {s['cumulative']:>10.4f} {s['self_time']:>10.4f} "
+				f"{s['per_call'] * 1e3:>12.4f}")
+		return '\n'.join(lines)
+
+	def write_folded(self, path):
+		'''
+		Write self times in the folded stack format ('a;b;c microseconds' per line) read by flamegraph.pl, speedscope
+		and similar tools
+		'''
+		with open(path, 'w') as f:
+			for (stack, t) in self.folded.items():
+				f.write(f"{';'.join(stack)} {int(round(t * 1e6))}\n")
+
+	def _enter(self, name):
+		self._stack.append([name, time.perf_counter(), 0.0])
+		self._depth[name] = self._depth.get(name, 0) + 1
+
+	def _exit(self, name):
+		(_, start, callees) = self._stack[-1]
+		elapsed = time.perf_counter() - start
+		stack = tuple(frame[0] for frame in self._stack)
+		self._stack.pop()
+		self._depth[name] -= 1
+		self.calls[name] = self.calls.get(name, 0) + 1
+		if self._depth[name] == 0:
+			# count recursive calls' time once, at the outermost call
+			self.cumulative[name] = self.cumulative.get(name, 0.0) + elapsed
+		else:
+			self.cumulative.setdefault(name, 0.0)
+		self.self_time[name] = self.self_time.get(name, 0.0) + elapsed - callees
+		self.folded[stack] = self.folded.get(stack, 0.0) + elapsed - callees
+		if self._stack:
+			self._stack[-1][2] += elapsed
+
+
+@contextmanager
+def profile(dump=None):
+	'''
+	Instrument the simulation engine for the duration of a with block and yield the Profile it fills in, e.g.
+
+		with profile() as p:
+			m = m.next(...)
+		print(p.report())
+
+	Outside a profile block the engine runs its own, unwrapped functions, so instrumentation costs nothing when it
+	is not in use. With dump, a cProfile of the block is also saved to that path, for pstats, snakeviz or
+	flameprof; Profile.write_folded gives flame graph input for the instrumented functions alone.
+	'''
+	global _active
+	if _active is not None:
+		raise RuntimeError('A profile is already running.')
+	p = Profile()
+	patches = []
+	profiler = cProfile.Profile() if dump is not None else None
+	_active = p
+	try:
+		_install(p, patches)
+		if profiler is not None:
+			profiler.enable()
+		yield p
+	finally:
+		if profiler is not None:
+			profiler.disable()
+			profiler.dump_stats(dump)
+		for (owner, attr, original) in reversed(patches):
+			setattr(owner, attr, original)
+		_active = None
+
+
+def _install(p, patches):
+	for (owner, subsystem, attrs) in TARGETS:
+		for attr in attrs:
+			if isinstance(owner, type):
+				original = owner.__dict__[attr]
+				setattr(owner, attr, _wrap_member(p, f'{subsystem}.{attr}', original))
+				patches.append((owner, attr, original))
+				continue
+			original = getattr(owner, attr)
+			wrapped = _timed(p, f'{subsystem}.{attr}', original)
+			# a module function is also bound in every module that star-imported it
+			for module in list(sys.modules.values()):
+				if getattr(module, '__name__', '').startswith(__package__) and module.__dict__.get(attr) is original:
+					setattr(module, attr, wrapped)
+					patches.append((module, attr, original))
+
+
+def _wrap_member(p, name, member):
+	if isinstance(member, property):
+		compute = getattr(member.fget, 'aggregate', None)
+		if compute is not None:
+			return market.aggregate(_timed(p, name, compute))
+		return property(_timed(p, name, member.fget), member.fset, member.fdel, member.__doc__)
+	return _timed(p, name, member)
+
+
+def _timed(p, name, fn):
+	@functools.wraps(fn)
+	def timed(*args, **kwargs):
+		p._enter(name)
+		try:
+			return fn(*args, **kwargs)
+		finally:
+			p._exit(name)
+	return timed
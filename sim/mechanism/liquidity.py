@@ -1,7 +1,7 @@
 from prelude import *
 
 
-class Liquidity(Data):
+class Liquidity(Data, slots=True):
 	'''
 	Liquidity engine
 	'''
@@ -16,4 +16,26 @@ class Liquidity(Data):
 	stake_target_period: int = 7
 
 	# valuation_period: [netowrk] take SUM of traded volume over this period when calculating "valuation"
-	valuation_period: int = 1
\ No newline at end of file
+	valuation_period: int = 1
+
+	# the market record these parameters belong to, told when they change
+	_market: Optional['Market'] = field(default=None, init=False, repr=False, compare=False)
+
+	def __setattr__(self, name, value):
+		object.__setattr__(self, name, value)
+		# a change to a record's parameters changes its aggregates
+		market = getattr(self, '_market', None)
+		if market is not None and name != '_market' and market.liquidity is self:
+			market.invalidate()
+
+	def __reduce__(self):
+		# pickled as the parameters alone, without the record
+		return (Liquidity, (self.v, self.k, self.stake_target_period, self.valuation_period))
+
+	def _owned_by(self, m):
+		'''
+		These parameters as m's own: self if no other record has them, else a copy
+		'''
+		liquidity = self if self._market is None or self._market is m else clone(self)
+		set_fields(liquidity, _market=m)
+		return liquidity
@@ -1,5 +1,5 @@
 import numpy as np
-from scipy.stats import norm
+from functools import lru_cache
 
 from prelude import *
 from .risk import *
@@ -21,8 +21,152 @@ import mechanism.market
 # To avoid division by zero errors
 PROB_TO_L = 1e-10
 
+# Number of (book, risk model) combinations whose price ladders are kept, see ladder()
+LADDER_CACHE_SIZE = 4096
 
-class LiquidityProvider(Data):
+
+def normalise_fractions(liquidity_fractions):
+    '''
+    Scale liquidity fractions to sum to one along the last axis, i.e. over the ticks of each shape
+    '''
+    normFactor = np.sum(liquidity_fractions, axis=-1, keepdims=True)
+    if (normFactor <= 0.0).any():
+        raise ValueError(
+            "liquidity_fractions must have non-negative entries with at least one strictly positive")
+    return (1.0 / normFactor) * liquidity_fractions
+
+
+def implied_volumes(obligations, limit_orders, liquidity_fractions, price_levels, prob_of_trading):
+    '''
+    Vectorised get_volume_meeting_obligation_from_shape over an (LP x tick) matrix: row i is the pegged volume needed
+    at each tick for LP i to meet obligations[i] on top of its limit orders, spread by its liquidity fractions. Ticks
+    too unlikely to trade (see PROB_TO_L) get zero volume. Leading axes broadcast, e.g. (record x LP x tick) for the
+    same LPs on several books (see record_margins).
+    '''
+    limit_orders = np.atleast_2d(limit_orders)
+    vol_shape = normalise_fractions(np.atleast_2d(liquidity_fractions))
+
+    limitOrderLiquidity = np.sum(limit_orders * price_levels * prob_of_trading, axis=-1)
+    remainingObligation = np.maximum(obligations - limitOrderLiquidity, 0.0)
+    tradeable = prob_of_trading > PROB_TO_L
+    with np.errstate(divide='ignore', invalid='ignore'):
+        impliedVolume = remainingObligation[..., None] * vol_shape / prob_of_trading / price_levels
+    return np.ceil(np.where(tradeable, impliedVolume, 0.0))
+
+
+def margins(market: 'Market', lps: List['LiquidityProvider']):
+    '''
+    Margin for each of lps on market's current book. The pegged volumes for every LP with a shape on a side are solved
+    as one (LP x tick) matrix, so the cost is a handful of array operations per side however many LPs there are.
+    '''
+    total = np.zeros(len(lps))
+    for (side, is_sell_side) in (('sell_side_shape', True), ('buy_side_shape', False)):
+        rows = [i for (i, lp) in enumerate(lps) if getattr(lp, side) != None]
+        if not rows:
+            continue
+        shapes = [getattr(lps[i], side) for i in rows]
+        # every LP's levels placed on the union of the levels in use, zero volume and fraction where it has none
+        ticks = np.unique(np.concatenate([shape.ticks for shape in shapes]))
+        limit_orders = np.zeros((len(rows), len(ticks)))
+        liquidity_fractions = np.zeros((len(rows), len(ticks)))
+        for (row, shape) in enumerate(shapes):
+            columns = np.searchsorted(ticks, shape.ticks)
+            limit_orders[row, columns] = shape.limit_orders
+            liquidity_fractions[row, columns] = shape.liquidity_fractions
+        mid = market.mark_price
+        book = ladder(mid, market.tick_size, ticks, market.risk_model, is_sell_side)
+        volumes = implied_volumes(
+            np.array([lps[i].obligation for i in rows]),
+            limit_orders, liquidity_fractions, book.prices, book.prob_of_trading)
+        riskFactor = market.risk_model.RiskFactorShort() if is_sell_side else market.risk_model.RiskFactorLong()
+        total[rows] += np.sum(riskFactor * mid * volumes, axis=1)
+    return total
+
+
+def record_margins(mid, tick, obligations, shapes, risk_model: RiskModel):
+    '''
+    margins for the same LPs, with the same order shapes, on many records of a market: mid and tick are the records'
+    mark prices and tick sizes, obligations their (record x LP) obligations and shapes each LP's (sell side, buy side)
+    shape. The books are laid out as margins lays out one, so each record's margins are the same, but every record
+    is solved at once as a (record x LP x tick) array. Returns the (record x LP) margins.
+    '''
+    mid = np.asarray(mid, dtype=float)
+    tick = np.asarray(tick, dtype=float)
+    total = np.zeros(np.shape(obligations))
+    for (side, is_sell_side) in ((0, True), (1, False)):
+        rows = [i for (i, lp_shapes) in enumerate(shapes) if lp_shapes[side] != None]
+        if not rows:
+            continue
+        side_shapes = [shapes[i][side] for i in rows]
+        ticks = np.unique(np.concatenate([shape.ticks for shape in side_shapes]))
+        limit_orders = np.zeros((len(rows), len(ticks)))
+        liquidity_fractions = np.zeros((len(rows), len(ticks)))
+        for (row, shape) in enumerate(side_shapes):
+            columns = np.searchsorted(ticks, shape.ticks)
+            limit_orders[row, columns] = shape.limit_orders
+            liquidity_fractions[row, columns] = shape.liquidity_fractions
+        # price_ladder and ladder for every record at once
+        if (tick <= 0).any() or (not is_sell_side and (mid - tick * ticks[-1] <= 0).any()):
+            raise ValueError(
+                "Invalid book params, or negative prices: choose higher mid or smaller tick or fewer ticks.")
+        prices = mid[:, None] + ((1 if is_sell_side else -1) * tick)[:, None] * ticks
+        prob_of_trading = risk_model.ProbsOfTrading(mid[:, None], prices)
+        volumes = implied_volumes(
+            np.asarray(obligations)[:, rows], limit_orders, liquidity_fractions, prices[:, None, :],
+            prob_of_trading[:, None, :])
+        riskFactor = risk_model.RiskFactorShort() if is_sell_side else risk_model.RiskFactorLong()
+        total[:, rows] += np.sum((riskFactor * mid)[:, None, None] * volumes, axis=-1)
+    return total
+
+
+def price_ladder(mid, tick, ticks, is_sell_side=True):
+    '''
+    The price levels of one side of the book, ticks (a count for every tick up to that depth, or the sorted tick
+    offsets from mid of a sparse book) away from mid: above it for offers and below it for bids.
+    '''
+    ticks = _ticks(ticks)
+    if (tick <= 0 or len(ticks) == 0 or ticks[0] <= 0):
+        raise ValueError("Invalid book params.")
+
+    if (not is_sell_side and mid - tick * ticks[-1] <= 0):
+        raise ValueError(
+            "Cannot handle negative prices, choose higher mid or smaller tick or fewer ticks.")
+
+    return mid + (1 if is_sell_side else -1) * tick * ticks
+
+
+Ladder = namedtuple('Ladder', ['prices', 'prob_of_trading'])
+
+
+def ladder(mid, tick, ticks, risk_model: RiskModel, is_sell_side=True):
+    '''
+    The price levels of one side of the book (see price_ladder) and their probabilities of trading, as read-only
+    arrays. Ladders are shared through an LRU cache keyed by the book and risk model parameters, so every shape and LP
+    on the same book reuses one; see ladder_cache_info for hit and miss counts.
+    '''
+    return _ladder(
+        float(mid), float(tick), tuple(_ticks(ticks).tolist()), bool(is_sell_side),
+        risk_model.mu, risk_model.sigma, risk_model.tau, risk_model.lambd, risk_model.normal)
+
+
+@lru_cache(maxsize=LADDER_CACHE_SIZE)
+def _ladder(mid, tick, ticks, is_sell_side, mu, sigma, tau, lambd, normal):
+    prices = price_ladder(mid, tick, ticks, is_sell_side)
+    probOfTrading = RiskModel(mu=mu, sigma=sigma, tau=tau, lambd=lambd, normal=normal).ProbsOfTrading(mid, prices)
+    prices.flags.writeable = False
+    probOfTrading.flags.writeable = False
+    return Ladder(prices, probOfTrading)
+
+
+def _ticks(ticks):
+    return np.arange(1, ticks + 1) if np.ndim(ticks) == 0 else np.asarray(ticks, dtype=int)
+
+
+ladder_cache_info = _ladder.cache_info
+ladder_cache_clear = _ladder.cache_clear
+
+
+class LiquidityProvider(Data, slots=True):
     '''
     A liquidity provider's commitment and fee bid. Also calculates returns from liquidity rewards.
     '''
@@ -37,27 +181,32 @@ class LiquidityProvider(Data):
 
     def __post_init__(self):
         self.entry_valuation = self.market.valuation  # TODO: update valuation
-        self.market._lps[self.name] = self
+        self.market.add_lp(self)
         if self.sell_side_shape != None and self.sell_side_shape.is_sell_side == False:
             raise ValueError("Sell side should have 'is_sell_side'=True")
-        if self.sell_side_shape != None and self.buy_side_shape.is_sell_side == True:
+        if self.buy_side_shape != None and self.buy_side_shape.is_sell_side == True:
             raise ValueError("Buy side should have 'is_sell_side'=False")
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        # a change to a registered LP changes its market's aggregates
+        market = getattr(self, 'market', None)
+        if market is not None and market._lps.get(getattr(self, 'name', None)) is self:
+            market._lp_changed(self)
+
+    def _store(self):
+        history = self.market._history
+        if history.holds(self.market):
+            history.store_lp(self.market, self)
+            history.clear_caches(self.market._n)
+        else:
+            self.market._cache.clear()
+
     @property
     def margin(self):
-        if self.sell_side_shape != None:
-            sellShapeWithCurrentMarket = replace(
-                self.sell_side_shape, market=self.market)
-            sellVolArray = self.get_volume_meeting_obligation_from_shape(
-                sellShapeWithCurrentMarket)
-        if self.buy_side_shape != None:
-            buyShapeWithCurrentMarket = replace(
-                self.buy_side_shape, market=self.market)
-            buyVolArray = self.get_volume_meeting_obligation_from_shape(
-                buyShapeWithCurrentMarket)
-        return (sellShapeWithCurrentMarket.CalculateMargin(sellVolArray) if self.sell_side_shape != None else 0) + \
-               (buyShapeWithCurrentMarket.CalculateMargin(
-                   buyVolArray) if self.buy_side_shape != None else 0)
+        if self.market._lps.get(self.name) is self:
+            return self.market.lp_margins[self.name]
+        return margins(self.market, [self])[0]
 
     @property
     def obligation(self):
@@ -89,32 +238,12 @@ class LiquidityProvider(Data):
         return (365 * self.fee_revenue) / self.stake
 
     def get_volume_meeting_obligation_from_shape(self, orderSet: 'OrderSetForSide'):
-        limitOrderLiquidity = orderSet.CalculateLimitOrderLiquidity()
-        remainingObligation = max(
-            self.obligation - limitOrderLiquidity, 0.0)
-        vol_shape = self._normalise_fractions(orderSet.liquidity_fractions)
-
-        impliedVolume = np.empty_like(vol_shape)
-        for bookIdx in range(0, self.market.num_ticks):
-            priceLevel = orderSet.priceList[bookIdx]
-            probTrading = self.market.risk_model.ProbOfTrading(
-                orderSet.mid, priceLevel)
-            if probTrading > PROB_TO_L:
-                impliedVolume[bookIdx] = remainingObligation * \
-                    vol_shape[bookIdx] / probTrading / priceLevel
-
-        return np.ceil(impliedVolume)
-
-    def _normalise_fractions(self, liquidity_fractions):
-        normFactor = np.sum(liquidity_fractions)
-        if (normFactor <= 0.0):
-            raise ValueError(
-                "liquidity_fractions must have non-negative entries with at least one strictly positive")
-        vol_shape = (1.0 / normFactor) * liquidity_fractions
-        return vol_shape
+        book = ladder(orderSet.mid, orderSet.tick, orderSet.ticks, self.market.risk_model, orderSet.is_sell_side)
+        return implied_volumes(
+            self.obligation, orderSet.limit_orders, orderSet.liquidity_fractions, book.prices, book.prob_of_trading)[0]
 
     def check_if_volume_meets_obligation(self, orderVolArray: np.array, orderSet: 'OrderSetForSide'):
-        if np.shape(orderVolArray) != (self.market.num_ticks, ):
+        if np.shape(orderVolArray) != (orderSet.num_ticks, ):
             raise ValueError(
                 "limitOrders array must have length equal to number of ticks on the book side.")
 
@@ -130,11 +259,18 @@ class LiquidityProvider(Data):
         return f'{self.name}(stake={self.stake}, equity={self.equity_share:.1%}, fee_bid={self.fee_bid})'
 
 
-class OrderSetForSide(Data):
+class OrderSetForSide(Data, slots=True):
+    '''
+    One side of a liquidity provider's book: limit order volumes and pegged order liquidity fractions at each of its
+    price levels. Levels are given as tick offsets from mid, sorted and strictly positive, and may be sparse and of any
+    depth, e.g. ticks=[1, 5, 200]. Without ticks the book is dense over the market's num_ticks levels. Offers sit above
+    mid and bids below it.
+    '''
     market: 'Market'
     is_sell_side: bool
     limit_orders: np.array
     liquidity_fractions: np.array
+    ticks: Optional[np.array] = None
 
     @property
     def mid(self):
@@ -146,22 +282,36 @@ class OrderSetForSide(Data):
 
     @property
     def num_ticks(self):
-        return self.market.num_ticks
+        '''
+        Number of price levels on this side
+        '''
+        return len(self.ticks)
 
-    def __post_init__(self):
-        if (self.tick <= 0 or self.num_ticks <= 0):
-            raise ValueError("Invalid book params.")
+    @property
+    def priceList(self):
+        return self.ladder.prices
 
-        if (self.mid - self.tick * self.num_ticks <= 0):
-            raise ValueError(
-                "Cannot handle negative prices, choose higher mid or smaller tick or fewer ticks.")
+    @property
+    def ladder(self):
+        return ladder(self.mid, self.tick, self.ticks, self.market.risk_model, self.is_sell_side)
 
+    def __post_init__(self):
         if type(self.limit_orders) != np.ndarray:
             self.limit_orders = np.array(self.limit_orders)
 
         if type(self.liquidity_fractions) != np.ndarray:
             self.liquidity_fractions = np.array(self.liquidity_fractions)
 
+        if self.ticks is None:
+            if np.shape(self.limit_orders) != (self.market.num_ticks, ):
+                raise ValueError(
+                    "limit_orders array must have length equal to number of ticks on the book side.")
+            self.ticks = np.arange(1, self.market.num_ticks + 1)
+        else:
+            self.ticks = np.array(self.ticks, dtype=int)
+            if self.ticks.ndim != 1 or (np.diff(self.ticks) <= 0).any():
+                raise ValueError("ticks must be strictly increasing tick offsets from mid.")
+
         if np.shape(self.limit_orders) != (self.num_ticks, ):
             raise ValueError(
                 "limit_orders array must have length equal to number of ticks on the book side.")
@@ -170,21 +320,14 @@ class OrderSetForSide(Data):
             raise ValueError(
                 "liquidity_fractions array must have length equal to number of ticks on the book side.")
 
-        self.priceList = np.linspace(
-            self.mid + self.tick, self.mid + self.tick * self.num_ticks, self.num_ticks)
+        self.ladder  # validates the book
 
     def CalculateLiquidity(self, volArray: np.array):
         if np.shape(volArray) != (self.num_ticks, ):
             raise ValueError(
                 "Volume array must have length equal to number of ticks on the book side.")
-        liquidity = 0.0
-        for orderIdx in range(0, self.num_ticks):
-            priceLevel = self.priceList[orderIdx]
-            probOfTrading = self.market.risk_model.ProbOfTrading(
-                self.mid, priceLevel)
-            volumeAtLevel = volArray[orderIdx]
-            liquidity = liquidity + volumeAtLevel * priceLevel * probOfTrading
-        return liquidity
+        book = self.ladder
+        return np.sum(volArray * book.prices * book.prob_of_trading)
 
     def CalculateLimitOrderLiquidity(self):
         return self.CalculateLiquidity(self.limit_orders)
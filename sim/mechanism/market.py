@@ -1,12 +1,30 @@
-import pandas as pd
-
 from prelude import *
 from .risk import *
 from .liquidity_provider import *
 from .liquidity import *
+from .history import *
+from .fees import *
+from .events import *
+from .export import *
 
 
-class Market(Data):
+def aggregate(fn):
+    '''
+    A read-only Market property computed at most once per record. The value is kept in the record's cache until the
+    record, one of its LPs or an earlier record in its window changes (see Market.invalidate).
+    '''
+    name = fn.__name__
+
+    def get(self):
+        cache = self._cache
+        if name not in cache:
+            cache[name] = fn(self)
+        return cache[name]
+    get.aggregate = fn  # the computation itself, e.g. for instrument.profile to time
+    return property(get, doc=fn.__doc__)
+
+
+class Market(Data, slots=True):
     '''
 
     '''
@@ -17,7 +35,7 @@ class Market(Data):
     risk_model: RiskModel = default_factory(RiskModel)
 
     # Market data
-    num_ticks: int = 10  #TODO: not have this fixed num_ticks thing
+    num_ticks: int = 10  # depth of order shapes given without explicit ticks
     tick_size: float = 1
     mark_price: float = 0
     traded_volume: float = 0
@@ -28,14 +46,35 @@ class Market(Data):
 
     # implementation details
     _n: int = 0  # used to record a record's place in history
-    _history: List['Market'] = field(default_factory=list, repr=False)
+    _history: History = field(default_factory=History, repr=False)
+    _cache: Dict[str, float] = field(default_factory=dict, init=False, repr=False, compare=False)
+    _fees: Optional[FeeIndex] = field(default=None, init=False, repr=False, compare=False)
 
     def __post_init__(self):
         if not self._history:
             # initialise history when creating a new market
-            self._history = [self]
+            self._history.append(self)
 
-    @property
+    def __setattr__(self, name, value):
+        if name == 'liquidity':
+            value = value._owned_by(self)  # each record has its own, which reports changes back to it
+        object.__setattr__(self, name, value)
+        if name not in ('_cache', '_fees'):
+            self.invalidate()
+
+    def invalidate(self):
+        '''
+        Write this record back to the history and drop cached aggregates for it and every later record, whose windows
+        may include it. Called whenever a field, an LP or the record's liquidity parameters change (a change to the
+        risk model, which the records of a market share, goes to History.risk_model_changed).
+        '''
+        history = getattr(self, '_history', None)
+        if history is None or not history.holds(self):
+            return  # still being constructed
+        history.store(self)
+        history.clear_caches(self._n)
+
+    @aggregate
     def valuation(self):
         '''
         This is the market's "valuation" for stake commitment, min of traded volume over a window and total stake
@@ -43,24 +82,42 @@ class Market(Data):
         period = self.liquidity.valuation_period
         # factor scales the valuation when the window is short to avoid artificial "growth" at the start of a market
         factor = float(period) / float(self._n + 1 - max(0, self._n - period + 1))
-        return max(factor * sum(self._window(period, 'traded_volume')), self.total_stake)
+        if self._history.holds(self):
+            volume = self._history.rolling.volume_sum(self._n)
+        else:
+            volume = sum(self._window(period, 'traded_volume'))
+        return max(factor * volume, self.total_stake)
 
-    @property
+    @aggregate
     def total_stake(self):
-        return sum(lp.stake for lp in self.lps)
+        return sum(self._history.lp_values('stake', self._n))
 
-    @property
+    @aggregate
     def total_margin(self):
-        return sum(lp.margin for lp in self.lps)
+        return sum(self.lp_margins.values())
 
-    @property
+    @aggregate
+    def lp_margins(self):
+        '''
+        Margin of every liquidity provider by name, solved for all of them at once
+        '''
+        lps = list(self.lps)
+        return dict(zip([lp.name for lp in lps], margins(self, lps).tolist()))
+
+    @aggregate
     def total_equity(self):
-        return sum(lp.equity for lp in self.lps)
+        # LiquidityProvider.equity for every LP, without materialising them
+        valuation = self.valuation
+        return sum((valuation / entry_valuation) * stake for (entry_valuation, stake) in zip(
+            self._history.lp_values('entry_valuation', self._n), self._history.lp_values('stake', self._n)))
 
-    @property
+    @aggregate
     def target_stake(self):
-        max_oi = max(self._window(
-            self.liquidity.stake_target_period, 'open_interest'))
+        if self._history.holds(self):
+            max_oi = self._history.rolling.max_open_interest(self._n)
+        else:
+            max_oi = max(self._window(
+                self.liquidity.stake_target_period, 'open_interest'))
         v = self.liquidity.v
         rf = self.risk_model.RiskFactorShort()
         return max_oi * v * rf
@@ -84,20 +141,25 @@ class Market(Data):
         return (365 * self.fees_collected) / cost_base if cost_base > 0 else 0
 
 
-    @property
+    @aggregate
     def fee_rate(self):
         '''
         Fee rate is calculated by sorting all committed liquditiy providers by their fee bid (lowest to highest), then
         working down the list until the total cumulative stake >= the stake target. The fee bid from the last liquidity
         provider needed to take the cumulative stake to the target is the liquidity fee rate for the market.
         '''
-        bids = sorted(list(self.lps), key=attr('fee_bid'))
-        stake_covered = 0
-        for bid in bids:
-            stake_covered += bid.stake
-            if stake_covered >= self.target_stake:
-                return bid.fee_bid
-        return bids[-1].fee_bid if len(bids) > 0 else 0
+        return self.fee_index.fee_rate(self.target_stake)
+
+    @property
+    def fee_index(self):
+        '''
+        This record's LPs in fee bid order with their cumulative stake, built on first use and then kept up to date
+        '''
+        if self._fees is None:
+            self._fees = FeeIndex()
+            for lp in self.lps:
+                self._fees.set(lp.name, lp.stake, lp.fee_bid)
+        return self._fees
 
     @property
     def fees_collected(self):
@@ -107,8 +169,10 @@ class Market(Data):
         '''
         Return a list of the value of field over up to period previous records from the history
         '''
-        records = self._history[max(0, self._n - period + 1):self._n + 1]
-        return [r if attr == None else getattr(r, attr) for r in records]
+        start = max(0, self._n - period + 1)
+        if attr == None:
+            return self._history[start:self._n + 1]
+        return list(self._history.column(attr)[start:self._n + 1])
 
     @property
     def lps(self):
@@ -120,26 +184,118 @@ class Market(Data):
         else:
             return default
 
+    def add_lp(self, lp: 'LiquidityProvider'):
+        '''
+        Commit lp to this record, replacing any LP of the same name. LiquidityProvider does this when created.
+        '''
+        if lp.market is not self:
+            raise ValueError(f"LP '{lp.name}' belongs to another market record.")
+        self._lps[lp.name] = lp
+        self._lp_changed(lp)
+        return lp
+
+    def amend_lp(self, name, **changes):
+        '''
+        Change fields of the LP called name, e.g. amend_lp('A', stake=2000, fee_bid=0.001)
+        '''
+        lp = self._lps[name]
+        for (field_name, value) in changes.items():
+            setattr(lp, field_name, value)
+        return lp
+
+    def remove_lp(self, name):
+        '''
+        Take the LP called name off this record. Returns the LP. Like add_lp and amend_lp this changes only this
+        record: on the latest record it cancels the commitment from here on, as the records after it are made by next,
+        but on an earlier one the records after it keep the LP (use cancel to schedule a cancellation instead).
+        '''
+        lp = self._lps.pop(name)
+        if self._fees is not None:
+            self._fees.remove(name)
+        self._history.clear_caches(self._n)
+        return lp
+
+    def commit(self, name, stake, fee_bid=0.0, sell_side_shape=None, buy_side_shape=None, step=None):
+        '''
+        A new LP commitment from record step on (default: the latest record). Returns the Event.
+        '''
+        return self._submit(Event(step, 'commit', name, dict(
+            stake=stake, fee_bid=fee_bid, sell_side_shape=sell_side_shape, buy_side_shape=buy_side_shape)))
+
+    def amend_stake(self, name, stake, step=None):
+        return self._submit(Event(step, 'amend_stake', name, dict(stake=stake)))
+
+    def amend_fee_bid(self, name, fee_bid, step=None):
+        return self._submit(Event(step, 'amend_fee_bid', name, dict(fee_bid=fee_bid)))
+
+    def cancel(self, name, step=None):
+        return self._submit(Event(step, 'cancel', name, {}))
+
+    def _submit(self, event):
+        '''
+        Apply an event to the latest record if it is due there or earlier, else queue it for Market.next. Amending or
+        cancelling an LP that won't exist at the event's step raises KeyError.
+        '''
+        latest = self._history[-1]
+        if event.step is None or event.step <= latest._n:
+            event = event._replace(step=latest._n)
+            check_events(latest._lps, [event])
+            latest._apply(event)
+        else:
+            # the LPs at its step are those of the latest record, changed by the events queued before it
+            check_events(latest._lps, [*self._history.events.upto(event.step), event])
+            self._history.events.push(event)
+        return event
+
+    def _apply(self, event):
+        if event.kind == 'commit':
+            LiquidityProvider(market=self, name=event.name, **event.values)
+        elif event.kind == 'cancel':
+            self.remove_lp(event.name)
+        else:
+            self.amend_lp(event.name, **event.values)
+        self._history.events.applied.append(event)
+
+    def _lp_changed(self, lp):
+        # called for every change to one of this record's LPs
+        if self._fees is not None:
+            self._fees.set(lp.name, lp.stake, lp.fee_bid)
+        lp._store()
+
     def next(self, traded_volume=None, open_interest=None, liquidity=None, mark_price=None):
         '''
-        Move time forward a step. Returns a copy of the market record and adds it to the history.
+        Move time forward a step. Returns a copy of the market record and adds it to the history, then applies the
+        events due at the new record and, if one is attached, lets the history's Checkpointer save it.
         '''
-        next_m = replace(
-            self._history[-1],
-            # copy here otherwise all history records share one LP list
-            _lps=self._history[-1]._lps.copy(),
+        latest = self._history[-1]
+        # the events due at the new record are checked against the LPs it carries over before it is added, so an
+        # event that can't be applied leaves the history and the queue as they were
+        n = len(self._history)
+        due = self._history.events.due(n, lambda events: check_events(latest._lps, events))
+        next_m = clone(
+            latest,
+            _lps={},
             traded_volume=traded_volume or self.traded_volume,
             open_interest=open_interest or self.open_interest,
-            liquidity=liquidity or replace(self.liquidity),
+            liquidity=liquidity or clone(self.liquidity, _market=None),
             mark_price=mark_price or self.mark_price,
-            _n=len(self._history))
-
-        for lp in next_m.lps:
-            # oint at correct history entry
-            next_m._lps[lp.name] = replace(lp, market=next_m)
-            if lp.name in self._lps: next_m._lps[lp.name].entry_valuation = self._lps[lp.name].entry_valuation
-
-        self._history.append(next_m)
+            _n=n,
+            _cache={},
+            _fees=None)
+        set_fields(next_m, liquidity=next_m.liquidity._owned_by(next_m))
+        # the LPs carry over from the latest record as they are, so only events cost anything per LP
+        self._history.advance(next_m)
+        if latest._fees is not None:
+            next_m._fees = latest._fees.copy()
+        if self is not latest:
+            # stepping on from an older record keeps its LPs' entry valuations
+            for lp in next_m.lps:
+                lp.entry_valuation = self._lps[lp.name].entry_valuation if lp.name in self._lps else next_m.valuation
+
+        for event in due:
+            next_m._apply(event._replace(step=n))
+        if self._history.checkpointer is not None:
+            self._history.checkpointer.step(next_m)
         return next_m
 
     def to_csv(self,
@@ -166,20 +322,44 @@ class Market(Data):
                    'margin',
                    'entry_valuation',
                    'obligation'],
-               output=sys.stdout):
+               output=sys.stdout,
+               chunk_size=CHUNK_SIZE):
         '''
-        Dump the market history to CSV. Creates columns for each liquidity provider's data.
+        Dump the market history to CSV. Creates columns for each liquidity provider's data, left blank where the
+        liquidity provider had no commitment. Rows are written chunk_size records at a time.
         '''
-        lps = list(dict.fromkeys(
-            [lp.name for m in self._history for lp in m.lps]))  # all LPs in history
-        # output CSV header
-        output.write(
-            ','.join([*market_fields, *[f'{lp}_{f}' for lp in lps for f in lp_fields]])+'\n')
-        for m in self._history:
-            market_data = [getattr(m, f) for f in market_fields]
-            lp_data = [m.lp(name=lp, attr=f)
-                       or '' for lp in lps for f in lp_fields]
-            output.write(','.join([str(d) for d in [*market_data, *lp_data]])+'\n')
+        write_csv(self, market_fields, lp_fields, output, chunk_size)
+
+    def to_parquet(self,
+                   path,
+                   market_fields=[
+                       '_n',
+                       'mark_price',
+                       'traded_volume',
+                       'open_interest',
+                       'valuation',
+                       'target_stake',
+                       'total_stake',
+                       'total_margin',
+                       'fee_rate',
+                       'fees_collected',
+                       'annualised_return',
+                       'annualised_return_on_capital',
+                       'total_equity'],
+                   lp_fields=[
+                       'stake',
+                       'equity',
+                       'equity_share',
+                       'fee_revenue',
+                       'annualised_return',
+                       'margin',
+                       'entry_valuation',
+                       'obligation'],
+                   chunk_size=CHUNK_SIZE):
+        '''
+        Dump the market history to a Parquet file, one row group per chunk_size records. Needs pyarrow.
+        '''
+        write_parquet(self, market_fields, lp_fields, path, chunk_size)
 
     def to_data_frame(self,
                       market_fields=[
@@ -201,34 +381,29 @@ class Market(Data):
                           'fee_revenue',
                           'annualised_return',
                           'margin'],
-                      output=print):
+                      output=print,
+                      incremental=False):
         '''
-        Dump the market history to CSV. Creates columns for each liquidity provider's data.
+        Dump the market history to a DataFrame. Creates columns for each liquidity provider's data, NaN where the
+        liquidity provider had no commitment. With incremental=True the history keeps the frame (see
+        IncrementalFrame), and later calls with the same fields only export the records added or changed since;
+        the frame returned is then read-only.
         '''
-        lps = list(dict.fromkeys(
-            [lp.name for m in self._history for lp in m.lps]))  # all LPs in history
-        df = pd.DataFrame(
-            columns=[*market_fields, *[f'{lp}_{f}' for lp in lps for f in lp_fields]])
+        if incremental:
+            return incremental_frame(self, market_fields, lp_fields)
+        import pandas as pd
+        return pd.DataFrame(export_columns(self, market_fields, lp_fields))
 
-        i = 0
-        for m in self._history:
-            market_data = [getattr(m, f) for f in market_fields]
-            lp_data = [m.lp(name=lp, attr=f)
-                       or '' for lp in lps for f in lp_fields]
-            row = [*market_data, *lp_data]
-            df.loc[i] = [tryFloat(d) for d in row]
-            i = i + 1
-        return df
+    def spill_to(self, directory):
+        '''
+        Keep this market's history in memory-mapped files in directory from now on, for runs too long to hold in
+        memory; see History.spill_to
+        '''
+        self._history.spill_to(directory)
+        return self
 
     def __getitem__(self, key):
         return self._history[key]
 
     def __invert__(self):
         return self._history[-1]
-
-
-def tryFloat(s):
-    try:
-        return float(s)
-    except:
-        return 0
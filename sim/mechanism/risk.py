@@ -1,11 +1,41 @@
 import sys; sys.path.append('../')
 from prelude import *
 
+import os
+import weakref
 import numpy as np
-from scipy.stats import norm
+from functools import lru_cache
+from .normal import BACKENDS, distribution
 
+# The normal distribution backend RiskModels use unless given one, see normal.py. 'numpy' avoids importing scipy.
+NORMAL_BACKEND = os.environ.get('MLP_NORMAL_BACKEND', 'scipy')
 
-class RiskModel(Data):
+
+RiskFactors = namedtuple('RiskFactors', ['long', 'short', 'quantile_lambda', 'quantile_one_minus_lambda'])
+
+
+@lru_cache(maxsize=1024)
+def _risk_factors(mu, sigma, tau, lambd, backend='scipy'):
+    '''
+    Risk factors depend only on the model parameters, so they are computed once per parameter set and shared by every
+    RiskModel (and so every Market record) with those parameters. Changing a parameter simply changes the cache key.
+    '''
+    norm = distribution(backend)
+    sigmaBar = np.sqrt(tau) * sigma
+    muBar = (mu - 0.5*sigma*sigma) * tau
+    quantileForLambda = norm.ppf(lambd)
+    quantileForOneMinusLambda = norm.ppf(1.0 - lambd)
+    scale = (1/lambd)*np.exp(muBar*sigmaBar*sigmaBar*0.5)
+    logNormalEs = -scale * norm.cdf(quantileForLambda-sigmaBar)
+    negativeLogNormalEs = scale * norm.sf(quantileForOneMinusLambda-sigmaBar)
+    return RiskFactors(
+        long=logNormalEs + 1.0,
+        short=negativeLogNormalEs - 1.0,
+        quantile_lambda=quantileForLambda,
+        quantile_one_minus_lambda=quantileForOneMinusLambda)
+
+
+class RiskModel(Data, slots=True):
     '''
     Risk Model
     '''
@@ -14,34 +44,49 @@ class RiskModel(Data):
     sigma: float = 2.0
     tau: float = 1.0/60/24/365.25
     lambd: float = 0.001
+    normal: Optional[str] = None  # normal distribution backend, 'scipy' or 'numpy', NORMAL_BACKEND if not given
+
+    # the histories of the markets using this model, told when it changes
+    _histories: weakref.WeakSet = field(default_factory=weakref.WeakSet, init=False, repr=False, compare=False)
 
     def __post_init__(self):
         if (self.tau < 0 or self.sigma <= 0 or self.lambd < 0.0 or self.lambd > 1.0):
             raise ValueError(
                 "Time and volatility parameter should be strictly +ve and lambd must be between 0 and 1. ")
+        if self.normal is None:
+            self.normal = NORMAL_BACKEND
+        if self.normal not in BACKENDS:
+            raise ValueError(f"normal must be one of {BACKENDS}.")
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        # a change to a market's risk model changes the aggregates of every record using it
+        if name != '_histories':
+            for history in list(getattr(self, '_histories', ())):
+                history.risk_model_changed(self)
+
+    def __reduce__(self):
+        # pickled as the parameters alone, without the markets using it
+        return (RiskModel, (self.mu, self.sigma, self.tau, self.lambd, self.normal))
 
     def RiskFactorLong(self):
-        sigmaBar = np.sqrt(self.tau) * self.sigma 
-        muBar=(self.mu - 0.5*self.sigma*self.sigma) * self.tau
-        quantileForLambda = norm.ppf(self.lambd)
-        #print("quantileForLambda = " + str(quantileForLambda))
-        logNormalEs = -(1/self.lambd)*np.exp(muBar*sigmaBar*sigmaBar*0.5) * norm.cdf(quantileForLambda-sigmaBar)
-        #print("logNormalEs = " + str(logNormalEs))
-        return logNormalEs + 1.0
+        return _risk_factors(self.mu, self.sigma, self.tau, self.lambd, self.normal).long
 
     def RiskFactorShort(self):
-        sigmaBar = np.sqrt(self.tau) * self.sigma 
-        muBar=(self.mu - 0.5*self.sigma*self.sigma) * self.tau
-        quantileForOneMinusLambda = norm.ppf(1.0 - self.lambd)
-        #print("quantileForOneMinusLambda = " + str(quantileForOneMinusLambda))
-        negativeLogNormalEs = (1/self.lambd)*np.exp(muBar*sigmaBar*sigmaBar*0.5) * (1.0 - norm.cdf(quantileForOneMinusLambda-sigmaBar))
-        #print("negativeLogNormalEs = " + str(negativeLogNormalEs))
-        return negativeLogNormalEs - 1.0
+        return _risk_factors(self.mu, self.sigma, self.tau, self.lambd, self.normal).short
 
     def ProbOfTrading(self, mid: float, level: float):
-        transLevel = (np.log(level/mid) - (self.mu - 0.5*self.sigma*self.sigma)*self.tau) / (self.sigma*np.sqrt(self.tau))
-        #print("transLevel = " + str(transLevel))
-        if (mid < level):
-            return 1.0 - norm.cdf(transLevel)
-        else:
-            return norm.cdf(transLevel)
\ No newline at end of file
+        return float(self.ProbsOfTrading(mid, level))
+
+    def ProbsOfTrading(self, mid, levels, is_sell_side=None):
+        '''
+        Batched ProbOfTrading: mid, levels (and is_sell_side, if given) are broadcast against each other so a whole
+        price ladder, or several ladders at once, is evaluated in a single pass. When is_sell_side is None the side is
+        inferred per level, as in ProbOfTrading (levels above mid use the upper tail).
+        '''
+        mid = np.asarray(mid, dtype=float)
+        levels = np.asarray(levels, dtype=float)
+        transLevel = (np.log(levels/mid) - (self.mu - 0.5*self.sigma*self.sigma)*self.tau) / (self.sigma*np.sqrt(self.tau))
+        upper = mid < levels if is_sell_side is None else np.asarray(is_sell_side, dtype=bool)
+        norm = distribution(self.normal)
+        return np.where(upper, norm.sf(transLevel), norm.cdf(transLevel))
@@ -1,13 +1,55 @@
 import os
+import sys
 from typing import List, Optional, Union, Dict
-from functools import reduce, namedtuple
+from functools import reduce, namedtuple, lru_cache
 from dataclasses import dataclass, field, replace
 from copy import deepcopy
 
 ROOT = (os.path.dirname(__file__) + '/../{}').format
 
-class Data: 
-	def __init_subclass__(cls, **kwargs): return dataclass(cls)
+# dataclass can only add __slots__ with a __weakref__ slot (which History needs for its views) from Python 3.11
+SLOTS = sys.version_info >= (3, 11)
+
+class DataType(type):
+	'''
+	Makes every subclass of Data a dataclass. With slots=True its fields are kept in __slots__ (plus a __weakref__
+	slot) rather than a per-instance __dict__, where the Python version supports it (see SLOTS), and with frozen=True
+	it is immutable.
+	'''
+	def __new__(meta, name, bases, namespace, slots=False, frozen=False, **kwargs):
+		cls = super().__new__(meta, name, bases, namespace, **kwargs)
+		if not bases or '__dataclass_params__' in namespace:
+			return cls  # Data itself, or the class dataclass re-creates to add slots
+		options = {'frozen': True} if frozen else {}
+		if slots and SLOTS:
+			options.update(slots=True, weakref_slot=True)
+		return dataclass(cls, **options)
+
+	def __init__(cls, name, bases, namespace, slots=False, frozen=False, **kwargs):
+		super().__init__(name, bases, namespace, **kwargs)
+
+class Data(metaclass=DataType):
+	__slots__ = ()
+
+@lru_cache(maxsize=None)
+def field_names(cls):
+	return tuple(cls.__dataclass_fields__)
+
+def set_fields(o, **values):
+	'''
+	Set fields of a Data record directly, without going through its __setattr__ (or a frozen record's refusal)
+	'''
+	for (name, value) in values.items():
+		object.__setattr__(o, name, value)
+
+def clone(o, **changes):
+	'''
+	A shallow copy of a Data record with changes. Unlike replace this doesn't call __init__, __post_init__ or
+	__setattr__, and copies init=False fields as they are, so pass those in changes if they must be reset.
+	'''
+	copy = object.__new__(type(o))
+	set_fields(copy, **{name: getattr(o, name) for name in field_names(type(o)) if name not in changes}, **changes)
+	return copy
 
 def default_factory(x, init=True, repr=True):
 	return field(default_factory=x, init=init, repr=repr)
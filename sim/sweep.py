@@ -0,0 +1,168 @@
+'''
+Parameter sweeps over Liquidity and RiskModel settings, run on a process pool.
+
+	python sweep.py --grid '{"v": [5, 10], "sigma": [1.0, 2.0]}' --workers 64 --checkpoint sweep.jsonl --output sweep.csv
+
+Each point of the grid builds a Liquidity and a RiskModel, hands them to a scenario builder which runs a market and
+returns its last record, and is reduced to a row of summary metrics. Finished rows are appended to the checkpoint
+file as they come in, so re-running the same command after an interruption only runs what is missing.
+'''
+import argparse
+import importlib
+import itertools
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+sys.path.append(os.path.dirname(__file__))
+from prelude import *
+from mechanism import *
+
+LIQUIDITY_PARAMS = ('v', 'k', 'stake_target_period', 'valuation_period')
+RISK_PARAMS = ('mu', 'sigma', 'tau', 'lambd', 'normal')
+METRICS = ('fee_rate', 'annualised_return_on_capital', 'total_margin')
+
+
+def grid(params: Dict[str, list]):
+	'''
+	Every combination of the given parameter values, as a list of dicts
+	'''
+	names = list(params)
+	for name in names:
+		if name not in LIQUIDITY_PARAMS + RISK_PARAMS:
+			raise ValueError(f"Unknown sweep parameter '{name}'.")
+	return [dict(zip(names, values)) for values in itertools.product(*(params[n] for n in names))]
+
+
+def example_scenario(liquidity: Liquidity, risk_model: RiskModel, days=365, seed=0):
+	'''
+	The liquidity_reward_distribution notebook's market on a synthetic daily price and volume path
+	'''
+	from mechanism.example_data import get_order_profiles
+
+	rng = np.random.default_rng(seed)
+	price = 100 * np.exp(np.cumsum(rng.normal(0, 0.03, days)))
+	volume = 1e6 * np.exp(np.cumsum(rng.normal(0, 0.05, days)))
+	mkt = Market(
+		name='sweep',
+		mark_price=price[0],
+		tick_size=1e-2,
+		num_ticks=10,
+		liquidity=liquidity,
+		open_interest=0.25*volume[0],
+		risk_model=risk_model)
+
+	(lo_empty, lo_smoothed, lf_smoothed, lo_active, lf_active, lo_passive, lf_passive,
+	 buySideA, sellSideA, buySideB, sellSideB, buySideC, sellSideC, buySideD, sellSideD) = get_order_profiles(mkt)
+	commitments = [
+		(1, 'A', 30000, 0.0025, sellSideA, buySideA),
+		(1, 'B', 70000, 0.002, sellSideB, buySideB),
+		(days // 3, 'C', 100000, 0.0015, sellSideC, buySideC),
+		(days // 2, 'D', 1000000, 0.00075, sellSideD, buySideD),
+	]
+	for i in range(days):
+		while commitments and commitments[0][0] <= i:
+			(_, lp_name, stake, fee_bid, sell_side_shape, buy_side_shape) = commitments.pop(0)
+			LiquidityProvider(market=mkt, name=lp_name, stake=stake, fee_bid=fee_bid,
+							  sell_side_shape=sell_side_shape, buy_side_shape=buy_side_shape)
+		mkt = mkt.next(traded_volume=volume[i], open_interest=0.25*volume[i], mark_price=price[i])
+	return mkt
+
+
+def run_one(params: dict, builder=example_scenario):
+	'''
+	Run one grid point and summarise it: the last and mean value of each metric over the market's history
+	'''
+	liquidity = Liquidity(**{p: params[p] for p in LIQUIDITY_PARAMS if p in params})
+	risk_model = RiskModel(**{p: params[p] for p in RISK_PARAMS if p in params})
+	m = builder(liquidity, risk_model)
+	# straight from the history, so that workers never import pandas
+	columns = export_columns(m, list(METRICS), [])
+	row = dict(params)
+	for metric in METRICS:
+		row[f'{metric}_last'] = float(columns[metric][-1])
+		row[f'{metric}_mean'] = float(np.mean(columns[metric]))
+	return row
+
+
+def run_chunk(chunk: List[dict], builder=example_scenario):
+	'''
+	Run a batch of grid points in one task, so that short runs aren't swamped by inter-process overhead
+	'''
+	return [run_one(params, builder) for params in chunk]
+
+
+def sweep(params: Dict[str, list], builder=example_scenario, workers=None, chunk_size=None, checkpoint=None):
+	'''
+	Run every point of the grid over a process pool and return one row of summary metrics per point.
+
+	builder(liquidity, risk_model) must return the last record of a market run and be importable by the worker
+	processes, i.e. a module-level function. With a checkpoint file, rows already in it are not run again and new
+	rows are appended as each chunk finishes.
+	'''
+	import pandas as pd
+
+	points = grid(params)
+	done = _load_checkpoint(checkpoint)
+	todo = [p for p in points if _key(p) not in done]
+	workers = workers or os.cpu_count()
+	# a few chunks per worker keeps the pool busy without a task per point
+	chunk_size = chunk_size or max(1, len(todo) // (4 * workers))
+	chunks = [todo[i:i + chunk_size] for i in range(0, len(todo), chunk_size)]
+
+	with ProcessPoolExecutor(max_workers=workers) as pool:
+		futures = [pool.submit(run_chunk, chunk, builder) for chunk in chunks]
+		for future in as_completed(futures):
+			rows = future.result()
+			for row in rows:
+				done[_key(row)] = row
+			if checkpoint is not None:
+				with open(checkpoint, 'a') as f:
+					for row in rows:
+						f.write(json.dumps(row) + '\n')
+
+	return pd.DataFrame([done[_key(p)] for p in points])
+
+
+def _key(params: dict):
+	return json.dumps({p: params[p] for p in LIQUIDITY_PARAMS + RISK_PARAMS if p in params}, sort_keys=True)
+
+
+def _load_checkpoint(checkpoint):
+	done = {}
+	if checkpoint is not None and os.path.isfile(checkpoint):
+		with open(checkpoint, 'r') as f:
+			for line in f:
+				try:
+					row = json.loads(line)
+				except ValueError:
+					continue  # a line cut short when the previous run was interrupted
+				done[_key(row)] = row
+	return done
+
+
+def _builder(spec):
+	(module, name) = spec.split(':')
+	return getattr(importlib.import_module(module), name)
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Sweep Liquidity and RiskModel parameters over a process pool.')
+	parser.add_argument('--grid', required=True, help='JSON object of parameter name to list of values')
+	parser.add_argument('--builder', default=None, help='scenario builder as module:function (default: example_scenario)')
+	parser.add_argument('--workers', type=int, default=None, help='worker processes (default: CPU count)')
+	parser.add_argument('--chunk-size', type=int, default=None, help='grid points per task')
+	parser.add_argument('--checkpoint', default=None, help='JSON lines file to resume from and append to')
+	parser.add_argument('--output', default=None, help='CSV file for the results (default: stdout)')
+	args = parser.parse_args(argv)
+
+	builder = _builder(args.builder) if args.builder else example_scenario
+	df = sweep(json.loads(args.grid), builder, args.workers, args.chunk_size, args.checkpoint)
+	df.to_csv(args.output if args.output else sys.stdout, index=False)
+
+
+if __name__ == '__main__':
+	main()
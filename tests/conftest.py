@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the simulation's modules import each other from sim/ (e.g. `from prelude import *`), as the notebooks do
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'sim'))
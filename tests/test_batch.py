@@ -0,0 +1,130 @@
+import math
+
+import numpy as np
+import pytest
+
+from mechanism.batch import Batch
+from mechanism.market import Market
+from mechanism.liquidity_provider import OrderSetForSide
+from mechanism.risk import RiskModel
+
+MARKET_FIELDS = ('traded_volume', 'open_interest', 'mark_price', 'valuation', 'target_stake', 'total_stake',
+				 'total_equity', 'total_margin', 'fee_rate', 'fees_collected', 'annualised_return',
+				 'annualised_return_on_capital')
+LP_FIELDS = ('stake', 'fee_bid', 'entry_valuation', 'obligation', 'margin', 'equity', 'equity_share', 'stake_share',
+			 'fee_revenue', 'annualised_return')
+
+
+def shapes(limit_orders, liquidity_fractions, ticks=None):
+	market = Market('shapes', mark_price=100, tick_size=0.01)
+	return (OrderSetForSide(market, True, limit_orders, liquidity_fractions, ticks=ticks),
+			OrderSetForSide(market, False, limit_orders, liquidity_fractions, ticks=ticks))
+
+
+def random_batch(seed, n=6, steps=25, lps=5):
+	rng = np.random.default_rng(seed)
+	# zeros carry the previous value forward; repeated stakes and bids exercise the tie-breaking
+	traded_volume = np.where(rng.random((n, steps)) < 0.2, 0.0, rng.uniform(1, 1000, (n, steps)))
+	open_interest = np.where(rng.random((n, steps)) < 0.2, 0.0, rng.uniform(1, 5000, (n, steps)))
+	mark_price = np.where(rng.random((n, steps)) < 0.2, 0.0, rng.uniform(90, 110, (n, steps)))
+	commit_step = rng.integers(-1, steps + 3, (n, lps))  # some empty slots, some committing after the last step
+	# some LPs commit more than once, the later commitment replacing the earlier
+	lp_index = rng.integers(0, lps - 1, (n, lps))
+	book = [None, shapes([0, 0], [1, 1], ticks=[1, 2]), shapes([5, 0, 1], [0, 1, 2], ticks=[1, 3, 4])]
+	shaped = [[book[j] for j in row] for row in rng.integers(0, len(book), (n, lps))]
+	return Batch(
+		traded_volume=traded_volume,
+		open_interest=open_interest,
+		mark_price=mark_price,
+		lp_stake=rng.choice([100.0, 250.0, rng.uniform(1, 1000)], (n, lps)),
+		lp_fee_bid=rng.choice([0.001, 0.002, 0.005, 0.01], (n, lps)),
+		lp_commit_step=commit_step,
+		lp_index=lp_index,
+		lp_sell_side_shape=[[s and s[0] for s in row] for row in shaped],
+		lp_buy_side_shape=[[s and s[1] for s in row] for row in shaped],
+		v=rng.uniform(1, 10, n),
+		k=rng.uniform(0.5, 2, n),
+		stake_target_period=rng.integers(1, 8, n),
+		valuation_period=rng.integers(1, 8, n),
+		risk_model=[RiskModel(sigma=sigma) for sigma in rng.uniform(0.5, 3, n)],
+		initial_traded_volume=rng.uniform(1, 1000, n),
+		initial_open_interest=rng.uniform(1, 5000, n),
+		initial_mark_price=rng.uniform(90, 110, n),
+		tick_size=rng.uniform(0.01, 0.1, n))
+
+
+def assert_matches_object_model(batch, results):
+	for i in range(batch.num_scenarios):
+		m = batch.to_market(i)
+		records = [m[n] for n in range(batch.num_steps + 1)]
+		assert [r._n for r in records] == list(results['_n'][i])
+		for f in MARKET_FIELDS:
+			expected = [getattr(r, f) for r in records]
+			assert np.allclose(results[f][i], expected, rtol=1e-9, atol=1e-12), (i, f)
+		for lp in range(batch.num_lps):
+			name = f'LP{lp}'
+			for f in LP_FIELDS:
+				expected = [getattr(r._lps[name], f) if name in r._lps else np.nan for r in records]
+				assert np.allclose(results['lp_' + f][i, :, lp], expected, rtol=1e-9, atol=1e-12, equal_nan=True), (
+					i, lp, f)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_run_matches_object_model(seed):
+	batch = random_batch(seed)
+	results = batch.run()
+	assert (batch.lp_index[:, :, None] == batch.lp_index[:, None, :]).sum() > batch.lp_index.size  # re-commitments
+	assert np.nansum(results['lp_margin']) > 0
+	assert_matches_object_model(batch, results)
+
+
+def notebook_batch(steps=200, **kwargs):
+	# get_example_market in notebooks/fee_margin_examples.ipynb
+	return Batch(
+		initial_mark_price=100, initial_traded_volume=1e6, initial_open_interest=0.25e6, tick_size=0.01, v=5, k=2,
+		risk_model=RiskModel(mu=0.0, sigma=2.0, tau=1.0 / 60 / 24 / 365.25, lambd=0.001),
+		open_interest=np.zeros((1, steps)), **kwargs)
+
+
+def test_notebook_fee_level_steps():
+	# 'A' commits again every 40 days with a higher fee bid, under linearly growing volume
+	batch = notebook_batch(
+		traded_volume=[[1e6 + i * 1e6 / 200 for i in range(200)]],
+		lp_stake=[[100000] * 5], lp_fee_bid=[[0.0025 * j for j in range(1, 6)]], lp_commit_step=[[1, 40, 80, 120, 160]],
+		lp_index=[[0] * 5])
+	results = batch.run()
+	assert results['lp_stake'].shape == (1, 201, 1)
+	assert [results['fee_rate'][0, n] for n in (1, 39, 40, 120, 200)] == [0.0025, 0.0025, 0.005, 0.01, 0.0125]
+	assert_matches_object_model(batch, results)
+
+
+def test_notebook_margins_across_time():
+	# three LPs with aggressive, uniform and passive shapes under a mark price moving as a sine
+	(empty, aggressive, uniform, passive) = ([0] * 10, [1] + [0] * 9, [1] * 10, [0] * 9 + [1])
+	books = [shapes(empty, fractions) for fractions in (passive, uniform, aggressive)]
+	batch = notebook_batch(
+		traded_volume=np.full((1, 200), 1e6),
+		mark_price=[[100 + 10 * math.sin(i * math.pi / 50) for i in range(200)]],
+		lp_stake=[[100000] * 3], lp_fee_bid=[[0.0025] * 3], lp_commit_step=[[1] * 3],
+		lp_sell_side_shape=[[sell for (sell, _) in books]], lp_buy_side_shape=[[buy for (_, buy) in books]])
+	results = batch.run()
+	margins = results['lp_margin'][0, 2:]
+	assert (margins[:, 0] > margins[:, 1]).all() and (margins[:, 1] > margins[:, 2]).all()
+	assert np.ptp(results['total_margin'][0, 2:]) > 0
+	assert_matches_object_model(batch, results)
+
+
+def test_run_shapes():
+	batch = random_batch(0, n=3, steps=7, lps=4)
+	results = batch.run()
+	for (f, values) in results.items():
+		assert values.shape == ((3, 8, batch.num_lps) if f.startswith('lp_') else (3, 8)), f
+
+
+def test_each_commitment_is_its_own_lp_by_default():
+	batch = Batch(traded_volume=[[1, 2]], open_interest=[[1, 1]], lp_stake=[[1, 2, 3]], lp_fee_bid=[[0, 0, 0]],
+				  lp_commit_step=[[0, 1, -1]])
+	results = batch.run()
+	assert batch.num_lps == 3
+	assert np.array_equal(results['lp_stake'][0], [[1, np.nan, np.nan], [1, 2, np.nan], [1, 2, np.nan]], equal_nan=True)
+	assert (results['total_margin'] == 0).all()
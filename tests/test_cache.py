@@ -0,0 +1,23 @@
+import pytest
+
+from data.cache import Cache, JsonFileCache, ColumnarCache
+
+
+def test_backend_must_implement_get_and_put():
+	class GetOnly(Cache):
+		def get(self, key):
+			return None
+
+	for cls in (Cache, GetOnly):
+		with pytest.raises(TypeError):
+			cls()
+
+
+@pytest.mark.parametrize('make_cache', [JsonFileCache, ColumnarCache])
+def test_append_and_last(tmp_path, make_cache):
+	cache = make_cache(str(tmp_path))
+	assert cache.get('k') is None and cache.last('k', 't') is None
+	cache.put('k', [{'t': 1.0, 'v': 1.0}, {'t': 2.0, 'v': 2.0}])
+	cache.append('k', [{'t': 3.0, 'v': 3.0}, {'t': 2.0, 'v': 5.0}], on='t')
+	assert cache.get('k') == [{'t': 1.0, 'v': 1.0}, {'t': 2.0, 'v': 5.0}, {'t': 3.0, 'v': 3.0}]
+	assert cache.last('k', 't') == 3.0
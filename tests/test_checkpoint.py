@@ -0,0 +1,152 @@
+import io
+import os
+
+import numpy as np
+import pytest
+
+import mechanism.history
+import mechanism.checkpoint
+from mechanism.market import Market, Liquidity, OrderSetForSide
+from mechanism.checkpoint import save, restore, Checkpointer
+
+STEPS = 400
+
+
+def build(seed=0):
+	'''
+	A market with LPs committing, amending and cancelling at later steps, some with order shapes, and its inputs
+	'''
+	rng = np.random.default_rng(seed)
+	prices = 100 * np.exp(np.cumsum(rng.normal(0, 0.02, STEPS)))
+	volumes = 1e6 * (1 + rng.random(STEPS))
+	m = Market('test', mark_price=prices[0], tick_size=0.01, num_ticks=10, traded_volume=volumes[0],
+			   open_interest=0.25 * volumes[0], liquidity=Liquidity(stake_target_period=7, valuation_period=7))
+	for i in range(4):
+		m.commit(f'LP{i}', stake=float(rng.integers(1, 100) * 1000), fee_bid=float(rng.integers(1, 50)) / 1e4,
+				 sell_side_shape=OrderSetForSide(m, True, [0, 0], [1, 1], ticks=[1, 2]),
+				 buy_side_shape=OrderSetForSide(m, False, [0, 0], [1, 2], ticks=[1, 3]), step=i * 30)
+	m.amend_stake('LP0', 5000, step=150)
+	m.cancel('LP1', step=170)
+	m.commit('late', stake=7000, fee_bid=0.002, sell_side_shape=OrderSetForSide(m, True, [0], [1], ticks=[2]),
+			 step=180)
+	return (m, prices, volumes)
+
+
+def run(m, prices, volumes, stop):
+	for n in range(len(m._history), stop):
+		m = m.next(traded_volume=volumes[n], open_interest=0.25 * volumes[n], mark_price=prices[n])
+	return m
+
+
+def csv(m):
+	output = io.StringIO()
+	m.to_csv(output=output)
+	return output.getvalue()
+
+
+@pytest.fixture
+def small_spills(monkeypatch):
+	# release rows every few hundred records rather than every few thousand
+	monkeypatch.setattr(mechanism.history, 'SPILL_ROWS', 64)
+	monkeypatch.setattr(mechanism.checkpoint, 'SPILL_ROWS', 64)
+
+
+def test_restore_into_a_spill_directory(tmp_path, small_spills):
+	(m, prices, volumes) = build()
+	m = run(m, prices, volumes, 300)
+	path = str(tmp_path / 'run.ckpt')
+	save(m, path)
+
+	restored = restore(path, spill_dir=str(tmp_path / 'spill'))
+	assert restored._history.spilled and restored._history._released > 0
+	assert csv(restored) == csv(m)
+	assert csv(run(restored, prices, volumes, STEPS)) == csv(run(m, prices, volumes, STEPS))
+
+
+def test_checkpointer_writes_only_changed_rows(tmp_path):
+	(m, prices, volumes) = build()
+	path = str(tmp_path / 'run.ckpt')
+	checkpointer = Checkpointer(path, every=20, background=False).attach(m)
+	m = run(m, prices, volumes, 300)
+	segments = checkpointer._segments
+	assert checkpointer.saved == 281 and len(segments) <= 5
+	# segments cover the rows in order, and are the only files beside the checkpoint
+	assert [start for (start, _, _) in segments] == [0, *[stop for (_, stop, _) in segments[:-1]]]
+	assert sorted(os.listdir(tmp_path)) == sorted(['run.ckpt', *[file for (_, _, file) in segments]])
+
+	# only the rows from the first changed record on are written again
+	m[290].mark_price = 99.0
+	checkpointer.save(m)
+	assert checkpointer._segments[:-1] == [s for s in segments if s[1] <= 290][:len(checkpointer._segments) - 1]
+	assert checkpointer._segments[-1][1] == 300
+	m[10].mark_price = 101.0
+	m.commit('new', stake=1000, fee_bid=0.001)
+	checkpointer.save(m)
+	assert [(start, stop) for (start, stop, _) in checkpointer._segments] == [(0, 300)]
+	checkpointer.close()
+	assert sorted(os.listdir(tmp_path)) == sorted(['run.ckpt', checkpointer._segments[0][2]])
+	assert csv(restore(path)) == csv(m)
+
+
+def test_checkpointer_replaces_an_earlier_checkpoint(tmp_path):
+	(m, prices, volumes) = build()
+	path = str(tmp_path / 'run.ckpt')
+	with Checkpointer(path, every=50, background=False).attach(m):
+		m = run(m, prices, volumes, 200)
+	restored = restore(path)
+	with Checkpointer(path, every=50, background=False).attach(restored) as checkpointer:
+		restored = run(restored, prices, volumes, 300)
+	assert sorted(os.listdir(tmp_path)) == sorted(['run.ckpt', *[file for (_, _, file) in checkpointer._segments]])
+	assert csv(restore(path)) == csv(run(m, prices, volumes, checkpointer.saved))
+
+
+def test_restore_mid_run_continues_like_an_uninterrupted_run(tmp_path):
+	(m, prices, volumes) = build()
+	full = run(m, prices, volumes, STEPS)
+
+	(m, prices, volumes) = build()
+	m = run(m, prices, volumes, 100)
+	path = str(tmp_path / 'run.ckpt')
+	save(m, path)
+	restored = restore(path)
+	# the amendment, cancellation and late commitment are still to come, the late one with its shape
+	assert [(e.step, e.kind, e.name) for e in restored._history.events.upto(STEPS)] == \
+		   [(150, 'amend_stake', 'LP0'), (170, 'cancel', 'LP1'), (180, 'commit', 'late')]
+	assert restored._history.events.upto(STEPS)[-1].values['sell_side_shape'].ticks.tolist() == [2]
+	assert restored.lp('LP2').buy_side_shape.liquidity_fractions.tolist() == [1, 2]
+	assert len(restored._history.events.applied) == len(m._history.events.applied)
+	assert csv(restored) == csv(m)
+
+	restored = run(restored, prices, volumes, STEPS)
+	assert csv(restored) == csv(full)
+	assert len(restored._history.events) == 0
+
+
+def test_checkpointer_in_the_background(tmp_path):
+	(m, prices, volumes) = build()
+	full = run(m, prices, volumes, STEPS)
+
+	(m, prices, volumes) = build()
+	path = str(tmp_path / 'run.ckpt')
+	with Checkpointer(path, every=40).attach(m) as checkpointer:
+		m = run(m, prices, volumes, 300)
+	# close waited for the last checkpoint and detached the checkpointer
+	assert checkpointer.saved == 281 and m._history.checkpointer is None
+	m = run(m, prices, volumes, STEPS)
+	assert checkpointer.saved == 281
+
+	restored = restore(path)
+	assert len(restored._history) == 281
+	assert csv(run(restored, prices, volumes, STEPS)) == csv(full)
+
+
+def test_checkpointer_raises_a_failed_write_on_close(tmp_path, monkeypatch):
+	def fail(*args):
+		raise OSError('disk full')
+
+	(m, prices, volumes) = build()
+	monkeypatch.setattr(mechanism.checkpoint, '_write', fail)
+	checkpointer = Checkpointer(str(tmp_path / 'run.ckpt'), every=10).attach(m)
+	m = run(m, prices, volumes, 15)
+	with pytest.raises(OSError):
+		checkpointer.close()
@@ -0,0 +1,100 @@
+import pytest
+
+from mechanism.market import Market, LiquidityProvider
+from mechanism.events import Event, EventLog
+
+
+def market():
+	m = Market('test', traded_volume=100, open_interest=1000)
+	LiquidityProvider(market=m, name='A', stake=100, fee_bid=0.01)
+	return m
+
+
+def lps(m):
+	return {lp.name: (lp.stake, lp.fee_bid) for lp in m.lps}
+
+
+def test_queued_events_apply_at_their_step():
+	m = market()
+	m.commit('B', stake=200, fee_bid=0.02, step=2)
+	m.amend_stake('A', 150, step=3)
+	m.amend_fee_bid('B', 0.005, step=3)
+	m.cancel('A', step=4)
+	assert len(m._history.events) == 4
+
+	records = [m]
+	for _ in range(5):
+		records.append(records[-1].next())
+	assert [lps(r) for r in records] == [
+		{'A': (100, 0.01)},
+		{'A': (100, 0.01)},
+		{'A': (100, 0.01), 'B': (200, 0.02)},
+		{'A': (150, 0.01), 'B': (200, 0.005)},
+		{'B': (200, 0.005)},
+		{'B': (200, 0.005)},
+	]
+	assert len(m._history.events) == 0
+	assert [(e.step, e.kind, e.name) for e in m._history.events.applied] == \
+		   [(2, 'commit', 'B'), (3, 'amend_stake', 'A'), (3, 'amend_fee_bid', 'B'), (4, 'cancel', 'A')]
+
+
+def test_events_at_the_same_step_apply_in_the_order_submitted():
+	m = market()
+	m.commit('B', stake=200, fee_bid=0.02, step=2)
+	m.amend_stake('B', 300, step=2)  # only valid after the commitment before it
+	m.amend_stake('B', 250, step=2)
+	m.cancel('A', step=2)
+	m.commit('A', stake=50, fee_bid=0.03, step=2)
+	m = m.next().next()
+	assert lps(m) == {'B': (250, 0.02), 'A': (50, 0.03)}
+	assert [e.kind for e in m._history.events.applied] == ['commit', 'amend_stake', 'amend_stake', 'cancel', 'commit']
+
+
+def test_events_at_or_before_the_latest_record_apply_now():
+	m = market()
+	m.amend_stake('A', 120, step=0)
+	m = m.next()
+	m.commit('B', stake=200, step=0)
+	assert lps(m) == {'A': (120, 0.01), 'B': (200, 0.0)}
+	assert lps(m[0]) == {'A': (120, 0.01)}
+	assert [e.step for e in m._history.events.applied] == [0, 1]
+
+
+def test_an_event_for_an_lp_that_wont_be_there_is_refused():
+	m = market()
+	with pytest.raises(KeyError):
+		m.amend_stake('B', 10, step=3)
+	m.cancel('A', step=2)
+	with pytest.raises(KeyError):
+		m.amend_fee_bid('A', 0.02, step=3)
+	assert len(m._history.events) == 1
+
+
+def test_a_rejected_event_leaves_the_history_and_queue_as_they_were():
+	m = market()
+	m.cancel('A', step=2)
+	m = m.next()
+	m.cancel('A')  # now, so the queued cancellation finds no LP at step 2
+	queued = m._history.events.upto(10)
+	with pytest.raises(KeyError):
+		m.next()
+	assert len(m._history) == 2
+	assert m._history.events.upto(10) == queued
+	assert m._history[-1] is m
+
+
+def test_due_leaves_events_queued_if_the_check_fails():
+	events = EventLog()
+	for (step, name) in ((3, 'a'), (1, 'b'), (3, 'c'), (5, 'd')):
+		events.push(Event(step, 'cancel', name, {}))
+
+	def refuse(due):
+		raise KeyError(due[0].name)
+
+	with pytest.raises(KeyError):
+		events.due(3, refuse)
+	assert len(events) == 4
+	assert [e.name for e in events.due(3, lambda due: None)] == ['b', 'a', 'c']
+	assert [e.name for e in events.upto(10)] == ['d']
+	with pytest.raises(ValueError):
+		events.push(Event(6, 'withdraw', 'd', {}))
@@ -0,0 +1,165 @@
+import json
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+import requests
+
+from data.cache import JsonFileCache, ColumnarCache
+from data.exchanges import FTX
+
+RESOLUTION = 60
+
+
+class Server(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+	'''
+	A stand-in for the FTX candles API: every market has a candle at each multiple of RESOLUTION, with volume given
+	by server.volume(market, time). Pages include one candle either side of the requested range, as the real API
+	may. Requests are recorded in server.requests; server.throttle responses are 429s with server.retry_after.
+	'''
+
+	def log_message(self, *args):
+		pass
+
+	def do_GET(self):
+		server = self.server
+		url = urlparse(self.path)
+		query = {key: int(values[0]) for (key, values) in parse_qs(url.query).items()}
+		market = url.path.split('/')[-2]
+		with server.lock:
+			server.requests.append((market, query.get('start_time'), query.get('end_time'), time.monotonic()))
+			throttle = server.throttle > 0
+			server.throttle -= throttle
+		if throttle:
+			self.send_response(429)
+			self.send_header('Retry-After', str(server.retry_after))
+			self.end_headers()
+			return
+
+		resolution = query['resolution']
+		start = max(0, query['start_time'] - resolution)
+		end = min(server.now, query['end_time'] + resolution)
+		candles = [{'time': t * 1000.0, 'volume': server.volume(market, t)}
+				   for t in range(start - start % resolution, end + 1, resolution)]
+		body = json.dumps({'success': True, 'result': candles}).encode()
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+	server = Server(('127.0.0.1', 0), Handler)
+	server.lock = threading.Lock()
+	server.requests = []
+	server.throttle = 0
+	server.retry_after = 0
+	server.now = 10 ** 9
+	server.volume = lambda market, t: float(t)
+	thread = threading.Thread(target=server.serve_forever, daemon=True)
+	thread.start()
+	server.api = f'http://127.0.0.1:{server.server_port}/api'
+	yield server
+	server.shutdown()
+	server.server_close()
+
+
+def times(candles):
+	return [c['time'] // 1000 for c in candles]
+
+
+def test_get_histories_pages_and_caches(server, tmp_path):
+	ftx = FTX(str(tmp_path), api=server.api, backoff=0.001)
+	end = RESOLUTION * (2 * FTX.PAGE_SIZE + 100)
+	histories = ftx.get_histories(['A', 'B'], RESOLUTION, 0, end)
+
+	expected = list(range(0, end + 1, RESOLUTION))
+	for market in ('A', 'B'):
+		assert times(histories[market]) == expected  # pages merged in order, overlapping candles dropped
+		pages = sorted((start, stop) for (m, start, stop, _) in server.requests if m == market)
+		assert pages == [(i * FTX.PAGE_SIZE * RESOLUTION, min((i + 1) * FTX.PAGE_SIZE * RESOLUTION - RESOLUTION, end))
+						 for i in range(3)]
+
+	# the range is cached as a whole
+	count = len(server.requests)
+	assert ftx.get_histories(['A', 'B'], RESOLUTION, 0, end) == histories
+	assert ftx.get_history('A', RESOLUTION, start_time=0, end_time=end) == histories['A']
+	assert len(server.requests) == count
+
+
+@pytest.mark.parametrize('make_cache', [JsonFileCache, ColumnarCache])
+def test_get_histories_up_to_now_tops_up_one_list(server, tmp_path, make_cache):
+	cache = make_cache(str(tmp_path))
+	ftx = FTX(cache=cache, api=server.api, backoff=0.001)
+	server.now = now = int(time.time()) // RESOLUTION * RESOLUTION
+	start = now - RESOLUTION * 2000
+	histories = ftx.get_histories(['A', 'B'], RESOLUTION, start)
+	assert times(histories['A']) == times(histories['B']) == list(range(start, now + 1, RESOLUTION))
+
+	# a later call only asks for the candles from the last one on, and leaves no list of its own behind
+	server.requests.clear()
+	assert ftx.get_histories(['A', 'B'], RESOLUTION, start + RESOLUTION * 10)['A'] == histories['A'][10:]
+	assert sorted((m, s) for (m, s, _, _) in server.requests) == [('A', now), ('B', now)]
+	assert not any('_history_' in path.name for path in tmp_path.iterdir())
+
+	# an earlier start fetches the candles before the cached ones, once
+	server.requests.clear()
+	earlier = start - RESOLUTION * 100
+	assert times(ftx.get_history('A', RESOLUTION, start_time=earlier)) == list(range(earlier, now + 1, RESOLUTION))
+	assert sorted(s for (_, s, _, _) in server.requests) == [earlier, now]
+	server.requests.clear()
+	assert times(ftx.get_history('A', RESOLUTION, start_time=earlier))[0] == earlier
+	assert [s for (_, s, _, _) in server.requests] == [now]
+
+
+def test_retries_after_rate_limit(server):
+	server.throttle = 2
+	server.retry_after = 0.2
+	ftx = FTX(api=server.api, backoff=0.001, max_workers=1)
+	candles = ftx.get_history('A', RESOLUTION, start_time=0, end_time=10 * RESOLUTION)
+
+	assert times(candles) == list(range(0, 11 * RESOLUTION, RESOLUTION))
+	assert len(server.requests) == 3
+	gaps = [b[-1] - a[-1] for (a, b) in zip(server.requests, server.requests[1:])]
+	assert min(gaps) >= 0.2  # waited as long as Retry-After asked, not the much shorter backoff
+
+
+def test_gives_up_after_retries(server):
+	server.throttle = 3
+	ftx = FTX(api=server.api, backoff=0.001, retries=2)
+	with pytest.raises(requests.HTTPError):
+		ftx.get_history('A', RESOLUTION, start_time=0, end_time=10 * RESOLUTION)
+	assert len(server.requests) == 3
+
+
+@pytest.mark.parametrize('make_cache', [JsonFileCache, ColumnarCache])
+def test_update_histories_merges(server, tmp_path, make_cache):
+	ftx = FTX(cache=make_cache(str(tmp_path)), api=server.api, backoff=0.001)
+	server.now = first = RESOLUTION * 2000
+	histories = ftx.update_histories(['A', 'B'], RESOLUTION, 0, first)
+	assert times(histories['A']) == times(histories['B']) == list(range(0, first + 1, RESOLUTION))
+
+	# the last candle was incomplete when it was fetched: the update replaces it and appends the new ones
+	server.requests.clear()
+	server.now = second = first + RESOLUTION * 50
+	server.volume = lambda market, t: float(t) + (0.5 if t == first else 0)
+	histories = ftx.update_histories(['A', 'B'], RESOLUTION, 0, second)
+	for market in ('A', 'B'):
+		assert times(histories[market]) == list(range(0, second + 1, RESOLUTION))
+		assert histories[market][first // RESOLUTION]['volume'] == first + 0.5
+		assert ftx.update_history(market, RESOLUTION, 0, second) == histories[market]
+	assert sorted((m, start) for (m, start, _, _) in server.requests[:2]) == [('A', first), ('B', first)]
+
+
+def test_update_histories_needs_cache(server):
+	with pytest.raises(ValueError):
+		FTX(api=server.api).update_histories(['A'], RESOLUTION)
@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from mechanism.market import Market, Liquidity, LiquidityProvider, OrderSetForSide
+from mechanism.export import export_columns
+
+MARKET_FIELDS = ['_n', 'mark_price', 'traded_volume', 'open_interest', 'valuation', 'target_stake', 'total_stake',
+				 'total_margin', 'fee_rate', 'fees_collected', 'annualised_return', 'annualised_return_on_capital',
+				 'total_equity']
+LP_FIELDS = ['stake', 'fee_bid', 'entry_valuation', 'equity', 'equity_share', 'stake_share', 'fee_revenue',
+			 'annualised_return', 'obligation', 'margin']
+
+
+def run(steps=300, lps=8, seed=0):
+	'''
+	A market where LPs join at random steps, some with order shapes, and one LP's fee bid keeps changing
+	'''
+	rng = np.random.default_rng(seed)
+	m = Market('test', traded_volume=100, open_interest=1000, mark_price=100, liquidity=Liquidity(valuation_period=7))
+	joins = sorted((int(rng.integers(0, steps // 2)), i) for i in range(lps))
+	for n in range(steps):
+		while joins and joins[0][0] <= n:
+			(_, i) = joins.pop(0)
+			shapes = {}
+			if i % 3 == 0:
+				shapes = dict(sell_side_shape=OrderSetForSide(m, True, [0, 0], [1, 1], ticks=[1, 2]),
+							  buy_side_shape=OrderSetForSide(m, False, [0, 0], [1, 2], ticks=[1, 3]))
+			LiquidityProvider(market=m, name=f'LP{i}', stake=float(rng.uniform(100, 1000)),
+							  fee_bid=float(rng.choice([0.001, 0.002, 0.003])), **shapes)
+		if n % 37 == 5 and m._lps:
+			m.amend_fee_bid(next(iter(m._lps)), float(rng.choice([0.001, 0.002, 0.003])))
+		m = m.next(traded_volume=float(rng.uniform(50, 500)), open_interest=float(rng.uniform(500, 5000)),
+				   mark_price=float(rng.uniform(90, 110)))
+	return m
+
+
+def per_record(m, start, stop):
+	history = m._history
+	columns = {f: [n if f == '_n' else getattr(history[n], f) for n in range(start, stop)] for f in MARKET_FIELDS}
+	for lp in history.lp_names:
+		for f in LP_FIELDS:
+			columns[f'{lp}_{f}'] = [history[n].lp(lp, f, np.nan) for n in range(start, stop)]
+	return columns
+
+
+@pytest.mark.parametrize('start, stop', [(0, None), (123, 211), (50, 50)])
+def test_derived_columns_are_the_records_own(start, stop):
+	m = run()
+	stop = len(m._history) if stop is None else stop
+	columns = export_columns(m, MARKET_FIELDS, LP_FIELDS, start, stop)
+	expected = per_record(m, start, stop)
+	assert columns.keys() == expected.keys()
+	for (name, values) in expected.items():
+		assert np.array_equal(columns[name], np.asarray(values, dtype=float), equal_nan=True), name
+	if stop > start:
+		assert np.any(columns['LP0_margin'][~np.isnan(columns['LP0_margin'])] > 0)
+
+
+def test_incremental_frame_follows_every_change():
+	rng = np.random.default_rng(0)
+	m = Market('test', traded_volume=100, open_interest=1000, mark_price=100, liquidity=Liquidity(valuation_period=7))
+	LiquidityProvider(market=m, name='A', stake=100, fee_bid=0.01)
+	LiquidityProvider(market=m, name='B', stake=200, fee_bid=0.02,
+					  sell_side_shape=OrderSetForSide(m, True, [0, 0], [1, 1], ticks=[1, 2]))
+	changes = {
+		5: lambda m: m.commit('C', stake=300, fee_bid=0.005),
+		8: lambda m: m.commit('D', stake=400, fee_bid=0.001, step=m._n + 3),  # queued, applied at its step
+		12: lambda m: m.amend_stake('A', 150),
+		15: lambda m: m.amend_fee_bid('B', 0.001),
+		18: lambda m: m.cancel('C'),
+		21: lambda m: set_liquidity(m, v=3),
+		24: lambda m: set_liquidity(m[10], valuation_period=4),  # an old record's parameters
+		27: lambda m: setattr(m[3], 'traded_volume', 500),  # an old record's market data
+		30: lambda m: m[20].amend_lp('A', stake=90),  # an old record's LP
+		33: lambda m: setattr(m, 'liquidity', Liquidity(k=2)),
+		36: lambda m: m.commit('E', stake=250.5, fee_bid=0.002),  # the first stake that isn't an integer
+	}
+	for n in range(40):
+		if n in changes:
+			changes[n](m)
+		incremental = m.to_data_frame(incremental=True)
+		pd.testing.assert_frame_equal(incremental, m.to_data_frame())
+		m = m.next(traded_volume=float(rng.integers(50, 500)), open_interest=float(rng.integers(500, 5000)))
+	assert len(m._history.exports) == 1
+
+
+def set_liquidity(m, **values):
+	for (name, value) in values.items():
+		setattr(m.liquidity, name, value)
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+import mechanism.history
+from mechanism.market import Market, Liquidity
+from mechanism.export import export_columns
+
+MARKET_FIELDS = ['_n', 'traded_volume', 'valuation', 'target_stake', 'total_stake', 'fee_rate']
+LP_FIELDS = ['stake', 'fee_bid', 'entry_valuation', 'equity_share']
+
+
+def run(steps, spill_dir=None, spill_at=100, late_at=600):
+	'''
+	A market with a few LPs, spilled to spill_dir at step spill_at if given, and another LP joining at late_at
+	'''
+	rng = np.random.default_rng(0)
+	m = Market('test', mark_price=100.0, tick_size=0.01, num_ticks=10, traded_volume=1e6, open_interest=2.5e5,
+			   liquidity=Liquidity(stake_target_period=7, valuation_period=7))
+	for i in range(4):
+		m.commit(f'LP{i}', stake=float(rng.integers(1, 100) * 1000), fee_bid=float(rng.integers(1, 50)) / 1e4, step=i * 50)
+	m.cancel('LP1', step=300)
+	for n in range(1, steps):
+		if spill_dir is not None and n == spill_at:
+			m.spill_to(spill_dir)
+		if n == late_at:
+			m.commit('late', stake=7000, fee_bid=0.002)
+		volume = 1e6 * (1 + rng.random())
+		m = m.next(traded_volume=volume, open_interest=0.25 * volume, mark_price=100 * (1 + 0.01 * rng.random()))
+	return m
+
+
+@pytest.fixture
+def small_spills(monkeypatch):
+	# release rows every few hundred records rather than every few thousand
+	monkeypatch.setattr(mechanism.history, 'SPILL_ROWS', 64)
+
+
+def test_spilled_history_exports_the_same(tmp_path, small_spills):
+	m = run(1000)
+	spilled = run(1000, str(tmp_path))
+	history = spilled._history
+	assert history.spilled and history._released > 0 and 'late' in history.lp_names
+
+	expected = export_columns(m, MARKET_FIELDS, LP_FIELDS)
+	columns = export_columns(spilled, MARKET_FIELDS, LP_FIELDS)
+	assert columns.keys() == expected.keys()
+	for (name, values) in expected.items():
+		assert np.array_equal(columns[name], values, equal_nan=True), name
+	for n in (5, 700):
+		assert {lp.name: lp.stake for lp in spilled[n].lps} == {lp.name: lp.stake for lp in m[n].lps}
+
+
+def test_spilling_twice_fails(tmp_path):
+	m = run(10, str(tmp_path), spill_at=5)
+	with pytest.raises(ValueError):
+		m.spill_to(str(tmp_path / 'other'))
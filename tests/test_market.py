@@ -0,0 +1,61 @@
+import pickle
+
+from mechanism.market import Market, Liquidity, RiskModel, LiquidityProvider
+
+
+def run(steps=10, **kwargs):
+	m = Market('test', traded_volume=50, open_interest=500, **kwargs)
+	LiquidityProvider(market=m, name='A', stake=100, fee_bid=0.01)
+	for i in range(steps):
+		m = m.next(traded_volume=100 + i, open_interest=1000 + i)
+	return m
+
+
+def test_changing_a_records_liquidity_in_place():
+	m = run(liquidity=Liquidity(valuation_period=2))
+	valuations = [r.valuation for r in m._history]
+	m[5].liquidity.valuation_period = 4
+	assert [r.liquidity.valuation_period for r in m[4:7]] == [2, 4, 2]
+	changed = [r.valuation for r in m._history]
+	assert changed[:5] == valuations[:5] and changed[5] != valuations[5]
+	assert changed[5] == 4 / 4 * sum(r.traded_volume for r in m[2:6])
+
+	m.liquidity.v = 10
+	assert m.target_stake == 10 * max(r.open_interest for r in m[-7:]) * m.risk_model.RiskFactorShort()
+
+
+def test_changing_the_risk_model_in_place():
+	risk_model = RiskModel()
+	m = run(risk_model=risk_model)
+	other = run(risk_model=risk_model)  # markets may share one
+	before = [r.target_stake for r in m._history]
+	risk_model.sigma = 1.0
+	after = [r.target_stake for r in m._history]
+	assert all(a < b for (a, b) in zip(after, before))
+	assert other.target_stake == after[-1]
+
+
+def test_liquidity_is_each_records_own():
+	liquidity = Liquidity(v=2)
+	m = Market('a', liquidity=liquidity)
+	assert m.liquidity is liquidity
+	assert Market('b', liquidity=liquidity).liquidity is not liquidity
+	n = m.next()
+	assert n.liquidity == liquidity and n.liquidity is not liquidity
+	n.liquidity.v = 3
+	assert m.liquidity.v == 2
+
+
+def test_parameters_pickle_without_their_market():
+	m = run()
+	assert pickle.loads(pickle.dumps(m.liquidity)) == m.liquidity
+	assert pickle.loads(pickle.dumps(m.risk_model)) == m.risk_model
+
+
+def test_removing_an_lp_changes_only_that_record():
+	m = run()
+	m[4].remove_lp('A')
+	assert [r.lp('A') is not None for r in m[3:6]] == [True, False, True]
+	assert m[4].total_stake == 0 and m[5].total_stake == 100
+	m.remove_lp('A')
+	assert m.next().lp('A') is None
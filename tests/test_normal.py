@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from scipy.stats import norm
+
+from mechanism import normal, risk
+from mechanism.normal import NUMPY_TOLERANCE, Normal
+
+# cdf reaches the smallest normal double just below -37
+X = np.concatenate([np.linspace(-37.5, 37.5, 15001), [0.0, -1e-300, 1e-300]])
+P = np.concatenate([np.logspace(-300, -1, 3000), np.linspace(0.01, 0.99, 981), 1 - np.logspace(-16, -1, 1000)])
+
+
+def relative_error(values, expected):
+	# over expected values that are normal doubles
+	values = np.asarray(values, dtype=float)
+	keep = np.abs(expected) >= np.finfo(float).tiny
+	return np.max(np.abs(values[keep] - expected[keep]) / np.abs(expected[keep]))
+
+
+@pytest.mark.parametrize('name', ['cdf', 'sf', 'pdf'])
+def test_matches_scipy(name):
+	assert relative_error(getattr(normal, name)(X), getattr(norm, name)(X)) <= NUMPY_TOLERANCE
+
+
+def test_ppf_matches_scipy():
+	expected = norm.ppf(P)
+	# relative error, except near the median where the quantile itself goes to 0
+	assert np.max(np.abs(normal.ppf(P) - expected) / np.maximum(np.abs(expected), 1.0)) <= NUMPY_TOLERANCE
+	assert normal.ppf(0.0) == -np.inf and normal.ppf(1.0) == np.inf
+	assert np.isnan(normal.ppf([-0.1, 1.1, np.nan])).all()
+
+
+def test_backends_have_the_same_functions():
+	scipy = normal.distribution('scipy')
+	assert normal.distribution('numpy')._fields == scipy._fields
+	assert np.allclose(scipy.pdf(X), normal.pdf(X), rtol=NUMPY_TOLERANCE, atol=0)
+
+
+@pytest.mark.parametrize('sigma', [0.1, 0.5, 2.0, 20.0])
+@pytest.mark.parametrize('tau', [1.0 / 60 / 24 / 365.25, 1.0 / 365.25, 10.0])
+@pytest.mark.parametrize('lambd', [1e-6, 1e-3, 0.1, 0.5])
+def test_risk_factors_match_scipy(monkeypatch, sigma, tau, lambd):
+	# the reference uses scipy's own sf: the scipy backend's 1 - cdf loses accuracy when lambd is small
+	values = risk._risk_factors(0.1, sigma, tau, lambd, 'numpy')
+	monkeypatch.setattr(risk, 'distribution', lambda backend: Normal(norm.cdf, norm.sf, norm.ppf, norm.pdf))
+	expected = risk._risk_factors.__wrapped__(0.1, sigma, tau, lambd)
+	for (value, e) in zip(values, expected):
+		# the risk factors are an expected shortfall plus or minus 1, so the error is relative to at least 1
+		assert abs(value - e) <= NUMPY_TOLERANCE * max(abs(e), 1.0)
@@ -0,0 +1,27 @@
+import json
+
+import pytest
+
+from data.stream import read_candles
+
+CANDLES = [{'time': 1000 * n, 'close': 100.0 + n, 'volume': 10 * n} for n in range(50)]
+
+
+@pytest.mark.parametrize('content', [
+	CANDLES,
+	{'success': True, 'result': CANDLES},
+	# a "result" key inside another value comes before the real one
+	{'meta': {'result': 1, 'note': '"result": []'}, 'result': CANDLES, 'after': [1, 2]},
+])
+def test_json_candles_are_read_in_small_blocks(tmp_path, content):
+	path = tmp_path / 'candles.json'
+	path.write_text(json.dumps(content))
+	assert list(read_candles(str(path), chunk_size=1)) == CANDLES
+
+
+@pytest.mark.parametrize('content', [{'meta': {'result': [{'close': 1}]}}, {'result': 1}])
+def test_json_without_a_result_list_is_refused(tmp_path, content):
+	path = tmp_path / 'candles.json'
+	path.write_text(json.dumps(content))
+	with pytest.raises(ValueError):
+		list(read_candles(str(path)))